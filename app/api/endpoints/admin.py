@@ -0,0 +1,44 @@
+import asyncio
+import os
+import time
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import Response
+
+from app.api.deps import require_admin
+from app.api.endpoints.model import pipeline
+from app.core import profiling
+from app.core.config import settings
+
+router = APIRouter(dependencies=[Depends(require_admin)])
+
+
+@router.post("/profile")
+async def capture_profile(
+    seconds: float = Query(10, gt=0, description="How long to profile /classify traffic for"),
+    memory: bool = Query(True, description="Also trace allocations, which slows requests and skews CPU samples"),
+    torch_ops: bool = Query(False, alias="torch", description="Also record torch operator times"),
+    interval_ms: float = Query(5, ge=1, le=100, description="Stack sampling interval")
+):
+    """
+    Profile this worker's /classify traffic for a number of seconds and download the results as a zip.
+    With several workers, only the worker that receives this request is profiled (see pid in summary.json).
+    """
+    if not settings.PROFILING_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if seconds > settings.PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"At most {settings.PROFILE_MAX_SECONDS} seconds can be profiled")
+    
+    try:
+        capture = profiling.start_capture(interval=interval_ms / 1000, memory=memory, torch_ops=torch_ops)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiling.stop_capture()
+    
+    archive = await asyncio.to_thread(capture.bundle, {"model_version": pipeline.version})
+    filename = f"profile-{os.getpid()}-{int(time.time())}.zip"
+    return Response(archive, media_type="application/zip", headers={"Content-Disposition": f'attachment; filename="{filename}"'})
@@ -1,39 +1,197 @@
-import time
-from typing import Dict, List, Optional
-from fastapi import APIRouter, Depends, UploadFile, File, Form
-from sqlalchemy.orm import Session
+import asyncio
+import io
+import logging
+import mimetypes
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from fastapi import APIRouter, BackgroundTasks, Depends, UploadFile, File, Form, HTTPException, Query, Header
+from fastapi.responses import Response, StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 import re
-import os
 
-from app.api.deps import get_db
+from app.api.deps import get_async_db
+from app.db.session import AsyncSessionLocal
 import app.db.models as models
+from app.core.config import settings
+from app.core.storage import get_storage, image_key
+from app.services.dedup_service import DedupService
+from app.services.derivative_service import get_derivative_service
+from app.services.export_service import ExportService
+from app.services.stats_service import StatsService
 
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter()
 
 
 @router.post("/upload_item/")
-async def upload_item(image: UploadFile = File(...), season: str = Form(...), db: Session = Depends(get_db)):
-    season_dir = os.path.join('C:/Users/jexia/projects/prada-id/app/images', season.replace(' ', '_'))
-    os.makedirs(season_dir, exist_ok=True)
+async def upload_item(
+    background_tasks: BackgroundTasks,
+    image: UploadFile = File(...),
+    season: str = Form(...),
+    db: AsyncSession = Depends(get_async_db)
+):
+    contents = await image.read()  # Read the image data from the UploadFile
+
+    dedup_service = DedupService(db)
+    try:
+        # Decoding is CPU-bound, keep it off the event loop
+        image_hash = await asyncio.to_thread(DedupService.hash_image, contents)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Error processing image: {str(e)}")
 
-    base_image_filename = f"{int(time.time())}.jpg"
-    image_path = os.path.join(season_dir, base_image_filename).replace("\\","/")
+    # Keys are content hashes and the write is idempotent, so store the blob before locking
+    image_path = await asyncio.to_thread(_save_image, contents)
+    db_item = models.Images(image_path=image_path, season=season)
 
-    # Check if the image path already exists and add a "_<num>" if it does
-    if os.path.exists(image_path):
-        num = 1
-        while os.path.exists(image_path):
-            image_filename = f"{base_image_filename.split('.')[0]}_{num}.jpg"
-            image_path = os.path.join(season_dir, image_filename).replace("\\","/")
-            num += 1
+    # Check the perceptual hash against every stored image with uploads serialized until the commit
+    async with DedupService.upload_lock:
+        await dedup_service.lock_uploads()
+        db.add(db_item)
+        await db.flush()
+        matches = await dedup_service.find(image_hash)
+        duplicate_of = await dedup_service.original_id(matches[0][1]) if matches else None
+        if duplicate_of is not None and settings.DUPLICATE_POLICY == "reject":
+            await db.rollback()
+            await _discard_image(db, image_path)
+            raise HTTPException(status_code=409, detail=f"Image is a duplicate of image {duplicate_of}")
 
-    # Save the uploaded image file
-    with open(image_path, "wb") as image_file:
-        image_file.write(await image.read())  # Read the image data from the UploadFile
+        db_item.phash = image_hash
+        db_item.duplicate_of = duplicate_of
+        await StatsService(db).record_upload(season)
+        await db.commit()
+    StatsService.invalidate()
+    await db.refresh(db_item)
+    await dedup_service.refresh()
+    # Thumbnail and preprocessed crop are written after the response is sent
+    background_tasks.add_task(_store_derivatives, db_item.id, contents)
+    return db_item
 
-    db_item = models.Images(image_path=image_path, season=season)
-    db.add(db_item)
-    db.commit()
-    db.refresh(db_item)
-    return db_item
\ No newline at end of file
+
+@router.get("/stats")
+async def get_data_stats(db: AsyncSession = Depends(get_async_db)) -> Dict:
+    """
+    Get statistics about the dataset, served from the per-season summary table.
+    """
+    return await StatsService(db).get_contribution_stats()
+
+
+@router.get("/seasons")
+async def get_seasons(db: AsyncSession = Depends(get_async_db)) -> List[str]:
+    """
+    Get all unique seasons in the dataset.
+    """
+    return await StatsService(db).get_all_seasons()
+
+
+@router.get("/images/{image_id}")
+async def get_image(image_id: int, range: Optional[str] = Header(None), db: AsyncSession = Depends(get_async_db)):
+    """
+    Stream a stored image, honouring a single HTTP Range request.
+    """
+    db_item = await db.get(models.Images, image_id)
+    if db_item is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    storage = get_storage()
+    try:
+        size = await asyncio.to_thread(storage.size, db_item.image_path)
+    except Exception:
+        raise HTTPException(status_code=404, detail="Image file not found in storage")
+
+    media_type = mimetypes.guess_type(db_item.image_path)[0] or "application/octet-stream"
+    headers = {"Accept-Ranges": "bytes", "Cache-Control": "public, max-age=86400"}
+    if range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(storage.read(db_item.image_path), media_type=media_type, headers=headers)
+
+    byte_range = _parse_range(range, size)
+    if byte_range is None:
+        raise HTTPException(status_code=416, detail="Requested range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    headers["Content-Length"] = str(end - start)
+    return StreamingResponse(storage.read(db_item.image_path, start, end), status_code=206, media_type=media_type, headers=headers)
+
+
+@router.get("/images/{image_id}/thumbnail")
+async def get_thumbnail(image_id: int):
+    """
+    Get the thumbnail generated when an image was uploaded, as JPEG.
+    """
+    thumbnail = await asyncio.to_thread(get_derivative_service().get_thumbnail, image_id)
+    if thumbnail is None:
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    buffer = io.BytesIO()
+    thumbnail.save(buffer, format="JPEG", quality=85)
+    return Response(buffer.getvalue(), media_type="image/jpeg", headers={"Cache-Control": "public, max-age=86400"})
+
+
+@router.get("/export")
+async def export_dataset(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    season: Optional[str] = Query(None, description="Only export this season"),
+    include_duplicates: bool = Query(False, description="Include images flagged as duplicates"),
+    after_id: int = Query(0, ge=0, description="Resume an interrupted export after this image id"),
+):
+    """
+    Stream (id, image_path, season) for the whole dataset as NDJSON or CSV.
+    """
+    media_type = "application/x-ndjson" if format == "ndjson" else "text/csv"
+    headers = {"Content-Disposition": f"attachment; filename=dataset.{format}"}
+    return StreamingResponse(
+        _export_chunks(format, season=season, include_duplicates=include_duplicates, after_id=after_id),
+        media_type=media_type,
+        headers=headers
+    )
+
+
+async def _export_chunks(format: str, **kwargs) -> AsyncIterator[str]:
+    # The session must live as long as the stream, not just the request handler
+    async with AsyncSessionLocal() as db:
+        export_service = ExportService(db)
+        chunks = export_service.iter_ndjson(**kwargs) if format == "ndjson" else export_service.iter_csv(**kwargs)
+        async for chunk in chunks:
+            yield chunk
+
+
+def _store_derivatives(image_id: int, contents: bytes) -> None:
+    # Derivatives only speed things up; training falls back to decoding the original
+    try:
+        get_derivative_service().add(image_id, contents)
+    except Exception as e:
+        logger.warning(f"Failed to generate derivatives for image {image_id}: {str(e)}")
+
+
+def _save_image(contents: bytes) -> str:
+    """Write an uploaded image to storage and return its key."""
+    storage = get_storage()
+    key = image_key(contents)
+    # Keys are content hashes, so an existing blob already holds these bytes
+    if not storage.exists(key):
+        storage.write_bytes(key, contents)
+    return key
+
+
+async def _discard_image(db: AsyncSession, key: str) -> None:
+    """Delete the blob of a rejected upload unless a stored image has the same bytes."""
+    if await db.scalar(select(models.Images.id).where(models.Images.image_path == key).limit(1)) is None:
+        await asyncio.to_thread(get_storage().delete, key)
+
+
+def _parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single "bytes=start-end" range into a [start, end) pair, or None if unsatisfiable."""
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes
+        start, end = max(0, size - int(last)), size
+    else:
+        start = int(first)
+        end = min(size, int(last) + 1) if last else size
+    if start >= end:
+        return None
+    return start, end
\ No newline at end of file
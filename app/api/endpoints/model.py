@@ -1,47 +1,490 @@
-from typing import Dict, List, Optional
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
 
-from fastapi import APIRouter, File, UploadFile, HTTPException, Depends, Form
+from fastapi import APIRouter, BackgroundTasks, File, UploadFile, HTTPException, Depends, Form, Query
+from fastapi.responses import StreamingResponse
 from PIL import Image
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+import asyncio
+import hashlib
 import io
+import itertools
+import json
+import logging
+import os
+import time
+import zipfile
 import numpy as np
 
-from app.ml.pipeline import PradaClassificationPipeline, create_default_pipeline
+from app.api.deps import get_async_db, require_admin
+from app.ml.classifiers import NearestNeighborClassifier
+from app.ml.compaction import CompactionState, compact_and_report, compacted_model_name, publish_checkpoint
+from app.ml.pipeline import (
+    PradaClassificationPipeline,
+    active_model_path,
+    create_default_pipeline,
+    load_knn_classifier,
+    read_active_model,
+    write_active_model
+)
+from app.core import profiling
+from app.core.cache import SingleFlight, TTLCache
 from app.core.config import settings
+from app.core.metrics import IN_FLIGHT, REQUESTS, stage_timer
+import app.db.models as models
 
-router = APIRouter()
+logger = logging.getLogger(__name__)
 
 # Initialize the pipeline 
 pipeline = create_default_pipeline()
 
+# Model switches are made in one worker and written to the active model file; the other
+# workers (python -m app.serve) compare its mtime on every request and follow it
+_active_model_mtime: Optional[int] = None
+_active_model_lock = asyncio.Lock()
+
+def _checkpoint_path(model_name: str) -> str:
+    return os.path.join(os.path.dirname(settings.KNN_CHECKPOINT_PATH), f"{model_name}.npz")
+
+def _active_model_changed() -> bool:
+    try:
+        return os.stat(active_model_path()).st_mtime_ns != _active_model_mtime
+    except FileNotFoundError:
+        return False
+
+def _load_active_model() -> None:
+    """Serve the checkpoint named in the active model file if it changed since this worker last looked."""
+    global _active_model_mtime
+    if not _active_model_changed():
+        return
+    _active_model_mtime = os.stat(active_model_path()).st_mtime_ns
+    model_name = read_active_model()
+    if model_name is None or model_name == pipeline.version:
+        return
+    try:
+        classifier = load_knn_classifier(_checkpoint_path(model_name))
+    except Exception as e:
+        logger.error(f"Could not load active model {model_name}, still serving {pipeline.version}: {str(e)}")
+        return
+    pipeline.swap_classifier(classifier, model_name)
+    classify_cache.invalidate()
+    logger.info(f"Following the active model file to {model_name}")
+
+async def sync_active_model() -> None:
+    if _active_model_changed():
+        async with _active_model_lock:
+            await asyncio.to_thread(_load_active_model)
+
+router = APIRouter(dependencies=[Depends(sync_active_model)])
+
+# Results for identical image bytes, keyed by content hash and the model that produced them
+classify_cache = TTLCache("classify", ttl=settings.CLASSIFY_CACHE_TTL, max_items=settings.CLASSIFY_CACHE_SIZE)
+classify_flight = SingleFlight("classify")
+
+# A switch made before a restart still applies; loaded before forking when preloaded
+_load_active_model()
+
+# Guard and status of the background index compaction, shared by all workers
+compaction_state = CompactionState(os.path.dirname(settings.KNN_CHECKPOINT_PATH))
+_compaction_schedule: Optional[asyncio.Task] = None
+
 @router.post("/switch_models/", response_model=Dict)
 async def switch_model(model_name: str = Form(...)):
-    # Hard code a model dictionary
-    # I want to keep track of the path to the weights, as well as the types of preprocessing and 
-    # feature extraction that I need to use for prediction
-    pass
-    # TODO
+    """
+    Serve predictions from another kNN checkpoint (<model_name>.npz next to the default one).
+    Preprocessing and feature extraction are unchanged, so the checkpoint must hold embeddings made by them.
+    Every worker follows the switch from its next request on, and it persists across restarts.
+    """
+    checkpoint_path = _checkpoint_path(model_name)
+    if os.path.basename(model_name) != model_name or not os.path.isfile(checkpoint_path):
+        raise HTTPException(status_code=404, detail=f"Model {model_name} not found")
+    
+    classifier = await asyncio.to_thread(load_knn_classifier, checkpoint_path)
+    current = getattr(pipeline.classifier, "features", None)
+    if current is not None and classifier.features.shape[1] != current.shape[1]:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Model {model_name} has {classifier.features.shape[1]}-dimensional embeddings, expected {current.shape[1]}"
+        )
+    
+    previous_version = pipeline.version
+    _serve_everywhere(classifier, model_name)
+    logger.info(f"Switched model from {previous_version} to {model_name}")
+    return {"model_version": pipeline.version, "previous_version": previous_version, "n_items": len(classifier.features)}
+
+@router.post("/compact/", status_code=202, response_model=Dict, dependencies=[Depends(require_admin)])
+async def compact_index(background_tasks: BackgroundTasks):
+    """
+    Compact the kNN index in the background, publish it as a new checkpoint and serve it.
+    The uncompacted checkpoint is kept, so switch_models can go back to it.
+    GET /compact/ reports index size, query latency and accuracy before and after.
+    Needs the X-Admin-Token header; COMPACTION_INTERVAL_HOURS also runs it on a schedule.
+    """
+    if not isinstance(pipeline.classifier, NearestNeighborClassifier):
+        raise HTTPException(status_code=400, detail="Only a nearest neighbor index can be compacted")
+    if not compaction_state.try_start(pipeline.version):
+        raise HTTPException(status_code=409, detail="A compaction is already running")
+    
+    background_tasks.add_task(_compact_index)
+    return {"status": "scheduled", "model_version": pipeline.version}
+
+@router.get("/compact/", response_model=Dict, dependencies=[Depends(require_admin)])
+async def get_compaction_status():
+    """
+    Whether a compaction is running in any worker, and the report of the last one.
+    """
+    return compaction_state.read()
 
 @router.post("/classify/", response_model=Dict)
-async def classify_image(image: UploadFile = File(...)):
+async def classify_image(
+    image: UploadFile = File(...),
+    timings: bool = Query(False, description="Include a per-stage timing breakdown in milliseconds"),
+    tta: Optional[bool] = Query(None, description="Turn test-time augmentation on or off; the server default applies if omitted"),
+    regions: bool = Query(False, description="Also classify each garment region separately, for photos of a whole outfit")
+):
     """
     Classify a Prada clothing image and return the predicted season.
+    Identical images are computed once: concurrent requests share the running prediction
+    and later ones are served from a cache until the model changes.
     """
-    try:
-        # Read and validate the image
-        contents = await image.read()
-        image = Image.open(io.BytesIO(contents))
+    with IN_FLIGHT.track_inprogress(endpoint="classify"):
+        try:
+            contents = await image.read()
+            # Omitting tta and passing the server default give the same result, so cache them together
+            tta = tta if tta is not None else pipeline.tta is not None
+            key = (hashlib.sha256(contents).hexdigest(), pipeline.version, pipeline.revision, tta, regions)
+            cached = classify_cache.get(key) if settings.CLASSIFY_CACHE_TTL > 0 else None
+            if cached is not None:
+                result, stage_timings, cache_status = cached, {}, "hit"
+            else:
+                (result, stage_timings), shared = await classify_flight.do(key, lambda: _classify(key, contents, tta, regions))
+                cache_status = "coalesced" if shared else "miss"
+        except Exception as e:
+            REQUESTS.inc(endpoint="classify", status="error")
+            raise HTTPException(
+                status_code=400,
+                detail=f"Error processing image: {str(e)}"
+            )
+    
+    REQUESTS.inc(endpoint="classify", status="ok")
+    # Cached results are shared between requests, so only ever add to a copy
+    result = dict(result)
+    if timings:
+        result["timings"] = {stage: seconds * 1000 for stage, seconds in stage_timings.items()}
+        result["timings"]["total"] = sum(result["timings"].values())
+        result["model_version"] = pipeline.version
+        result["cache"] = cache_status
+    return result
+
+@router.post("/classify_batch/")
+async def classify_batch(images: List[UploadFile] = File(...)):
+    """
+    Classify many images, or zip archives of images, in one request.
+    Streams one NDJSON line per image as soon as its batch finishes, then a summary line.
+    """
+    items = []
+    for upload in images:
+        # Uploads are spooled to disk; check sizes before reading one into memory
+        if upload.size is not None and upload.size > settings.CLASSIFY_BATCH_MAX_UPLOAD_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"{upload.filename} is larger than {settings.CLASSIFY_BATCH_MAX_UPLOAD_BYTES} bytes"
+            )
+        is_zip = await upload.read(4) == b"PK\x03\x04"
+        await upload.seek(0)
+        if not is_zip and upload.size is not None and upload.size > settings.CLASSIFY_BATCH_MAX_ITEM_BYTES:
+            items.append((upload.filename, _too_large))
+            continue
         
-        # Make prediction
-        result = pipeline.predict(image)
-        # print(result)
+        contents = await upload.read()
+        if is_zip and zipfile.is_zipfile(io.BytesIO(contents)):
+            items.extend(_zip_items(upload.filename, contents))
+        else:
+            items.append((upload.filename, _bytes_loader(contents)))
+        if len(items) > settings.CLASSIFY_BATCH_MAX_ITEMS:
+            raise HTTPException(
+                status_code=413,
+                detail=f"At most {settings.CLASSIFY_BATCH_MAX_ITEMS} images can be classified per request"
+            )
+    
+    return StreamingResponse(_classify_stream(items), media_type="application/x-ndjson")
+
+@router.get("/similar/{image_id}", response_model=Dict)
+async def similar_to_item(
+    image_id: int,
+    k: int = Query(10, ge=1, le=50),
+    offset: int = Query(0, ge=0),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Return the catalogue items most similar to a stored image, reusing its stored embedding.
+    """
+    _check_page(k, offset)
+    # Rows are only meaningful within one model, so keep using it if another is swapped in
+    classifier = pipeline.classifier
+    row = classifier.row_for_id(image_id)
+    if row is None:
+        raise HTTPException(status_code=404, detail=f"Image {image_id} is not in the index")
 
-        return result
+    items = await asyncio.to_thread(
+        pipeline.similar, classifier.features[row], k=k, offset=offset, exclude_row=row, classifier=classifier
+    )
+    return await _similar_response(items, k, offset, db)
+
+@router.post("/similar/", response_model=Dict)
+async def similar_to_image(
+    image: UploadFile = File(...),
+    k: int = Form(10, ge=1, le=50),
+    offset: int = Form(0, ge=0),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Return the catalogue items most similar to an uploaded image.
+    """
+    _check_page(k, offset)
+    try:
+        contents = await image.read()
+        # The forward pass and the kNN query are CPU-bound, keep them off the event loop
+        features = await asyncio.to_thread(lambda: pipeline.embed(Image.open(io.BytesIO(contents))))
     except Exception as e:
         raise HTTPException(
             status_code=400,
             detail=f"Error processing image: {str(e)}"
         )
 
+    items = await asyncio.to_thread(pipeline.similar, features, k=k, offset=offset)
+    return await _similar_response(items, k, offset, db)
+
+def _serve_everywhere(classifier: NearestNeighborClassifier, model_name: str) -> None:
+    """Swap in a loaded checkpoint here and point the other workers at it."""
+    global _active_model_mtime
+    write_active_model(model_name)
+    _active_model_mtime = os.stat(active_model_path()).st_mtime_ns
+    pipeline.swap_classifier(classifier, model_name)
+    # Keys already include the model revision; this just frees the stale entries
+    classify_cache.invalidate()
+
+async def _compact_index() -> None:
+    """Run a compaction started with compaction_state.try_start() and record its report."""
+    classifier, version, revision = pipeline.classifier, pipeline.version, pipeline.revision
+    try:
+        compacted, report = await asyncio.to_thread(
+            compact_and_report,
+            classifier,
+            merge_fraction=settings.COMPACTION_MERGE_FRACTION,
+            condense_rows=settings.COMPACTION_CONDENSE,
+            min_agreement=settings.COMPACTION_MIN_AGREEMENT
+        )
+        model_name = compacted_model_name(version)
+        await asyncio.to_thread(publish_checkpoint, compacted, _checkpoint_path(model_name))
+        report["model_version"] = model_name
+        # Switching away from a model that was updated or switched meanwhile would lose those changes
+        report["served"] = pipeline.revision == revision
+        if report["served"]:
+            _serve_everywhere(compacted, model_name)
+            logger.info(f"Compacted {version} from {report['original_rows']} to {report['published_rows']} rows as {model_name}")
+        else:
+            logger.warning(f"Model {version} changed during compaction; {model_name} was published but not served")
+    except Exception as e:
+        logger.exception("Index compaction failed")
+        report = {"error": str(e)}
+    compaction_state.finish(report)
+
+def _compaction_due(interval: float, since: float) -> bool:
+    """Whether the scheduled compaction should run: the interval has passed and the index grew since the last one."""
+    status = compaction_state.read()
+    if status["running"] or time.time() - (status.get("finished_at") or since) < interval:
+        return False
+    report = status.get("report") or {}
+    return not (report.get("model_version") == pipeline.version
+                and report.get("published_rows") == len(pipeline.classifier.features))
+
+async def compaction_schedule() -> None:
+    """Compact the served index every COMPACTION_INTERVAL_HOURS; the first worker to find it due runs it."""
+    interval = settings.COMPACTION_INTERVAL_HOURS * 3600
+    started = time.time()
+    while True:
+        await asyncio.sleep(min(interval, 300))
+        try:
+            await sync_active_model()
+            if not isinstance(pipeline.classifier, NearestNeighborClassifier) or not _compaction_due(interval, started):
+                continue
+            if compaction_state.try_start(pipeline.version):
+                logger.info(f"Starting scheduled compaction of {pipeline.version}")
+                await _compact_index()
+        except Exception:
+            logger.exception("Scheduled compaction check failed")
+
+def start_compaction_schedule() -> None:
+    global _compaction_schedule
+    if settings.COMPACTION_INTERVAL_HOURS > 0 and _compaction_schedule is None:
+        _compaction_schedule = asyncio.create_task(compaction_schedule())
+
+async def _classify(key: Tuple, contents: bytes, tta: bool, regions: bool) -> Tuple[Dict, Dict[str, float]]:
+    """Decode and predict off the event loop, then cache the result for later identical requests."""
+    def run() -> Tuple[Dict, Dict[str, float]]:
+        stage_timings = {}
+        with profiling.track():
+            with stage_timer("decode", pipeline.version, stage_timings):
+                image = Image.open(io.BytesIO(contents))
+                image.load()
+            if regions:
+                result = pipeline.predict_regions(
+                    image, settings.CLASSIFY_MAX_REGIONS, settings.REGION_MIN_AREA, timings=stage_timings
+                )
+            else:
+                result = pipeline.predict(image, timings=stage_timings, tta=tta)
+        return result, stage_timings
+    
+    result, stage_timings = await asyncio.to_thread(run)
+    if settings.CLASSIFY_CACHE_TTL > 0:
+        classify_cache.set(key, result)
+    return result, stage_timings
+
+def _too_large() -> bytes:
+    raise ValueError("Image is too large")
+
+def _bytes_loader(contents: bytes) -> Callable[[], bytes]:
+    def load() -> bytes:
+        if len(contents) > settings.CLASSIFY_BATCH_MAX_ITEM_BYTES:
+            _too_large()
+        return contents
+    return load
+
+def _zip_items(filename: str, contents: bytes) -> List[Tuple[str, Callable[[], bytes]]]:
+    # Members are read lazily by the decode workers, so only a few are in memory at once
+    archive = zipfile.ZipFile(io.BytesIO(contents))
+    items = []
+    for member in archive.infolist():
+        basename = os.path.basename(member.filename)
+        if member.is_dir() or member.filename.startswith("__MACOSX/") or basename.startswith("."):
+            continue
+
+        def load(member: zipfile.ZipInfo = member) -> bytes:
+            if member.file_size > settings.CLASSIFY_BATCH_MAX_ITEM_BYTES:
+                _too_large()
+            return archive.read(member)
+        items.append((f"{filename}/{member.filename}", load))
+    return items
+
+def _decode(load: Callable[[], bytes]) -> Image.Image:
+    image = Image.open(io.BytesIO(load()))
+    image.load()
+    return image
+
+def _predict_batch(batch: List[Tuple[int, str, Image.Image]]) -> List[Dict[str, Any]]:
+    images = [image for _, _, image in batch]
+    try:
+        with profiling.track():
+            return pipeline.predict_batch(images)
+    except Exception as e:
+        logger.warning(f"Batch prediction failed, retrying images one at a time: {str(e)}")
+        # Find the offending images by predicting one at a time
+        results = []
+        for image in images:
+            try:
+                results.append(pipeline.predict(image, tta=False))
+            except Exception as e:
+                results.append({"error": f"Error processing image: {str(e)}"})
+        return results
+
+def _ndjson(item: Dict[str, Any]) -> str:
+    return json.dumps(item, default=lambda value: value.item() if isinstance(value, np.generic) else str(value)) + "\n"
+
+async def _classify_stream(items: List[Tuple[str, Callable[[], bytes]]]) -> AsyncIterator[str]:
+    semaphore = asyncio.Semaphore(settings.CLASSIFY_DECODE_CONCURRENCY)
+    
+    async def decode(index: int, filename: str, load: Callable[[], bytes]):
+        async with semaphore:
+            try:
+                return index, filename, await asyncio.to_thread(_decode, load), None
+            except Exception as e:
+                return index, filename, None, e
+    
+    # Decoding carries on in the background while earlier batches are classified, but only a
+    # couple of batches ahead, so decoded images cannot pile up while a slow batch runs
+    pending = set()
+    queued = enumerate(items)
+    max_in_flight = settings.CLASSIFY_BATCH_SIZE * 2
+    
+    def start_decoding() -> None:
+        for index, (filename, load) in itertools.islice(queued, max_in_flight - len(pending)):
+            pending.add(asyncio.create_task(decode(index, filename, load)))
+    
+    counts = {"ok": 0, "error": 0}
+    
+    async def flush(batch: List[Tuple[int, str, Image.Image]]) -> List[str]:
+        lines = []
+        for (index, filename, _), result in zip(batch, await asyncio.to_thread(_predict_batch, batch)):
+            status = "error" if "error" in result else "ok"
+            counts[status] += 1
+            REQUESTS.inc(endpoint="classify_batch", status=status)
+            lines.append(_ndjson({"index": index, "filename": filename, **result}))
+        return lines
+    
+    with IN_FLIGHT.track_inprogress(endpoint="classify_batch"):
+        try:
+            batch = []
+            start_decoding()
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=lambda task: task.result()[0]):
+                    index, filename, image, error = task.result()
+                    if error is not None:
+                        counts["error"] += 1
+                        REQUESTS.inc(endpoint="classify_batch", status="error")
+                        yield _ndjson({"index": index, "filename": filename, "error": f"Error reading image: {str(error)}"})
+                        continue
+                    
+                    batch.append((index, filename, image))
+                    if len(batch) >= settings.CLASSIFY_BATCH_SIZE:
+                        for line in await flush(batch):
+                            yield line
+                        batch = []
+                start_decoding()
+            
+            if batch:
+                for line in await flush(batch):
+                    yield line
+        finally:
+            # The client may disconnect mid-stream
+            for task in pending:
+                task.cancel()
+    
+    yield _ndjson({"done": True, "count": len(items), **counts, "model_version": pipeline.version})
+
+def _check_page(k: int, offset: int) -> None:
+    if offset + k > settings.SIMILAR_MAX_RESULTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Results are limited to the top {settings.SIMILAR_MAX_RESULTS} items"
+        )
+
+async def _similar_response(items: List[Dict], k: int, offset: int, db: AsyncSession) -> Dict:
+    # Look up all catalogue rows for the page in one query
+    image_ids = [item["image_id"] for item in items if item["image_id"] is not None]
+    rows = (await db.scalars(select(models.Images).where(models.Images.id.in_(image_ids)))).all() if image_ids else []
+    images = {row.id: row for row in rows}
+
+    results = []
+    for rank, item in enumerate(items, start=offset):
+        db_item = images.get(item["image_id"])
+        results.append({
+            "rank": rank,
+            "image_id": item["image_id"],
+            "image_path": db_item.image_path if db_item else None,
+            "image_url": f"{settings.API_V1_STR}/data_operations/images/{db_item.id}" if db_item else None,
+            "season": db_item.season if db_item else item["season"],
+            "distance": item["distance"]
+        })
+
+    has_more = len(items) == k and offset + k < settings.SIMILAR_MAX_RESULTS
+    return {
+        "items": results,
+        "offset": offset,
+        "next_offset": offset + k if has_more else None
+    }
+
 @router.post("/train/", response_model=Dict)
 async def train_model():
     pass
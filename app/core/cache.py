@@ -0,0 +1,80 @@
+"""
+Small in-process caches shared by the API.
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from app.core.metrics import CACHE_REQUESTS
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after ttl seconds."""
+
+    def __init__(self, name: str, ttl: float, max_items: int = 1024):
+        self.name = name  # reported as the cache label on metrics
+        self.ttl = ttl
+        self.max_items = max_items
+        self._items: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the cached value, or None if it is missing or expired."""
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[0] > time.monotonic():
+                self._items.move_to_end(key)
+                CACHE_REQUESTS.inc(cache=self.name, result="hit")
+                return item[1]
+            if item is not None:
+                del self._items[key]
+        CACHE_REQUESTS.inc(cache=self.name, result="miss")
+        return None
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def invalidate(self, key: Optional[Hashable] = None) -> None:
+        """Drop one key, or everything if no key is given."""
+        with self._lock:
+            if key is None:
+                self._items.clear()
+            else:
+                self._items.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class SingleFlight:
+    """Let concurrent callers with the same key share one in-progress computation.
+
+    Only calls that overlap are merged; once the computation finishes the key is
+    forgotten, so results must be cached separately if they should outlive it.
+    """
+
+    def __init__(self, name: str):
+        self.name = name  # reported as the cache label on metrics
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Await fn() or the identical call already running; returns (result, shared)."""
+        task = self._calls.get(key)
+        shared = task is not None
+        if shared:
+            CACHE_REQUESTS.inc(cache=self.name, result="coalesced")
+        else:
+            # Run as its own task so a caller disconnecting does not cancel the others' result
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(task), shared
+
+    def __len__(self) -> int:
+        return len(self._calls)
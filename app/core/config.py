@@ -1,4 +1,5 @@
-from typing import Optional
+import os
+from typing import List, Optional
 
 from pydantic_settings import BaseSettings
 
@@ -11,6 +12,11 @@ class Settings(BaseSettings):
     # # Security
     # SECRET_KEY: str
     # ACCESS_TOKEN_EXPIRE_MINUTES: int = 60 * 24 * 8  # 8 days
+    ADMIN_TOKEN: Optional[str] = None  # X-Admin-Token for /admin endpoints; they are disabled while unset
+    
+    # Profiling (POST /admin/profile, or python -m app.core.profiling offline)
+    PROFILING_ENABLED: bool = False
+    PROFILE_MAX_SECONDS: float = 120
     
     # Database
     POSTGRES_SERVER: str = "localhost:5433"
@@ -18,17 +24,87 @@ class Settings(BaseSettings):
     POSTGRES_PASSWORD: str = "testpass123"
     POSTGRES_DB: str = "Images"
     SQLALCHEMY_DATABASE_URI: Optional[str] = None
+    SQLALCHEMY_ASYNC_DATABASE_URI: Optional[str] = None  # derived from SQLALCHEMY_DATABASE_URI if unset
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: int = 30  # seconds to wait for a free connection
+    DB_POOL_RECYCLE: int = 1800  # seconds before a connection is replaced
+    DB_POOL_PRE_PING: bool = True
+    
+    STATS_CACHE_TTL: int = 60  # seconds the stats/seasons endpoints serve cached counts
+    CLASSIFY_CACHE_TTL: int = 300  # seconds /classify serves a cached result for identical image bytes; 0 disables
+    CLASSIFY_CACHE_SIZE: int = 2048
+    
+    # Storage
+    STORAGE_BACKEND: str = "local"  # "local" (sharded directories under IMAGES_DIR) or "s3"
+    IMAGES_DIR: str = "app/images"  # relative to the working directory, like KNN_CHECKPOINT_PATH
+    S3_BUCKET: Optional[str] = None
+    S3_ENDPOINT_URL: Optional[str] = None  # e.g. http://localhost:9000 for MinIO
+    AWS_ACCESS_KEY_ID: Optional[str] = None
+    AWS_SECRET_ACCESS_KEY: Optional[str] = None
+    AWS_REGION: str = "us-east-1"
+    
+    # Derivatives generated at ingest time
+    DERIVATIVES_DIR: Optional[str] = None  # defaults to IMAGES_DIR/derivatives
+    THUMBNAIL_SIZE: int = 256
+    DERIVATIVE_CROPS: bool = True  # also store the preprocessed crop the feature extractor sees
+    DERIVATIVE_CHUNK_ITEMS: int = 1024  # items per packed chunk file
+    
+    # ML Model
+    KNN_CHECKPOINT_PATH: str = "app/ml/ckpts/features_labels.npz"
+    RESNET_PRETRAINED: bool = True  # False skips the ImageNet weight download (offline benchmarks)
+    SIMILAR_MAX_RESULTS: int = 200  # deepest rank the /similar endpoint will page to
+    EMBEDDING_CACHE_DIR: str = ".cache/embeddings"  # used by python -m app.ml.evaluation
+    
+    # Index compaction (POST /models/compact/, every COMPACTION_INTERVAL_HOURS, or python -m app.ml.compaction)
+    COMPACTION_INTERVAL_HOURS: float = 0  # 0 only compacts on request; otherwise when due and the index has grown
+    COMPACTION_MERGE_FRACTION: float = 0.05  # near-duplicate radius, as a fraction of the median distance between rows
+    COMPACTION_CONDENSE: bool = True  # also drop rows the kept rows already classify unanimously
+    COMPACTION_MIN_AGREEMENT: float = 1.0
+    
+    # Calibration (fit with python -m app.ml.calibration)
+    CALIBRATION_PATH: Optional[str] = None  # defaults to <KNN checkpoint>.calibration.json, used if it exists
+    ABSTAIN_THRESHOLD: Optional[float] = None  # overrides the threshold saved with the calibration
+    
+    # Test-time augmentation
+    TTA_ENABLED: bool = False  # requests can still opt in or out with ?tta=
+    TTA_FLIPS: bool = True
+    TTA_CROPS: int = 1  # 1 (centre) or 5 (centre and corners)
+    TTA_SCALES: List[float] = [1.0]
+    TTA_AGGREGATION: str = "mean"  # "mean" of embeddings or "vote" over per-view predictions
+    TTA_MAX_VIEWS: int = 0  # 0 for no limit
+    TTA_LATENCY_BUDGET_MS: float = 0  # cap views by measured extraction time per view; 0 for no budget
+    
+    # Region classification (/classify?regions=true)
+    CLASSIFY_MAX_REGIONS: int = 4  # garment regions embedded per image, besides the whole image
+    REGION_MIN_AREA: float = 0.02  # fraction of the image a foreground component needs to count as a region
+    
+    # Batch classification
+    CLASSIFY_BATCH_SIZE: int = 16  # images per forward pass
+    CLASSIFY_BATCH_MAX_ITEMS: int = 200  # images per request, counting zip members
+    CLASSIFY_BATCH_MAX_ITEM_BYTES: int = 20 * 1024 * 1024
+    CLASSIFY_BATCH_MAX_UPLOAD_BYTES: int = 200 * 1024 * 1024  # per uploaded file, e.g. a zip archive of images
+    CLASSIFY_DECODE_CONCURRENCY: int = 8
+    
+    # Serving (python -m app.serve)
+    SERVE_WORKERS: int = 2
+    SERVE_THREADS_PER_WORKER: int = 0  # 0 splits the CPU cores evenly between workers
+    METRICS_DIR: Optional[str] = None  # workers' metric snapshots, merged on /metrics; a temporary directory if unset
+    
+    # Duplicate detection
+    DUPLICATE_HASH_DISTANCE: int = 4  # max Hamming distance between perceptual hashes of near-duplicates
+    DUPLICATE_POLICY: str = "flag"  # "flag" stores duplicates with duplicate_of set, "reject" refuses them
+    
+    # Segmentation
+    SEGMENTATION_BACKEND: str = "threshold"  # threshold, contour, grabcut, torch or onnx
+    SEGMENTATION_MODEL_PATH: Optional[str] = None
+    MASK_CACHE_BYTES: int = 64 * 1024 * 1024  # in-memory masks per worker, stored at one bit per pixel
+    MASK_CACHE_DIR: Optional[str] = None
     
     # # Redis
     # REDIS_HOST: str = "localhost"
     # REDIS_PORT: int = 5433
     
-    # # AWS
-    # AWS_ACCESS_KEY_ID: Optional[str] = None
-    # AWS_SECRET_ACCESS_KEY: Optional[str] = None
-    # AWS_REGION: str = "us-east-1"
-    # S3_BUCKET: Optional[str] = None
-    
     # # ML Model
     # MODEL_PATH: str = "models/prada_classifier.pt"
     
@@ -43,6 +119,16 @@ class Settings(BaseSettings):
                 f"postgresql://{self.POSTGRES_USER}:{self.POSTGRES_PASSWORD}"
                 f"@{self.POSTGRES_SERVER}/{self.POSTGRES_DB}"
             )
+        if not self.SQLALCHEMY_ASYNC_DATABASE_URI:
+            # Same database through an async driver: asyncpg for Postgres, aiosqlite locally
+            scheme, rest = self.SQLALCHEMY_DATABASE_URI.split("://", 1)
+            if scheme.startswith("sqlite"):
+                scheme = "sqlite+aiosqlite"
+            elif scheme.startswith("postgresql"):
+                scheme = "postgresql+asyncpg"
+            self.SQLALCHEMY_ASYNC_DATABASE_URI = f"{scheme}://{rest}"
+        if not self.DERIVATIVES_DIR:
+            self.DERIVATIVES_DIR = os.path.join(self.IMAGES_DIR, "derivatives")
 
 
 settings = Settings() 
\ No newline at end of file
@@ -0,0 +1,272 @@
+"""
+Minimal in-process metrics rendered in the Prometheus text exposition format.
+
+Under python -m app.serve every worker also writes a snapshot of its metrics to a shared
+directory about once a second, and /metrics adds up the snapshots of the other workers,
+so any worker reports totals for the whole server (like prometheus_client's multiprocess mode).
+"""
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+
+# Seconds between a worker's snapshots, so totals from other workers lag by up to this much
+SNAPSHOT_INTERVAL = 1.0
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """Base class for a metric family with optional labels."""
+
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def snapshot(self) -> Dict[Tuple[str, ...], Any]:
+        """Copy of the value of every label set."""
+        raise NotImplementedError
+
+    @staticmethod
+    def combine(a: Any, b: Any) -> Any:
+        """Add up the values of one label set from two workers."""
+        raise NotImplementedError
+
+    def samples(self, values: Optional[Dict[Tuple[str, ...], Any]] = None) -> List[str]:
+        raise NotImplementedError
+
+    def render(self, values: Optional[Dict[Tuple[str, ...], Any]] = None) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self.samples(values))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    type_name = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def snapshot(self) -> Dict[Tuple[str, ...], float]:
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def combine(a: float, b: float) -> float:
+        return a + b
+
+    def samples(self, values: Optional[Dict[Tuple[str, ...], float]] = None) -> List[str]:
+        values = self.snapshot() if values is None else values
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in values.items()]
+
+
+class Gauge(Counter):
+    """A value that can go up and down."""
+
+    type_name = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track_inprogress(self, **labels: str) -> Iterator[None]:
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    """Counts observations into cumulative buckets."""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [bucket counts..., +Inf count], sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    def snapshot(self) -> Dict[Tuple[str, ...], Tuple[List[int], float]]:
+        with self._lock:
+            return {key: (list(counts), total[0]) for key, (counts, total) in self._values.items()}
+
+    @staticmethod
+    def combine(a: Tuple[List[int], float], b: Tuple[List[int], float]) -> Tuple[List[int], float]:
+        return [x + y for x, y in zip(a[0], b[0])], a[1] + b[1]
+
+    def samples(self, values: Optional[Dict[Tuple[str, ...], Tuple[List[int], float]]] = None) -> List[str]:
+        values = self.snapshot() if values is None else values
+
+        lines = []
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Collection of metrics rendered together on /metrics."""
+
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self.directory: Optional[str] = None
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def share(self, directory: str) -> None:
+        """Write this worker's snapshots to a directory shared with the other workers and report their totals.
+
+        Call in each worker after forking; values recorded before then belong to the parent and are dropped.
+        """
+        for metric in self.metrics:
+            with metric._lock:
+                metric._values.clear()
+        self.directory = directory
+        threading.Thread(target=self._write_snapshots, name="metrics-snapshot", daemon=True).start()
+
+    def _write_snapshots(self) -> None:
+        while True:
+            time.sleep(SNAPSHOT_INTERVAL)
+            self.write_snapshot()
+
+    def write_snapshot(self) -> None:
+        state = {
+            metric.name: [[list(key), value] for key, value in metric.snapshot().items()]
+            for metric in self.metrics
+        }
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(path + ".tmp", path)
+
+    def _other_workers(self) -> Iterator[Tuple[bool, Dict[str, Any]]]:
+        """(alive, state) for the snapshots of every other worker, including ones that have exited."""
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            pid = int(os.path.basename(path)[:-len(".json")])
+            if pid == os.getpid():
+                continue
+            try:
+                with open(path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                continue
+            try:
+                os.kill(pid, 0)
+                alive = True
+            except ProcessLookupError:
+                alive = False
+            except PermissionError:
+                alive = True
+            yield alive, state
+
+    def render(self) -> str:
+        if self.directory is None:
+            return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+        merged = {metric.name: metric.snapshot() for metric in self.metrics}
+        for alive, state in self._other_workers():
+            for metric in self.metrics:
+                # Counts of exited workers still belong in the totals; what was in progress there does not
+                if isinstance(metric, Gauge) and not alive:
+                    continue
+                values = merged[metric.name]
+                for key, value in state.get(metric.name, []):
+                    key = tuple(key)
+                    values[key] = metric.combine(values[key], value) if key in values else value
+        return "\n".join(metric.render(merged[metric.name]) for metric in self.metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "prada_stage_duration_seconds",
+    "Time spent in each stage of the classification pipeline.",
+    ["stage", "model_version"]
+))
+BATCH_SIZE = REGISTRY.register(Histogram(
+    "prada_batch_size",
+    "Number of images processed together by a pipeline stage.",
+    ["stage"],
+    buckets=SIZE_BUCKETS
+))
+IN_FLIGHT = REGISTRY.register(Gauge(
+    "prada_inflight_requests",
+    "Requests currently queued or being processed.",
+    ["endpoint"]
+))
+CACHE_REQUESTS = REGISTRY.register(Counter(
+    "prada_cache_requests_total",
+    "Cache lookups by cache and result (hit, miss, or coalesced onto a running call).",
+    ["cache", "result"]
+))
+REQUESTS = REGISTRY.register(Counter(
+    "prada_requests_total",
+    "Handled requests by endpoint and status.",
+    ["endpoint", "status"]
+))
+
+
+@contextmanager
+def stage_timer(stage: str, model_version: str = "", timings: Optional[Dict[str, float]] = None) -> Iterator[None]:
+    """Time a pipeline stage into STAGE_SECONDS and, if given, a per-request timings dict."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage, model_version=model_version)
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
@@ -0,0 +1,154 @@
+"""
+Fixed-shape uint8 arrays packed into memory-mapped chunk files with an append-only index.
+"""
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: only threads within one process are serialised
+    fcntl = None
+
+
+# One record per stored item; (height, width) is the size of the content inside the padded slot
+INDEX_DTYPE = np.dtype([
+    ("key", "<i8"),
+    ("chunk", "<i4"),
+    ("slot", "<i4"),
+    ("height", "<i4"),
+    ("width", "<i4"),
+])
+
+
+class PackedArrayStore:
+    """Store uint8 arrays of one shape, keyed by integer ids.
+
+    Items are written to slot-aligned positions in chunk_00000.u8, chunk_00001.u8, ...
+    so a batch of items is read straight out of a memmap instead of being decoded.
+    index.bin holds one INDEX_DTYPE record per write; the last record for a key wins.
+    """
+
+    def __init__(self, root: str, item_shape: Tuple[int, ...], chunk_items: int = 1024):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.item_shape = tuple(item_shape)
+        self.item_bytes = int(np.prod(self.item_shape))
+        self.chunk_items = chunk_items
+        self.index_path = os.path.join(root, "index.bin")
+
+        self._lock = threading.Lock()
+        self._records = np.empty(0, dtype=INDEX_DTYPE)
+        self._rows: Dict[int, int] = {}
+        self._maps: Dict[int, np.memmap] = {}
+        self.refresh()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, key: int) -> bool:
+        return int(key) in self._rows
+
+    def _chunk_path(self, chunk: int) -> str:
+        return os.path.join(self.root, f"chunk_{chunk:05d}.u8")
+
+    @contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        # Uploads may be handled by several worker processes sharing the same store
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.root, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def refresh(self) -> None:
+        """Load index records appended since the last refresh, e.g. by another process."""
+        try:
+            size = os.path.getsize(self.index_path)
+        except FileNotFoundError:
+            return
+        loaded = len(self._records) * INDEX_DTYPE.itemsize
+        size -= size % INDEX_DTYPE.itemsize  # ignore a record torn by a crash mid-write
+        if size <= loaded:
+            return
+
+        with open(self.index_path, "rb") as f:
+            f.seek(loaded)
+            new_records = np.frombuffer(f.read(size - loaded), dtype=INDEX_DTYPE)
+        start = len(self._records)
+        self._records = np.concatenate([self._records, new_records])
+        self._rows.update(zip(new_records["key"].tolist(), range(start, len(self._records))))
+
+    def put(self, key: int, array: np.ndarray, height: Optional[int] = None, width: Optional[int] = None) -> None:
+        """Store an array under key. height and width default to the full item shape."""
+        if array.shape != self.item_shape or array.dtype != np.uint8:
+            raise ValueError(f"Expected a uint8 array of shape {self.item_shape}, got {array.dtype} {array.shape}")
+        height = self.item_shape[0] if height is None else height
+        width = self.item_shape[1] if width is None else width
+
+        with self._lock, self._file_lock():
+            self.refresh()
+            chunk, slot = divmod(len(self._records), self.chunk_items)
+
+            # The data goes in before its index record, so readers never see an unwritten slot
+            chunk_path = self._chunk_path(chunk)
+            with open(chunk_path, "r+b" if os.path.exists(chunk_path) else "wb") as f:
+                f.seek(slot * self.item_bytes)
+                f.write(np.ascontiguousarray(array).tobytes())
+
+            record = np.array([(key, chunk, slot, height, width)], dtype=INDEX_DTYPE)
+            with open(self.index_path, "ab") as f:
+                torn = f.tell() % INDEX_DTYPE.itemsize
+                if torn:
+                    f.truncate(f.tell() - torn)
+                f.write(record.tobytes())
+            self.refresh()
+
+    def _chunk_map(self, chunk: int, slot: int) -> np.memmap:
+        chunk_map = self._maps.get(chunk)
+        if chunk_map is None or slot >= len(chunk_map):
+            # The last chunk grows as items are added, so remap it when a slot is past its end
+            n_items = os.path.getsize(self._chunk_path(chunk)) // self.item_bytes
+            chunk_map = np.memmap(self._chunk_path(chunk), dtype=np.uint8, mode="r", shape=(n_items, *self.item_shape))
+            self._maps[chunk] = chunk_map
+        return chunk_map
+
+    def get(self, key: int) -> Optional[np.ndarray]:
+        """Return a copy of the array stored under key, or None."""
+        row = self._rows.get(int(key))
+        if row is None:
+            return None
+        record = self._records[row]
+        return np.array(self._chunk_map(int(record["chunk"]), int(record["slot"]))[record["slot"]])
+
+    def content_size(self, key: int) -> Optional[Tuple[int, int]]:
+        """Return the (height, width) of the content stored under key, or None."""
+        row = self._rows.get(int(key))
+        if row is None:
+            return None
+        record = self._records[row]
+        return int(record["height"]), int(record["width"])
+
+    def get_many(self, keys: List[int]) -> Tuple[List[int], np.ndarray]:
+        """Return the keys that are stored and an (n_found, *item_shape) array of their items, in key order."""
+        found = [int(key) for key in keys if int(key) in self._rows]
+        items = np.empty((len(found), *self.item_shape), dtype=np.uint8)
+        if not found:
+            return found, items
+
+        records = self._records[[self._rows[key] for key in found]]
+        for chunk in np.unique(records["chunk"]):
+            positions = np.flatnonzero(records["chunk"] == chunk)
+            slots = records["slot"][positions]
+            # Read each chunk's slots in ascending order so the reads are sequential
+            order = np.argsort(slots)
+            chunk_map = self._chunk_map(int(chunk), int(slots.max()))
+            items[positions[order]] = chunk_map[slots[order]]
+        return found, items
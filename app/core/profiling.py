@@ -0,0 +1,321 @@
+"""
+Capture CPU and memory profiles of live requests, or of the pipeline offline.
+
+While a capture runs, the Python stacks of threads inside track() blocks (the
+/classify predictions) are sampled every few milliseconds, tracemalloc snapshots
+are taken at the start and end, and torch operator times can be recorded for the
+tracked calls. The results are bundled into a zip:
+
+    cpu.folded        sampled stacks in collapsed format, for flamegraph.pl or speedscope
+    cpu_top.txt       functions by self and total samples
+    memory_top.txt    largest allocation sites at the end, and growth since the start
+    memory.snapshot   the final tracemalloc snapshot (tracemalloc.Snapshot.load)
+    torch_ops.txt     torch operator calls and times, if requested
+    cpu.pstats        deterministic cProfile stats (offline --cprofile only)
+    summary.json
+
+tracemalloc slows down allocation-heavy code, which also inflates its share of
+the CPU samples, so capture CPU without memory when timings matter. Profile the
+pipeline offline on sample images with:
+
+    python -m app.core.profiling data/samples/*.jpg --repeat 20 --torch --out profile.zip
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+
+class ProfileCapture:
+    """Sample the stacks of tracked threads and snapshot memory until stopped."""
+
+    def __init__(self, interval: float = 0.005, memory: bool = True, memory_frames: int = 10, torch_ops: bool = False):
+        self.interval = interval
+        self.memory = memory
+        self.memory_frames = memory_frames
+        self.torch_ops = torch_ops
+        self.stacks: Counter = Counter()  # collapsed stack -> samples
+        self.samples = 0
+        self.calls = 0
+        self.operators: Dict[str, list] = {}  # torch operator -> [calls, total us, self us]
+        self.seconds = 0.0
+        self._threads: Dict[int, int] = {}  # thread ident -> track() nesting depth
+        self._lock = threading.Lock()
+        self._torch_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._started_tracemalloc = False
+        self._memory_start = None
+        self._memory_end = None
+        self._started = None
+
+    def start(self) -> None:
+        self._started = time.perf_counter()
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.memory_frames)
+                self._started_tracemalloc = True
+            self._memory_start = tracemalloc.take_snapshot()
+        self._sampler = threading.Thread(target=self._sample, name="profile-sampler", daemon=True)
+        self._sampler.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._sampler.join()
+        self.seconds = time.perf_counter() - self._started
+        if self.memory:
+            self._memory_end = tracemalloc.take_snapshot()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+
+    @contextmanager
+    def track(self) -> Iterator[None]:
+        """Include the current thread in the capture while the block runs."""
+        ident = threading.get_ident()
+        with self._lock:
+            depth = self._threads.get(ident, 0)
+            self._threads[ident] = depth + 1
+            if depth == 0:
+                self.calls += 1
+
+        # torch.profiler only sees its own thread and allows one session at a time,
+        # so operator times come from whichever tracked call gets there first
+        profiler = None
+        if depth == 0 and self.torch_ops and self._torch_lock.acquire(blocking=False):
+            from torch.profiler import ProfilerActivity, profile
+            profiler = profile(activities=[ProfilerActivity.CPU])
+            profiler.start()
+        try:
+            yield
+        finally:
+            with self._lock:
+                if depth == 0:
+                    del self._threads[ident]
+                else:
+                    self._threads[ident] = depth
+            # Stopping parses the recorded events, which should not show up in the samples
+            if profiler is not None:
+                try:
+                    profiler.stop()
+                    self._add_operators(profiler)
+                finally:
+                    self._torch_lock.release()
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                idents = list(self._threads)
+            if not idents:
+                continue
+            frames = sys._current_frames()
+            self.samples += 1
+            for ident in idents:
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.stacks[_fold(frame)] += 1
+
+    def _add_operators(self, profiler) -> None:
+        for event in profiler.key_averages():
+            totals = self.operators.setdefault(event.key, [0, 0.0, 0.0])
+            totals[0] += event.count
+            totals[1] += event.cpu_time_total
+            totals[2] += event.self_cpu_time_total
+
+    def bundle(self, summary: Optional[Dict[str, Any]] = None, extra_files: Optional[Dict[str, bytes]] = None) -> bytes:
+        """Return the stopped capture as zip archive bytes."""
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("cpu.folded", "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common()))
+            archive.writestr("cpu_top.txt", top_functions(self.stacks))
+            if self.memory:
+                start, end = _filter_snapshot(self._memory_start), _filter_snapshot(self._memory_end)
+                archive.writestr("memory_top.txt", memory_report(start, end))
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    end.dump(os.path.join(tmp_dir, "memory.snapshot"))
+                    archive.write(os.path.join(tmp_dir, "memory.snapshot"), "memory.snapshot")
+            if self.torch_ops:
+                archive.writestr("torch_ops.txt", operator_report(self.operators))
+            for name, data in (extra_files or {}).items():
+                archive.writestr(name, data)
+            archive.writestr("summary.json", json.dumps({
+                "pid": os.getpid(),
+                "seconds": self.seconds,
+                "calls": self.calls,
+                "samples": self.samples,
+                "interval_ms": self.interval * 1000,
+                "memory": self.memory,
+                "torch_ops": self.torch_ops,
+                **(summary or {})
+            }, indent=2))
+        return buffer.getvalue()
+
+
+# The capture running in this process, if any
+_active: Optional[ProfileCapture] = None
+_active_lock = threading.Lock()
+
+
+def start_capture(**kwargs) -> ProfileCapture:
+    """Start capturing in this process; raises RuntimeError if a capture is already running."""
+    global _active
+    with _active_lock:
+        if _active is not None:
+            raise RuntimeError("A profile capture is already running")
+        capture = ProfileCapture(**kwargs)
+        capture.start()
+        _active = capture
+    return capture
+
+
+def stop_capture() -> ProfileCapture:
+    global _active
+    with _active_lock:
+        capture, _active = _active, None
+    capture.stop()
+    return capture
+
+
+@contextmanager
+def track() -> Iterator[None]:
+    """Profile the block if a capture is running; costs one attribute lookup otherwise."""
+    capture = _active
+    if capture is None:
+        yield
+        return
+    with capture.track():
+        yield
+
+
+def _fold(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def top_functions(stacks: Counter, limit: int = 40) -> str:
+    """Functions by the share of samples spent in them (self) and under them (total)."""
+    self_counts, total_counts = Counter(), Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        self_counts[frames[-1]] += count
+        for name in set(frames):
+            total_counts[name] += count
+
+    n_samples = sum(stacks.values()) or 1
+    lines = []
+    for title, counts in (("By self samples", self_counts), ("By total samples", total_counts)):
+        lines.append(f"{title} ({n_samples} samples)")
+        lines.extend(f"{100 * count / n_samples:6.1f}%  {name}" for name, count in counts.most_common(limit))
+        lines.append("")
+    return "\n".join(lines)
+
+
+def _filter_snapshot(snapshot: tracemalloc.Snapshot) -> tracemalloc.Snapshot:
+    return snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<unknown>"),
+        tracemalloc.Filter(False, "*/torch/profiler/*"),
+        tracemalloc.Filter(False, "*/torch/autograd/profiler*"),
+    ])
+
+
+def memory_report(start: tracemalloc.Snapshot, end: tracemalloc.Snapshot, limit: int = 30) -> str:
+    lines = ["Largest allocation sites at the end of the capture"]
+    lines.extend(str(stat) for stat in end.statistics("lineno")[:limit])
+    lines.extend(["", "Growth since the start of the capture"])
+    lines.extend(str(stat) for stat in end.compare_to(start, "lineno")[:limit])
+    return "\n".join(lines) + "\n"
+
+
+def operator_report(operators: Dict[str, list], limit: int = 50) -> str:
+    lines = [f"{'calls':>8} {'total ms':>10} {'self ms':>10}  operator"]
+    for name, (calls, total_us, self_us) in sorted(operators.items(), key=lambda item: -item[1][2])[:limit]:
+        lines.append(f"{calls:>8} {total_us / 1000:>10.1f} {self_us / 1000:>10.1f}  {name}")
+    return "\n".join(lines) + "\n"
+
+
+def main() -> None:
+    import cProfile
+
+    from PIL import Image
+
+    from app.ml.pipeline import create_default_pipeline
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="+", help="Sample images to classify")
+    parser.add_argument("--repeat", type=int, default=10, help="Passes over the sample images")
+    parser.add_argument("--tta", action="store_true", help="Profile with test-time augmentation")
+    parser.add_argument("--no-memory", action="store_true", help="Skip tracemalloc, which skews CPU samples")
+    parser.add_argument("--torch", action="store_true", help="Also record torch operator times")
+    parser.add_argument("--cprofile", action="store_true", help="Add a deterministic cProfile pass (cpu.pstats)")
+    parser.add_argument("--interval-ms", type=float, default=5.0, help="Stack sampling interval")
+    parser.add_argument("--out", default="profile.zip")
+    args = parser.parse_args()
+
+    pipeline = create_default_pipeline()
+    images = [Image.open(path).convert("RGB") for path in args.images]
+    pipeline.predict(images[0], tta=args.tta)  # warm up
+
+    # One pass without profiling, to show how much the capture slows predictions down
+    baseline = []
+    for image in images:
+        start = time.perf_counter()
+        pipeline.predict(image, tta=args.tta)
+        baseline.append(time.perf_counter() - start)
+
+    durations = []
+    capture = start_capture(interval=args.interval_ms / 1000, memory=not args.no_memory, torch_ops=args.torch)
+    try:
+        for _ in range(args.repeat):
+            for image in images:
+                start = time.perf_counter()
+                with track():
+                    pipeline.predict(image, tta=args.tta)
+                durations.append(time.perf_counter() - start)
+    finally:
+        stop_capture()
+
+    extra_files = {}
+    if args.cprofile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        for image in images:
+            pipeline.predict(image, tta=args.tta)
+        profiler.disable()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            profiler.dump_stats(os.path.join(tmp_dir, "cpu.pstats"))
+            with open(os.path.join(tmp_dir, "cpu.pstats"), "rb") as f:
+                extra_files["cpu.pstats"] = f.read()
+
+    durations.sort()
+    summary = {
+        "model_version": pipeline.version,
+        "images": len(images),
+        "mean_ms": sum(durations) / len(durations) * 1000,
+        "p50_ms": durations[len(durations) // 2] * 1000,
+        "unprofiled_mean_ms": sum(baseline) / len(baseline) * 1000,
+    }
+    with open(args.out, "wb") as f:
+        f.write(capture.bundle(summary, extra_files))
+    print(top_functions(capture.stacks, limit=15))
+    print(
+        f"Mean {summary['mean_ms']:.1f} ms over {len(durations)} profiled predictions "
+        f"({summary['unprofiled_mean_ms']:.1f} ms unprofiled); wrote {args.out}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+Blob storage for images: a sharded local filesystem backend and an S3-compatible backend.
+"""
+import hashlib
+import os
+import tempfile
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from typing import Iterable, Iterator, Optional
+
+from app.core.config import settings
+
+
+CHUNK_SIZE = 256 * 1024
+
+
+class StorageBackend(ABC):
+    """Base class for blob storage keyed by relative paths like "images/ab12....jpg"."""
+
+    @abstractmethod
+    def write(self, key: str, chunks: Iterable[bytes]) -> int:
+        """Stream chunks into the blob at key and return the number of bytes written."""
+        pass
+
+    @abstractmethod
+    def read(self, key: str, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        """Stream the bytes of a blob from start up to (excluding) end."""
+        pass
+
+    @abstractmethod
+    def size(self, key: str) -> int:
+        """Return the size of a blob in bytes."""
+        pass
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        pass
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        pass
+
+    def write_bytes(self, key: str, data: bytes) -> int:
+        return self.write(key, [data])
+
+    def read_bytes(self, key: str, start: int = 0, end: Optional[int] = None) -> bytes:
+        return b"".join(self.read(key, start, end))
+
+
+class LocalStorageBackend(StorageBackend):
+    """Store blobs on the local filesystem under hash-prefix directories.
+
+    A key is stored at root/ab/cd/<key> where abcd are the first hex digits of
+    the key's SHA-1, so even millions of blobs spread over 65536 directories.
+    """
+
+    def __init__(self, root: str, shard_levels: int = 2):
+        self.root = root
+        self.shard_levels = shard_levels
+
+    def path(self, key: str) -> str:
+        # Rows written before the storage backend hold absolute file paths
+        if os.path.isabs(key):
+            return key
+        if ".." in key.split("/"):
+            raise ValueError(f"Invalid storage key: {key}")
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        shards = [digest[2 * i:2 * i + 2] for i in range(self.shard_levels)]
+        return os.path.join(self.root, *shards, key)
+
+    def write(self, key: str, chunks: Iterable[bytes]) -> int:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so readers never see a partial blob
+        written = 0
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    written += len(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return written
+
+    def read(self, key: str, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        with open(self.path(key), "rb") as f:
+            f.seek(start)
+            remaining = None if end is None else end - start
+            while remaining is None or remaining > 0:
+                chunk = f.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    return
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def size(self, key: str) -> int:
+        return os.path.getsize(self.path(key))
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+class S3StorageBackend(StorageBackend):
+    """Store blobs in an S3 bucket, or any S3-compatible server (MinIO, LocalStack) via endpoint_url."""
+
+    def __init__(
+        self,
+        bucket: str,
+        endpoint_url: Optional[str] = None,
+        region: Optional[str] = None,
+        access_key_id: Optional[str] = None,
+        secret_access_key: Optional[str] = None,
+        prefix: str = ""
+    ):
+        try:
+            import boto3
+        except ImportError as e:
+            raise ImportError("boto3 is required for the s3 storage backend") from e
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            region_name=region,
+            aws_access_key_id=access_key_id,
+            aws_secret_access_key=secret_access_key
+        )
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+
+    def write(self, key: str, chunks: Iterable[bytes]) -> int:
+        # Spool to memory (or disk past 8MB); upload_fileobj switches to multipart for large blobs
+        written = 0
+        with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as f:
+            for chunk in chunks:
+                f.write(chunk)
+                written += len(chunk)
+            f.seek(0)
+            self.client.upload_fileobj(f, self.bucket, self._key(key))
+        return written
+
+    def read(self, key: str, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        kwargs = {}
+        if start or end is not None:
+            # HTTP ranges are inclusive
+            kwargs["Range"] = f"bytes={start}-{'' if end is None else end - 1}"
+        response = self.client.get_object(Bucket=self.bucket, Key=self._key(key), **kwargs)
+        yield from response["Body"].iter_chunks(CHUNK_SIZE)
+
+    def size(self, key: str) -> int:
+        return self.client.head_object(Bucket=self.bucket, Key=self._key(key))["ContentLength"]
+
+    def exists(self, key: str) -> bool:
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+
+@lru_cache
+def get_storage() -> StorageBackend:
+    """Get the storage backend selected by STORAGE_BACKEND."""
+    if settings.STORAGE_BACKEND == "local":
+        return LocalStorageBackend(settings.IMAGES_DIR)
+    elif settings.STORAGE_BACKEND == "s3":
+        if not settings.S3_BUCKET:
+            raise ValueError("S3_BUCKET must be set for the s3 storage backend")
+        return S3StorageBackend(
+            bucket=settings.S3_BUCKET,
+            endpoint_url=settings.S3_ENDPOINT_URL,
+            region=settings.AWS_REGION,
+            access_key_id=settings.AWS_ACCESS_KEY_ID,
+            secret_access_key=settings.AWS_SECRET_ACCESS_KEY
+        )
+    else:
+        raise ValueError(f"Unsupported storage backend: {settings.STORAGE_BACKEND}")
+
+
+def image_key(data: bytes, extension: str = "jpg") -> str:
+    """Content-addressed key for an image, so identical bytes are only stored once."""
+    return f"images/{hashlib.sha256(data).hexdigest()}.{extension}"
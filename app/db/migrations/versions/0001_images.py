@@ -0,0 +1,34 @@
+"""images table
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-19
+
+Databases created by Base.metadata.create_all before migrations existed
+already have the table, so it is only created when missing.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    if sa.inspect(op.get_bind()).has_table("images"):
+        return
+    op.create_table(
+        "images",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("image_path", sa.String(), nullable=False),
+        sa.Column("season", sa.String(), nullable=False),
+    )
+    op.create_index("ix_images_id", "images", ["id"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_images_id", table_name="images")
+    op.drop_table("images")
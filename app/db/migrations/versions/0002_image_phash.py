@@ -0,0 +1,36 @@
+"""perceptual hash and duplicate_of on images
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # create_all may already have made the table with these columns
+    columns = {column["name"] for column in sa.inspect(op.get_bind()).get_columns("images")}
+    if "phash" in columns:
+        return
+    with op.batch_alter_table("images") as batch:
+        batch.add_column(sa.Column("phash", sa.String(), nullable=True))
+        batch.add_column(sa.Column("duplicate_of", sa.Integer(), nullable=True))
+        batch.create_foreign_key("fk_images_duplicate_of", "images", ["duplicate_of"], ["id"])
+        batch.create_index("ix_images_phash", ["phash"])
+        batch.create_index("ix_images_duplicate_of", ["duplicate_of"])
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("images") as batch:
+        batch.drop_index("ix_images_duplicate_of")
+        batch.drop_index("ix_images_phash")
+        batch.drop_constraint("fk_images_duplicate_of", type_="foreignkey")
+        batch.drop_column("duplicate_of")
+        batch.drop_column("phash")
@@ -0,0 +1,33 @@
+"""season_counts summary table and the (season, id) index on images
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19
+
+The app fills season_counts from images at startup when it is empty.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table("season_counts"):
+        op.create_table(
+            "season_counts",
+            sa.Column("season", sa.String(), primary_key=True),
+            sa.Column("count", sa.Integer(), nullable=False, server_default="0"),
+        )
+    if "ix_images_season_id" not in {index["name"] for index in inspector.get_indexes("images")}:
+        op.create_index("ix_images_season_id", "images", ["season", "id"])
+
+
+def downgrade() -> None:
+    op.drop_index("ix_images_season_id", table_name="images")
+    op.drop_table("season_counts")
@@ -4,7 +4,7 @@
 # from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, Text
 # from sqlalchemy.orm import relationship
 
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, ForeignKey, Index, Integer, String
 
 from app.db.session import Base
 
@@ -27,6 +27,8 @@ class Images(Base):
     id = Column(Integer, primary_key=True, index=True)
     image_path = Column(String, nullable=False)
     season = Column(String, nullable=False)  # e.g., "Spring Summer 1999"
+    phash = Column(String, index=True)  # 64-bit perceptual hash as 16 hex chars
+    duplicate_of = Column(Integer, ForeignKey("images.id"), index=True)  # original image if this is a (near-)duplicate
 
     # user_id = Column(Integer, ForeignKey("users.id"))
     # image_url = Column(String, nullable=False)
@@ -37,6 +39,19 @@ class Images(Base):
 
     # user = relationship("User", back_populates="contributions")
 
+    __table_args__ = (
+        # Serves season lookups and keyset pagination (id > last_id) within a season
+        Index("ix_images_season_id", "season", "id"),
+    )
+
+
+class SeasonCount(Base):
+    __tablename__ = "season_counts"
+
+    # Number of images per season, kept up to date on upload so stats never scan images
+    season = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
 
 # class ModelVersion(Base):
 #     __tablename__ = "model_versions"
@@ -1,12 +1,50 @@
+from typing import Any, Dict
+
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from app.core.config import settings
 
+
+def _engine_options(url: str) -> Dict[str, Any]:
+    """Pool settings for an engine; SQLite has no server-side connection limit to tune."""
+    if url.startswith("sqlite"):
+        return {"pool_pre_ping": settings.DB_POOL_PRE_PING}
+    return {
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+    }
+
+
 # Create SQLAlchemy engine
-engine = create_engine(settings.SQLALCHEMY_DATABASE_URI)
+engine = create_engine(settings.SQLALCHEMY_DATABASE_URI, **_engine_options(settings.SQLALCHEMY_DATABASE_URI))
 
 # Create session factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine) 
 
-Base = declarative_base()
\ No newline at end of file
+# Async engine and session factory for endpoints, so queries don't block the event loop
+async_engine = create_async_engine(
+    settings.SQLALCHEMY_ASYNC_DATABASE_URI, **_engine_options(settings.SQLALCHEMY_ASYNC_DATABASE_URI)
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+Base = declarative_base()
+
+
+def run_migrations() -> None:
+    """Upgrade the database schema to the latest alembic revision (app/db/migrations)."""
+    import os
+
+    from alembic import command
+    from alembic.config import Config
+
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    config = Config(os.path.join(root, "alembic.ini"))
+    config.set_main_option("script_location", os.path.join(root, "app", "db", "migrations"))
+    config.attributes["configure_logger"] = False
+    command.upgrade(config, "head")
+
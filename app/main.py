@@ -1,12 +1,15 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from typing import List, Annotated
 
-from app.api.endpoints import data_operations, model
+from app.api.endpoints import admin, data_operations, model
 
 
 from app.core.config import settings
-from app.db.session import engine
+from app.core.metrics import REGISTRY
+from app.db.session import AsyncSessionLocal, engine, run_migrations
+from app.services.stats_service import StatsService
 import app.db.models as models
 
 
@@ -15,9 +18,23 @@ app = FastAPI(
     description="API for classifying vintage Prada clothing by season",
     version="0.1.0",
 )
+run_migrations()    # add new columns to existing tables
 models.Base.metadata.create_all(bind=engine)    # create all the tables in the database
 
 
+@app.on_event("startup")
+async def fill_season_counts():
+    # Backfill the stats summary table if it was just created next to existing images
+    async with AsyncSessionLocal() as db:
+        await StatsService(db).rebuild_if_empty()
+
+
+@app.on_event("startup")
+async def schedule_compaction():
+    # Each worker checks; the compaction lock lets only one of them run it
+    model.start_compaction_schedule()
+
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -32,6 +49,7 @@ app.add_middleware(
 # app.include_router(training.router, prefix=settings.API_V1_STR + "/training", tags=["training"])
 app.include_router(data_operations.router, prefix=settings.API_V1_STR + "/data_operations", tags=["data_operations"])
 app.include_router(model.router, prefix=settings.API_V1_STR + "/models", tags=["models"])
+app.include_router(admin.router, prefix=settings.API_V1_STR + "/admin", tags=["admin"])
 
 @app.get("/")
 async def root():
@@ -39,4 +57,11 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"} 
\ No newline at end of file
+    return {"status": "healthy"}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+    Expose pipeline metrics in the Prometheus text format.
+    """
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4") 
\ No newline at end of file
@@ -0,0 +1,119 @@
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+import numpy as np
+from PIL import Image
+
+from app.ml.feature_extraction import CROP_SIZE, center_crop
+
+
+CROP_POSITIONS = ["center", "top_left", "top_right", "bottom_left", "bottom_right"]
+
+
+class TestTimeAugmentation:
+    """Build several CROP_SIZE views of a preprocessed image for test-time augmentation.
+
+    Views are ordered by usefulness (unscaled centre crop first, then its flip, then
+    the corner crops, then the other scales), so limiting the number of views keeps
+    the most informative ones. With a latency budget, the number of views is chosen
+    from the measured extraction time per view.
+    """
+
+    def __init__(
+        self,
+        flips: bool = True,
+        crops: int = 1,
+        scales: Sequence[float] = (1.0,),
+        aggregation: str = "mean",
+        max_views: Optional[int] = None,
+        latency_budget_ms: float = 0.0
+    ):
+        if crops not in (1, 5):
+            raise ValueError("crops must be 1 (centre) or 5 (centre and corners)")
+        if aggregation not in ("mean", "vote"):
+            raise ValueError(f"Unsupported aggregation: {aggregation}")
+
+        self.flips = flips
+        self.positions = CROP_POSITIONS[:crops]
+        self.scales = sorted(scales, key=lambda scale: abs(scale - 1.0))
+        self.aggregation = aggregation
+        self.max_views = max_views
+        self.latency_budget_ms = latency_budget_ms
+        self._ms_per_view = None
+        self._lock = threading.Lock()
+
+    @property
+    def n_views(self) -> int:
+        """Number of views used for the next prediction."""
+        n_views = len(self.scales) * len(self.positions) * (2 if self.flips else 1)
+        if self.max_views:
+            n_views = min(n_views, self.max_views)
+        if self.latency_budget_ms > 0 and self._ms_per_view:
+            n_views = min(n_views, int(self.latency_budget_ms / self._ms_per_view))
+        return max(1, n_views)
+
+    def record(self, n_views: int, seconds: float) -> None:
+        """Update the moving average of extraction time per view."""
+        ms_per_view = seconds * 1000 / n_views
+        with self._lock:
+            if self._ms_per_view is None:
+                self._ms_per_view = ms_per_view
+            else:
+                self._ms_per_view = 0.8 * self._ms_per_view + 0.2 * ms_per_view
+
+    def views(self, image: Union[Image.Image, np.ndarray]) -> np.ndarray:
+        """Return an (n_views, CROP_SIZE, CROP_SIZE, 3) uint8 array of views."""
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        image = image.convert("RGB")
+
+        n_views = self.n_views
+        views = []
+        for scale in self.scales:
+            scaled = image
+            if scale != 1.0:
+                scaled = image.resize(
+                    (max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.BILINEAR
+                )
+            for position in self.positions:
+                crop = _crop(scaled, position)
+                views.append(crop)
+                if self.flips:
+                    views.append(crop[:, ::-1])
+                if len(views) >= n_views:
+                    return np.stack(views[:n_views])
+        return np.stack(views)
+
+    def aggregate_features(self, features: np.ndarray) -> np.ndarray:
+        """Average view embeddings into a single feature vector."""
+        return features.mean(axis=0)
+
+    @staticmethod
+    def aggregate_predictions(predictions: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Average the class probabilities predicted for each view."""
+        probabilities = {}
+        for prediction in predictions:
+            for label, probability in prediction["probabilities"].items():
+                probabilities[label] = probabilities.get(label, 0.0) + probability / len(predictions)
+
+        season = max(probabilities, key=probabilities.get)
+        result = dict(predictions[0])
+        result.update({
+            "season": season,
+            "confidence": probabilities[season],
+            "probabilities": probabilities
+        })
+        return result
+
+
+def _crop(image: Image.Image, position: str) -> np.ndarray:
+    if position == "center":
+        return center_crop(image)
+
+    # Pad images smaller than the crop the same way CenterCrop does
+    if image.width < CROP_SIZE or image.height < CROP_SIZE:
+        image = Image.fromarray(center_crop(image, max(CROP_SIZE, image.width, image.height)))
+
+    left = 0 if position.endswith("left") else image.width - CROP_SIZE
+    top = 0 if position.startswith("top") else image.height - CROP_SIZE
+    return np.asarray(image.crop((left, top, left + CROP_SIZE, top + CROP_SIZE)))
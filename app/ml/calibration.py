@@ -0,0 +1,265 @@
+"""
+Calibrated confidence for the nearest neighbour classifier.
+
+Votes are weighted by distance and turned into probabilities, which are then calibrated
+on the stored embeddings themselves (leave-one-out), so fitting needs no image decoding:
+
+    python -m app.ml.calibration --method temperature --target-accuracy 0.9
+"""
+import argparse
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from scipy.optimize import minimize_scalar
+from sklearn.isotonic import IsotonicRegression
+
+from app.ml.classifiers import NearestNeighborClassifier
+
+
+# Mixed in with a uniform distribution so no class ever gets probability 0
+SMOOTHING = 1e-3
+
+
+def vote_probabilities(
+    distances: np.ndarray,
+    neighbor_labels: np.ndarray,
+    n_classes: int,
+    temperature: float = 1.0,
+    vote_weights: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Turn (n, k) neighbour distances and labels into (n, n_classes) distance-weighted vote shares.
+
+    Each neighbour votes with weight exp(-(d - d_nearest) / temperature), times its
+    vote weight if given; distances should already be divided by a typical neighbour distance.
+    """
+    weights = np.exp(-(distances - distances[:, :1]) / temperature)
+    if vote_weights is not None:
+        weights = weights * vote_weights
+    probabilities = np.zeros((len(distances), n_classes))
+    np.add.at(probabilities, (np.arange(len(distances))[:, None], neighbor_labels), weights)
+    probabilities /= probabilities.sum(axis=1, keepdims=True)
+    return (1 - SMOOTHING) * probabilities + SMOOTHING / n_classes
+
+
+class KNNCalibrator:
+    """Calibrate distance-weighted kNN votes with a fitted temperature or an isotonic map.
+
+    temperature: one scalar sharpening or flattening the vote weights, fitted by minimising NLL.
+    isotonic: a monotone map from the top vote share to the probability of being correct.
+    """
+
+    def __init__(self, method: str = "temperature"):
+        if method not in ("temperature", "isotonic"):
+            raise ValueError(f"Unsupported calibration method: {method}")
+        self.method = method
+        self.scale = 1.0
+        self.temperature = 1.0
+        self.isotonic_x = None
+        self.isotonic_y = None
+        self.abstain_threshold = 0.0
+
+    def fit(self, distances: np.ndarray, neighbor_labels: np.ndarray, labels: np.ndarray, n_classes: int) -> "KNNCalibrator":
+        """Fit on held-out neighbour lists and the true label indices."""
+        # Typical distance to the nearest neighbour, so the temperature is independent of the embedding scale
+        self.scale = float(np.median(distances[:, 0])) or 1.0
+        distances = distances / self.scale
+
+        if self.method == "temperature":
+            def nll(log_temperature: float) -> float:
+                probabilities = vote_probabilities(distances, neighbor_labels, n_classes, np.exp(log_temperature))
+                return -np.mean(np.log(probabilities[np.arange(len(labels)), labels]))
+
+            self.temperature = float(np.exp(minimize_scalar(nll, bounds=(-6, 6), method="bounded").x))
+        else:
+            probabilities = vote_probabilities(distances, neighbor_labels, n_classes)
+            isotonic = IsotonicRegression(y_min=0.0, y_max=1.0, out_of_bounds="clip")
+            isotonic.fit(probabilities.max(axis=1), probabilities.argmax(axis=1) == labels)
+            self.isotonic_x = isotonic.X_thresholds_
+            self.isotonic_y = isotonic.y_thresholds_
+        return self
+
+    def predict_proba(
+        self,
+        distances: np.ndarray,
+        neighbor_labels: np.ndarray,
+        n_classes: int,
+        vote_weights: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """Return calibrated (n, n_classes) probabilities for (n, k) neighbour lists."""
+        distances = np.atleast_2d(distances) / self.scale
+        neighbor_labels = np.atleast_2d(neighbor_labels)
+        if vote_weights is not None:
+            vote_weights = np.atleast_2d(vote_weights)
+        probabilities = vote_probabilities(distances, neighbor_labels, n_classes, self.temperature, vote_weights)
+        if self.method == "isotonic":
+            # Move the top class to its calibrated confidence without reordering the classes:
+            # shrink the rest proportionally when confidence goes up, and blend towards uniform
+            # when it goes down (rescaling the rest up could lift another class above the top)
+            rows = np.arange(len(probabilities))
+            top = probabilities.argmax(axis=1)
+            top_probability = probabilities[rows, top]
+            calibrated = np.clip(np.interp(top_probability, self.isotonic_x, self.isotonic_y), 1e-6, 1 - 1e-6)
+            rest = 1 - top_probability
+            sharpened = probabilities * ((1 - calibrated) / np.where(rest > 0, rest, 1))[:, None]
+            sharpened[rows, top] = calibrated
+            # The top share can fall no lower than uniform without changing the argmax
+            spread = top_probability - 1 / n_classes
+            blend = np.clip((calibrated - 1 / n_classes) / np.where(spread > 0, spread, 1), 1e-6, 1)[:, None]
+            flattened = blend * probabilities + (1 - blend) / n_classes
+            probabilities = np.where((calibrated >= top_probability)[:, None], sharpened, flattened)
+        return probabilities
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump({
+                "method": self.method,
+                "scale": self.scale,
+                "temperature": self.temperature,
+                "isotonic_x": None if self.isotonic_x is None else self.isotonic_x.tolist(),
+                "isotonic_y": None if self.isotonic_y is None else self.isotonic_y.tolist(),
+                "abstain_threshold": self.abstain_threshold
+            }, f, indent=2)
+
+    @classmethod
+    def load(cls, path: str) -> "KNNCalibrator":
+        with open(path) as f:
+            state = json.load(f)
+        calibrator = cls(state["method"])
+        calibrator.scale = state["scale"]
+        calibrator.temperature = state["temperature"]
+        if state["isotonic_x"] is not None:
+            calibrator.isotonic_x = np.array(state["isotonic_x"])
+            calibrator.isotonic_y = np.array(state["isotonic_y"])
+        calibrator.abstain_threshold = state.get("abstain_threshold", 0.0)
+        return calibrator
+
+
+def leave_one_out_neighbors(classifier: NearestNeighborClassifier, rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Neighbours of stored rows among all other stored rows, from the fitted index."""
+    distances, indices = classifier.model.kneighbors(classifier.features[rows], n_neighbors=k + 1)
+    # Drop each row's own entry (or the furthest neighbour if ties pushed it out of the list)
+    keep = indices != rows[:, None]
+    keep[keep.sum(axis=1) > k, -1] = False
+    return distances[keep].reshape(len(rows), k), classifier.labels[indices[keep].reshape(len(rows), k)]
+
+
+def expected_calibration_error(confidence: np.ndarray, correct: np.ndarray, n_bins: int = 15) -> float:
+    bins = np.minimum((confidence * n_bins).astype(int), n_bins - 1)
+    ece = 0.0
+    for b in range(n_bins):
+        in_bin = bins == b
+        if in_bin.any():
+            ece += in_bin.mean() * abs(confidence[in_bin].mean() - correct[in_bin].mean())
+    return float(ece)
+
+
+def evaluate(probabilities: np.ndarray, labels: np.ndarray, thresholds: Optional[List[float]] = None) -> Dict[str, Any]:
+    """Accuracy, ECE, NLL and Brier score, plus coverage and accuracy for each abstain threshold."""
+    rows = np.arange(len(labels))
+    confidence = probabilities.max(axis=1)
+    correct = probabilities.argmax(axis=1) == labels
+    one_hot = np.zeros_like(probabilities)
+    one_hot[rows, labels] = 1
+
+    report = {
+        "n": int(len(labels)),
+        "accuracy": float(correct.mean()),
+        "ece": expected_calibration_error(confidence, correct),
+        "nll": float(-np.mean(np.log(np.clip(probabilities[rows, labels], 1e-12, None)))),
+        "brier": float(np.mean(np.sum((probabilities - one_hot) ** 2, axis=1))),
+        "abstention": []
+    }
+    for threshold in thresholds or [0.5, 0.6, 0.7, 0.8, 0.9]:
+        answered = confidence >= threshold
+        report["abstention"].append({
+            "threshold": threshold,
+            "coverage": float(answered.mean()),
+            "accuracy": float(correct[answered].mean()) if answered.any() else None
+        })
+    return report
+
+
+def threshold_for_accuracy(probabilities: np.ndarray, labels: np.ndarray, target_accuracy: float) -> float:
+    """Lowest confidence threshold at which the answered items reach target_accuracy."""
+    confidence = probabilities.max(axis=1)
+    correct = probabilities.argmax(axis=1) == labels
+    order = np.argsort(-confidence)
+    running_accuracy = np.cumsum(correct[order]) / np.arange(1, len(order) + 1)
+    reaching = np.flatnonzero(running_accuracy >= target_accuracy)
+    if not len(reaching):
+        return 1.0
+    return float(confidence[order][reaching[-1]])
+
+
+def calibrate_classifier(
+    classifier: NearestNeighborClassifier,
+    method: str = "temperature",
+    sample_size: int = 5000,
+    target_accuracy: Optional[float] = None,
+    seed: int = 0
+) -> Tuple[KNNCalibrator, Dict[str, Any]]:
+    """Fit a calibrator on half of a leave-one-out sample of the stored embeddings and report on the other half."""
+    rng = np.random.default_rng(seed)
+    rows = rng.permutation(len(classifier.features))[:sample_size]
+    distances, neighbor_labels = leave_one_out_neighbors(classifier, rows, classifier.n_neighbors)
+    labels = classifier.labels[rows]
+    n_classes = len(classifier.label_encoder.classes_)
+
+    fit, held_out = np.arange(len(rows)) % 2 == 0, np.arange(len(rows)) % 2 == 1
+    calibrator = KNNCalibrator(method).fit(distances[fit], neighbor_labels[fit], labels[fit], n_classes)
+
+    # Uncalibrated baseline: the plain vote share the classifier reports today
+    raw = np.zeros((int(held_out.sum()), n_classes))
+    np.add.at(raw, (np.arange(len(raw))[:, None], neighbor_labels[held_out]), 1.0 / classifier.n_neighbors)
+    calibrated = calibrator.predict_proba(distances[held_out], neighbor_labels[held_out], n_classes)
+
+    if target_accuracy is not None:
+        calibrator.abstain_threshold = threshold_for_accuracy(calibrated, labels[held_out], target_accuracy)
+
+    thresholds = sorted({0.5, 0.6, 0.7, 0.8, 0.9, round(calibrator.abstain_threshold, 4)} - {0.0})
+    report = {
+        "method": method,
+        "temperature": calibrator.temperature,
+        "abstain_threshold": calibrator.abstain_threshold,
+        "uncalibrated": evaluate(raw, labels[held_out], thresholds),
+        "calibrated": evaluate(calibrated, labels[held_out], thresholds)
+    }
+    return calibrator, report
+
+
+def default_calibration_path(checkpoint_path: str) -> str:
+    return f"{os.path.splitext(checkpoint_path)[0]}.calibration.json"
+
+
+def main() -> None:
+    import time
+
+    from app.core.config import settings
+
+    parser = argparse.ArgumentParser(description="Fit confidence calibration on the stored kNN embeddings")
+    parser.add_argument("--checkpoint", default=settings.KNN_CHECKPOINT_PATH)
+    parser.add_argument("--method", choices=["temperature", "isotonic"], default="temperature")
+    parser.add_argument("--n-neighbors", type=int, default=5)
+    parser.add_argument("--sample-size", type=int, default=5000, help="Stored embeddings used for fitting and evaluation")
+    parser.add_argument("--target-accuracy", type=float, default=None,
+                        help="Set the abstain threshold to reach this accuracy on answered items")
+    parser.add_argument("--out", default=None, help="Defaults to <checkpoint>.calibration.json")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    checkpoint = np.load(args.checkpoint)
+    classifier = NearestNeighborClassifier(n_neighbors=args.n_neighbors)
+    classifier.fit(checkpoint["X"], checkpoint["y"])
+
+    calibrator, report = calibrate_classifier(classifier, args.method, args.sample_size, args.target_accuracy)
+    out = args.out or default_calibration_path(args.checkpoint)
+    calibrator.save(out)
+    report["seconds"] = time.perf_counter() - start
+    print(json.dumps(report, indent=2))
+    print(f"Saved calibration to {out}")
+
+
+if __name__ == "__main__":
+    main()
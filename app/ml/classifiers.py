@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List, Optional, Tuple, Union
 
 import numpy as np
@@ -19,6 +20,26 @@ class Classifier(ABC):
     def predict(self, features: np.ndarray) -> Dict[str, Any]:
         """Make a prediction on the input features."""
         pass
+    
+    @property
+    @abstractmethod
+    def classes(self) -> np.ndarray:
+        """Labels in the column order of predict_proba."""
+        pass
+    
+    def predict_proba(self, features: np.ndarray) -> np.ndarray:
+        """Return an (n_samples, n_classes) probability matrix aligned with classes."""
+        class_index = {label: i for i, label in enumerate(self.classes)}
+        rows = np.atleast_2d(features)
+        probabilities = np.zeros((len(rows), len(class_index)))
+        for row, sample in enumerate(rows):
+            for label, probability in self.predict(sample)["probabilities"].items():
+                probabilities[row, class_index[label]] = probability
+        return probabilities
+    
+    def predict_batch(self, features: np.ndarray) -> List[Dict[str, Any]]:
+        """Predict every row of a 2-D feature matrix."""
+        return [self.predict(row) for row in np.atleast_2d(features)]
 
 
 class NearestNeighborClassifier(Classifier):
@@ -31,15 +52,86 @@ class NearestNeighborClassifier(Classifier):
         self.label_encoder = LabelEncoder()
         self.features = None
         self.labels = None
+        self.ids = None
+        self._id_to_row = {}
+        self.weights = None  # votes per row, e.g. the near-duplicates a row stands in for after compaction
+        self.aliases = {}  # ids removed by compaction -> the row that stands in for them
+        self.calibrator = None  # a KNNCalibrator from app.ml.calibration, if fitted
+        self.abstain_threshold = 0.0
         self.is_fitted = False
     
-    def fit(self, features: np.ndarray, labels: List[str]) -> None:
-        """Fit the nearest neighbor model."""
+    def fit(
+        self,
+        features: np.ndarray,
+        labels: List[str],
+        ids: Optional[List[int]] = None,
+        weights: Optional[np.ndarray] = None
+    ) -> None:
+        """Fit the nearest neighbor model.
+        
+        ids are the `Images` ids of the rows, so neighbours can be mapped back to
+        catalogue items. Rows without a catalogue item use -1. weights are vote
+        weights per row; every neighbour votes equally if they are not given.
+        """
         self.features = features
+        self.weights = np.asarray(weights, dtype=np.float64) if weights is not None else None
         self.labels = self.label_encoder.fit_transform(labels)
+        self.ids = np.asarray(ids, dtype=np.int64) if ids is not None else np.full(len(features), -1, dtype=np.int64)
+        self._id_to_row = {int(image_id): row for row, image_id in enumerate(self.ids) if image_id >= 0}
         self.model.fit(features)
         self.is_fitted = True
     
+    def kneighbors(self, features: np.ndarray, n_neighbors: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Return distances and row indices of the n_neighbors closest stored rows."""
+        if not self.is_fitted:
+            raise ValueError("Classifier must be fitted before use")
+        
+        n_neighbors = min(n_neighbors, len(self.features))
+        return self.model.kneighbors(features.reshape(1, -1), n_neighbors=n_neighbors)
+    
+    @property
+    def classes(self) -> np.ndarray:
+        return self.label_encoder.classes_
+    
+    def predict_proba(self, features: np.ndarray) -> np.ndarray:
+        """Vote shares (or calibrated probabilities) for a batch of feature vectors in one neighbour query."""
+        if not self.is_fitted:
+            raise ValueError("Classifier must be fitted before use")
+        
+        distances, indices = self.model.kneighbors(np.atleast_2d(features))
+        neighbor_labels = self.labels[indices]
+        vote_weights = self._vote_weights(indices)
+        if self.calibrator is not None:
+            return self.calibrator.predict_proba(distances, neighbor_labels, len(self.classes), vote_weights)
+        
+        if vote_weights is None:
+            vote_weights = np.full(indices.shape, 1.0 / self.n_neighbors)
+        else:
+            vote_weights = vote_weights / vote_weights.sum(axis=1, keepdims=True)
+        probabilities = np.zeros((len(indices), len(self.classes)))
+        np.add.at(probabilities, (np.arange(len(indices))[:, None], neighbor_labels), vote_weights)
+        return probabilities
+    
+    def row_for_id(self, image_id: int) -> Optional[int]:
+        """Return the index row holding the embedding of an `Images` id, or standing in for it after compaction."""
+        row = self._id_to_row.get(image_id)
+        return row if row is not None else self.aliases.get(image_id)
+    
+    def save(self, path: str) -> None:
+        """Save the stored embeddings, labels, ids and any vote weights and aliases as a checkpoint."""
+        arrays = {}
+        if self.weights is not None:
+            arrays["weights"] = self.weights
+        np.savez(
+            path,
+            X=self.features,
+            y=self.label_encoder.inverse_transform(self.labels),
+            ids=self.ids,
+            alias_ids=np.array(list(self.aliases.keys()), dtype=np.int64),
+            alias_rows=np.array(list(self.aliases.values()), dtype=np.int64),
+            **arrays
+        )
+    
     def predict(self, features: np.ndarray) -> Dict[str, Any]:
         """Predict the class of the input features."""
         if not self.is_fitted:
@@ -51,6 +143,11 @@ class NearestNeighborClassifier(Classifier):
         # Get labels of nearest neighbors
         neighbor_labels = self.labels[indices[0]]
         
+        if self.calibrator is not None:
+            return self._predict_calibrated(distances, indices)
+        if self.weights is not None:
+            return self._predict_weighted(distances, indices)
+        
         # Count occurrences of each label
         unique_labels, counts = np.unique(neighbor_labels, return_counts=True)
         
@@ -73,55 +170,152 @@ class NearestNeighborClassifier(Classifier):
             "probabilities": probabilities,
             "nearest_neighbors": {
                 "distances": distances[0].tolist(),
-                "indices": indices[0].tolist()
+                "indices": indices[0].tolist(),
+                "image_ids": self.ids[indices[0]].tolist()
+            }
+        }
+    
+    def _predict_calibrated(self, distances: np.ndarray, indices: np.ndarray) -> Dict[str, Any]:
+        """Predict from calibrated distance-weighted votes, flagging low-confidence results."""
+        classes = self.label_encoder.classes_
+        vote_weights = self._vote_weights(indices)
+        probabilities = self.calibrator.predict_proba(distances, self.labels[indices], len(classes), vote_weights)[0]
+        top = int(np.argmax(probabilities))
+        confidence = float(probabilities[top])
+        
+        return {
+            "season": classes[top],
+            "confidence": confidence,
+            "probabilities": dict(zip(classes.tolist(), probabilities.tolist())),
+            "abstain": confidence < self.abstain_threshold,
+            "nearest_neighbors": {
+                "distances": distances[0].tolist(),
+                "indices": indices[0].tolist(),
+                "image_ids": self.ids[indices[0]].tolist()
+            }
+        }
+    
+    def _vote_weights(self, indices: np.ndarray) -> Optional[np.ndarray]:
+        """Votes of (n, k) neighbour lists when rows carry weights, or None if every neighbour votes once.
+        
+        A row of weight w counts as w neighbours, nearest first, until n_neighbors votes
+        are used up, so merged near-duplicates vote as the rows they replaced would have.
+        """
+        if self.weights is None:
+            return None
+        weights = self.weights[indices]
+        before = np.cumsum(weights, axis=1) - weights
+        return np.clip(self.n_neighbors - before, 0, weights)
+    
+    def _predict_weighted(self, distances: np.ndarray, indices: np.ndarray) -> Dict[str, Any]:
+        """Predict from votes of weighted rows (see _vote_weights)."""
+        classes = self.label_encoder.classes_
+        vote_weights = self._vote_weights(indices)[0]
+        probabilities = np.bincount(self.labels[indices[0]], weights=vote_weights, minlength=len(classes)) / vote_weights.sum()
+        top = int(np.argmax(probabilities))
+        
+        return {
+            "season": classes[top],
+            "confidence": probabilities[top],
+            "probabilities": dict(zip(classes.tolist(), probabilities.tolist())),
+            "nearest_neighbors": {
+                "distances": distances[0].tolist(),
+                "indices": indices[0].tolist(),
+                "image_ids": self.ids[indices[0]].tolist()
             }
         }
 
 
 class EnsembleClassifier(Classifier):
-    """Combine multiple classifiers for better performance."""
+    """Combine multiple classifiers for better performance.
     
-    def __init__(self, classifiers: List[Classifier], weights: Optional[List[float]] = None):
+    Members are fitted and queried concurrently on a thread pool; sklearn and NumPy
+    release the GIL for the heavy lifting, so members overlap instead of queueing.
+    """
+    
+    def __init__(self, classifiers: List[Classifier], weights: Optional[List[float]] = None, n_jobs: Optional[int] = None):
         self.classifiers = classifiers
-        self.weights = weights if weights else [1.0] * len(classifiers)
+        self.weights = np.asarray(weights if weights else [1.0] * len(classifiers), dtype=np.float64)
+        self.n_jobs = n_jobs or len(classifiers)
+        self._executor = None
+        self._classes = None
+        self._columns = []  # per member, the column of each member class in the shared label space
         self.is_fitted = False
     
+    def _map(self, fn, *iterables) -> List[Any]:
+        if self.n_jobs <= 1:
+            return list(map(fn, *iterables))
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.n_jobs, thread_name_prefix="ensemble")
+        return list(self._executor.map(fn, *iterables))
+    
+    def close(self) -> None:
+        """Shut down the member thread pool; it is recreated if the ensemble is used again."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+    
+    def __del__(self):
+        # Don't block garbage collection on running member calls
+        if getattr(self, "_executor", None) is not None:
+            self._executor.shutdown(wait=False)
+    
+    @property
+    def classes(self) -> np.ndarray:
+        return self._classes
+    
     def fit(self, features: np.ndarray, labels: List[str]) -> None:
-        """Fit all classifiers."""
-        for classifier in self.classifiers:
-            classifier.fit(features, labels)
+        """Fit all classifiers concurrently and build the shared label space."""
+        self._map(lambda classifier: classifier.fit(features, labels), self.classifiers)
+        
+        self._classes = np.unique(np.concatenate([np.asarray(c.classes) for c in self.classifiers]))
+        self._columns = [np.searchsorted(self._classes, c.classes) for c in self.classifiers]
         self.is_fitted = True
     
-    def predict(self, features: np.ndarray) -> Dict[str, Any]:
-        """Combine predictions from all classifiers."""
-        if not self.is_fitted:
-            raise ValueError("Ensemble classifier must be fitted before use")
-        
-        # Get predictions from all classifiers
-        predictions = [classifier.predict(features) for classifier in self.classifiers]
-        
-        # Combine predictions based on weights
-        combined_probabilities = {}
-        for i, pred in enumerate(predictions):
-            weight = self.weights[i]
-            for label, prob in pred["probabilities"].items():
-                if label in combined_probabilities:
-                    combined_probabilities[label] += prob * weight
-                else:
-                    combined_probabilities[label] = prob * weight
+    def _member_probabilities(self, features: np.ndarray) -> List[np.ndarray]:
+        return self._map(lambda classifier: classifier.predict_proba(features), self.classifiers)
+    
+    def _combine(self, member_probabilities: List[np.ndarray]) -> np.ndarray:
+        combined = np.zeros((len(member_probabilities[0]), len(self._classes)))
+        for weight, columns, probabilities in zip(self.weights, self._columns, member_probabilities):
+            combined[:, columns] += weight * probabilities
         
         # Normalize probabilities
-        total = sum(combined_probabilities.values())
-        if total > 0:
-            combined_probabilities = {k: v/total for k, v in combined_probabilities.items()}
+        totals = combined.sum(axis=1, keepdims=True)
+        return np.divide(combined, totals, out=combined, where=totals > 0)
+    
+    def predict_proba(self, features: np.ndarray) -> np.ndarray:
+        """Weighted average of member probabilities for a batch, aligned with classes."""
+        if not self.is_fitted:
+            raise ValueError("Ensemble classifier must be fitted before use")
+        return self._combine(self._member_probabilities(features))
+    
+    def predict_batch(self, features: np.ndarray) -> List[Dict[str, Any]]:
+        """Predict every row of a 2-D feature matrix."""
+        if not self.is_fitted:
+            raise ValueError("Ensemble classifier must be fitted before use")
         
-        # Find the label with highest probability
-        predicted_label = max(combined_probabilities.items(), key=lambda x: x[1])[0]
-        confidence = combined_probabilities[predicted_label]
+        member_probabilities = self._member_probabilities(np.atleast_2d(features))
+        combined = self._combine(member_probabilities)
+        top = combined.argmax(axis=1)
         
-        return {
-            "season": predicted_label,
-            "confidence": confidence,
-            "probabilities": combined_probabilities,
-            "individual_predictions": predictions
-        } 
\ No newline at end of file
+        results = []
+        for row, label_index in enumerate(top):
+            individual = []
+            for classifier, probabilities in zip(self.classifiers, member_probabilities):
+                member_top = int(probabilities[row].argmax())
+                individual.append({
+                    "season": classifier.classes[member_top],
+                    "confidence": float(probabilities[row, member_top])
+                })
+            results.append({
+                "season": self._classes[label_index],
+                "confidence": float(combined[row, label_index]),
+                "probabilities": dict(zip(self._classes.tolist(), combined[row].tolist())),
+                "individual_predictions": individual
+            })
+        return results
+    
+    def predict(self, features: np.ndarray) -> Dict[str, Any]:
+        """Combine predictions from all classifiers."""
+        return self.predict_batch(features.reshape(1, -1))[0]
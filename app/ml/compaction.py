@@ -0,0 +1,385 @@
+"""
+Compact the kNN index by dropping redundant embeddings.
+
+Updates only ever append rows, so the index fills up with near-identical embeddings
+of the same garment. Compaction works within each season:
+
+1. Near-duplicates (closer than a fraction of the median distance between rows)
+   are merged into their most central member, which gets their votes as its weight.
+2. Condensed nearest neighbours: the remaining rows are only kept if the rows kept so
+   far do not already vote for their season unanimously, so boundary examples stay
+   and the interior of each season is thinned out.
+
+Removed catalogue items stay reachable by id through an alias to their nearest kept row.
+The compacted index is published as a new checkpoint, so the original stays available,
+with its calibration refitted on distances to the kept rows.
+
+    python -m app.ml.compaction --merge-fraction 0.05 --out app/ml/ckpts/features_labels_compacted.npz
+"""
+import argparse
+import json
+import math
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, Tuple
+
+import numpy as np
+from sklearn.metrics import pairwise_distances
+from sklearn.neighbors import NearestNeighbors
+
+from app.ml.calibration import KNNCalibrator, default_calibration_path
+from app.ml.classifiers import NearestNeighborClassifier
+
+try:
+    import fcntl
+except ImportError:  # Windows: only compactions within one process are guarded
+    fcntl = None
+
+
+def typical_distance(features: np.ndarray, metric: str = "euclidean", sample_size: int = 2000, seed: int = 0) -> float:
+    """Median distance between random pairs of rows.
+
+    Unlike the nearest neighbour distance, this does not shrink as duplicates pile up.
+    """
+    rng = np.random.default_rng(seed)
+    first, second = rng.integers(0, len(features), size=(2, sample_size))
+    distances = pairwise_distances(features[first], features[second], metric=metric)
+    return float(np.median(np.diagonal(distances)))
+
+
+def merge_near_duplicates(features: np.ndarray, labels: np.ndarray, radius: float, metric: str = "euclidean") -> np.ndarray:
+    """For every row, the row standing in for it: itself, or the centre of its near-duplicate group.
+
+    Groups never cross seasons. Rows with the most neighbours within radius are taken
+    first, so each group is represented by a central member rather than an outlier.
+    """
+    representative = np.arange(len(features))
+    for label in np.unique(labels):
+        rows = np.flatnonzero(labels == label)
+        neighborhoods = NearestNeighbors(radius=radius, metric=metric).fit(features[rows]).radius_neighbors(
+            features[rows], return_distance=False
+        )
+        assigned = np.zeros(len(rows), dtype=bool)
+        for i in np.argsort([-len(neighborhood) for neighborhood in neighborhoods], kind="stable"):
+            if assigned[i]:
+                continue
+            group = neighborhoods[i][~assigned[neighborhoods[i]]]
+            assigned[group] = True
+            representative[rows[group]] = rows[i]
+    return representative
+
+
+def condense(
+    features: np.ndarray,
+    labels: np.ndarray,
+    candidates: np.ndarray,
+    n_neighbors: int,
+    min_agreement: float = 1.0,
+    metric: str = "euclidean",
+    chunk_size: int = 1024,
+    max_passes: int = 2,
+    seed: int = 0
+) -> np.ndarray:
+    """Condensed nearest neighbours over the candidate rows; returns a keep mask over all rows.
+
+    A candidate is dropped when at least min_agreement of its n_neighbors nearest kept
+    rows share its season, i.e. the kept rows already classify it confidently. Candidates
+    are checked a chunk at a time against the rows kept before that chunk.
+    """
+    rng = np.random.default_rng(seed)
+    keep = np.zeros(len(features), dtype=bool)
+    # Start with a few rows of every season so each season can receive votes
+    for label in np.unique(labels[candidates]):
+        rows = candidates[labels[candidates] == label]
+        keep[rng.choice(rows, size=min(n_neighbors, len(rows)), replace=False)] = True
+
+    for _ in range(max_passes):
+        added = 0
+        pending = rng.permutation(candidates[~keep[candidates]])
+        for start in range(0, len(pending), chunk_size):
+            chunk = pending[start:start + chunk_size]
+            kept = np.flatnonzero(keep)
+            k = min(n_neighbors, len(kept))
+            _, indices = NearestNeighbors(n_neighbors=k, metric=metric).fit(features[kept]).kneighbors(features[chunk])
+            # Count agreeing neighbours as integers; summed 1/k shares of a unanimous vote can fall short of 1.0
+            agreeing = np.sum(labels[kept][indices] == labels[chunk][:, None], axis=1)
+            boundary = chunk[agreeing < math.ceil(min_agreement * k - 1e-9)]
+            keep[boundary] = True
+            added += len(boundary)
+        if not added:
+            break
+    return keep
+
+
+def compact_classifier(
+    classifier: NearestNeighborClassifier,
+    merge_fraction: float = 0.05,
+    condense_rows: bool = True,
+    min_agreement: float = 1.0,
+    seed: int = 0
+) -> NearestNeighborClassifier:
+    """Return a new classifier over the compacted rows, with the same settings.
+
+    merge_fraction is the near-duplicate radius as a fraction of the median distance
+    between rows (see typical_distance). A calibration is refitted (see refit_calibration),
+    since it was fitted on distances to the uncompacted index.
+    """
+    features, labels, metric = classifier.features, classifier.labels, classifier.metric
+    representative = merge_near_duplicates(features, labels, merge_fraction * typical_distance(features, metric), metric)
+    candidates = np.unique(representative)
+    if condense_rows:
+        keep = condense(features, labels, candidates, classifier.n_neighbors, min_agreement, metric, seed=seed)
+    else:
+        keep = np.zeros(len(features), dtype=bool)
+        keep[candidates] = True
+    kept = np.flatnonzero(keep)
+    # A merged row votes for all the near-duplicates it replaced
+    weights = classifier.weights if classifier.weights is not None else np.ones(len(features))
+    merged_weights = np.bincount(representative, weights=weights, minlength=len(features))
+
+    compacted = NearestNeighborClassifier(n_neighbors=classifier.n_neighbors, metric=metric)
+    compacted.fit(
+        features[kept],
+        classifier.label_encoder.inverse_transform(labels[kept]),
+        ids=classifier.ids[kept],
+        weights=merged_weights[kept]
+    )
+
+    # Every removed row is stood in for by the nearest kept row of its season
+    stand_in = np.full(len(features), -1)
+    stand_in[kept] = np.arange(len(kept))
+    for label in np.unique(labels):
+        kept_rows = kept[labels[kept] == label]
+        dropped = np.flatnonzero(~keep & (labels == label))
+        if len(dropped):
+            _, nearest = NearestNeighbors(n_neighbors=1, metric=metric).fit(features[kept_rows]).kneighbors(features[dropped])
+            stand_in[dropped] = stand_in[kept_rows[nearest[:, 0]]]
+
+    dropped = np.flatnonzero(~keep & (classifier.ids >= 0))
+    aliases = {image_id: int(stand_in[row]) for image_id, row in classifier.aliases.items()}
+    aliases.update(zip(classifier.ids[dropped].tolist(), stand_in[dropped].tolist()))
+    compacted.aliases = aliases
+
+    if classifier.calibrator is not None:
+        own_rows = np.full(len(features), -1)
+        own_rows[kept] = np.arange(len(kept))
+        compacted.calibrator = refit_calibration(compacted, features, labels, own_rows, classifier.calibrator, seed=seed)
+        compacted.abstain_threshold = classifier.abstain_threshold
+    return compacted
+
+
+def refit_calibration(
+    compacted: NearestNeighborClassifier,
+    features: np.ndarray,
+    labels: np.ndarray,
+    own_rows: np.ndarray,
+    calibrator: KNNCalibrator,
+    sample_size: int = 5000,
+    seed: int = 0
+) -> KNNCalibrator:
+    """Fit a calibrator like the given one on the compacted index, keeping its abstain threshold.
+
+    The queries are a sample of all the original rows, not only the kept ones (mostly
+    season boundaries), so the fit sees the same mix of easy and hard queries as before.
+    own_rows maps each original row to its row in the compacted index, or -1 if it was
+    dropped; kept rows are queried leave-one-out.
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.permutation(len(features))[:sample_size]
+    k = min(compacted.n_neighbors, len(compacted.features) - 1)
+    distances, indices = compacted.model.kneighbors(features[rows], n_neighbors=k + 1)
+    # Drop each kept row's own entry, or the furthest neighbour if it is not in the list
+    keep = indices != own_rows[rows][:, None]
+    keep[keep.sum(axis=1) > k, -1] = False
+    distances = distances[keep].reshape(len(rows), -1)
+    neighbor_labels = compacted.labels[indices[keep].reshape(len(rows), -1)]
+
+    refitted = KNNCalibrator(calibrator.method).fit(distances, neighbor_labels, labels[rows], len(compacted.classes))
+    refitted.abstain_threshold = calibrator.abstain_threshold
+    return refitted
+
+
+def evaluate_index(classifier: NearestNeighborClassifier, features: np.ndarray, labels: np.ndarray, n_latency: int = 100) -> Dict[str, Any]:
+    """Size, accuracy on the given queries and median single-query latency of an index."""
+    predicted = classifier.classes[classifier.predict_proba(features).argmax(axis=1)]
+    durations = []
+    for query in features[:n_latency]:
+        start = time.perf_counter()
+        classifier.predict(query)
+        durations.append(time.perf_counter() - start)
+    return {
+        "rows": int(len(classifier.features)),
+        "megabytes": classifier.features.nbytes / 1e6,
+        "accuracy": float(np.mean(predicted == labels)),
+        "latency_ms": float(np.median(durations) * 1000)
+    }
+
+
+def compaction_report(
+    classifier: NearestNeighborClassifier,
+    holdout_fraction: float = 0.1,
+    seed: int = 0,
+    **kwargs
+) -> Dict[str, Any]:
+    """Compare the index before and after compaction on rows held out of both.
+
+    The held-out rows are removed first, the rest is compacted with kwargs (see
+    compact_classifier), and both indexes classify the held-out rows.
+    """
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(classifier.features))
+    n_holdout = max(1, int(len(order) * holdout_fraction))
+    holdout, train = np.sort(order[:n_holdout]), np.sort(order[n_holdout:])
+
+    season_names = classifier.label_encoder.inverse_transform(classifier.labels)
+    before = NearestNeighborClassifier(n_neighbors=classifier.n_neighbors, metric=classifier.metric)
+    before.fit(
+        classifier.features[train],
+        season_names[train],
+        ids=classifier.ids[train],
+        weights=classifier.weights[train] if classifier.weights is not None else None
+    )
+    start = time.perf_counter()
+    after = compact_classifier(before, seed=seed, **kwargs)
+    seconds = time.perf_counter() - start
+
+    queries, query_labels = classifier.features[holdout], season_names[holdout]
+    return {
+        "holdout_rows": int(n_holdout),
+        "compaction_seconds": seconds,
+        "before": evaluate_index(before, queries, query_labels),
+        "after": evaluate_index(after, queries, query_labels)
+    }
+
+
+def compacted_model_name(model_name: str) -> str:
+    """A new checkpoint name for a compacted model, e.g. features_labels_compacted_20260101120000."""
+    base = model_name.split("_compacted_")[0]
+    return f"{base}_compacted_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+
+
+def publish_checkpoint(classifier: NearestNeighborClassifier, path: str) -> None:
+    """Write a checkpoint and its calibration, if any, renaming each into place so readers never see a partial file."""
+    if classifier.calibrator is not None:
+        calibration_path = default_calibration_path(path)
+        classifier.calibrator.save(calibration_path + ".tmp")
+        os.replace(calibration_path + ".tmp", calibration_path)
+    tmp_path = f"{os.path.splitext(path)[0]}.tmp.npz"
+    classifier.save(tmp_path)
+    os.replace(tmp_path, path)
+
+
+class CompactionState:
+    """Guard and status of the background compaction, shared by every worker through files in one directory.
+
+    compaction.lock is flocked while a compaction runs, so the guard is released if its worker
+    dies; compaction.json holds whether one is running, when the last one finished and its report.
+    """
+
+    def __init__(self, directory: str):
+        self.lock_path = os.path.join(directory, "compaction.lock")
+        self.status_path = os.path.join(directory, "compaction.json")
+        self._lock_file = None
+
+    def _lock_held(self) -> bool:
+        if fcntl is None:
+            return self._lock_file is not None
+        with open(self.lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return False
+
+    def read(self) -> Dict[str, Any]:
+        try:
+            with open(self.status_path) as f:
+                status = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            status = {"running": False, "report": None}
+        # A worker that died mid-compaction leaves running set but releases the lock
+        status["running"] = status.get("running", False) and self._lock_held()
+        return status
+
+    def _write(self, status: Dict[str, Any]) -> None:
+        tmp_path = self.status_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(status, f, indent=2)
+        os.replace(tmp_path, self.status_path)
+
+    def try_start(self, model_version: str) -> bool:
+        """Take the guard for a new compaction, or return False if one is already running in any worker."""
+        if self._lock_file is not None:
+            return False
+        lock_file = open(self.lock_path, "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return False
+        self._lock_file = lock_file
+        status = self.read()
+        status.update(running=True, model_version=model_version, started_at=time.time(), pid=os.getpid())
+        self._write(status)
+        return True
+
+    def finish(self, report: Dict[str, Any]) -> None:
+        """Record the report of the compaction started by try_start and release the guard."""
+        try:
+            status = self.read()
+            status.update(running=False, finished_at=time.time(), report=report)
+            self._write(status)
+        finally:
+            self._lock_file.close()  # closing releases the flock
+            self._lock_file = None
+
+
+def compact_and_report(
+    classifier: NearestNeighborClassifier,
+    holdout_fraction: float = 0.1,
+    **kwargs
+) -> Tuple[NearestNeighborClassifier, Dict[str, Any]]:
+    """Compact the whole index and report what compaction does to a held-out sample."""
+    report = compaction_report(classifier, holdout_fraction, **kwargs)
+    compacted = compact_classifier(classifier, **kwargs)
+    report["published_rows"] = int(len(compacted.features))
+    report["original_rows"] = int(len(classifier.features))
+    return compacted, report
+
+
+def main() -> None:
+    from app.core.config import settings
+    from app.ml.pipeline import load_knn_classifier
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkpoint", default=settings.KNN_CHECKPOINT_PATH)
+    parser.add_argument("--merge-fraction", type=float, default=settings.COMPACTION_MERGE_FRACTION,
+                        help="Near-duplicate radius as a fraction of the median distance between rows")
+    parser.add_argument("--min-agreement", type=float, default=settings.COMPACTION_MIN_AGREEMENT,
+                        help="Share of kept neighbours that must agree for a row to be dropped")
+    parser.add_argument("--no-condense", action="store_true", help="Only merge near-duplicates")
+    parser.add_argument("--holdout-fraction", type=float, default=0.1)
+    parser.add_argument("--out", default=None, help="Publish the compacted checkpoint to this new file")
+    args = parser.parse_args()
+    if args.out and os.path.abspath(args.out) == os.path.abspath(args.checkpoint):
+        parser.error("--out must not overwrite --checkpoint; the rows compaction drops cannot be recovered")
+
+    classifier = load_knn_classifier(args.checkpoint)
+    compacted, report = compact_and_report(
+        classifier,
+        args.holdout_fraction,
+        merge_fraction=args.merge_fraction,
+        condense_rows=not args.no_condense,
+        min_agreement=args.min_agreement
+    )
+    print(json.dumps(report, indent=2))
+    if args.out:
+        publish_checkpoint(compacted, args.out)
+        print(f"Published {len(compacted.features)} rows to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""
+Evaluate classifier and reduction settings on cached embeddings.
+
+Images are embedded once per (preprocessing, extractor, dataset) and the matrix is
+cached, so a sweep only re-runs the cheap part: every combination of n_neighbors,
+metric and PCA dimensions is cross-validated on the cached matrix in parallel.
+
+    python -m app.ml.evaluation --images-dir data/labelled --n-neighbors 3 5 9 --pca 0 128
+    python -m app.ml.evaluation --database --segmentation-backend contour
+    python -m app.ml.evaluation --checkpoint app/ml/ckpts/features_labels.npz
+"""
+import argparse
+import hashlib
+import io
+import itertools
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from joblib import Parallel, delayed
+from PIL import Image
+from sklearn.decomposition import PCA
+from sklearn.model_selection import KFold, StratifiedKFold
+
+from app.core.config import settings
+from app.ml.classifiers import NearestNeighborClassifier
+from app.ml.pipeline import PradaClassificationPipeline
+
+
+logger = logging.getLogger(__name__)
+
+# Images loaded and embedded at a time
+EMBED_CHUNK_SIZE = 64
+
+
+def describe_pipeline(pipeline: PradaClassificationPipeline) -> Dict[str, Any]:
+    """The preprocessing and extractor settings that determine the embeddings."""
+    def describe(component) -> Dict[str, Any]:
+        description = {"type": type(component).__name__}
+        for name, value in vars(component).items():
+            if isinstance(value, (int, float, str, bool, tuple)) and name != "batch_size":
+                description[name] = value
+        backend = getattr(component, "backend", None)
+        if backend is not None:
+            description["backend"] = backend.cache_key
+        return description
+
+    return {
+        "preprocessors": [describe(p) for p in pipeline.preprocessing_pipeline.preprocessors],
+        "extractors": [describe(e) for e in pipeline.feature_extractors],
+    }
+
+
+class EmbeddingCache:
+    """Embedding matrices on disk, keyed by pipeline description and dataset fingerprint."""
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def key(description: Dict[str, Any], fingerprint: Iterable[str]) -> str:
+        digest = hashlib.blake2b(json.dumps(description, sort_keys=True).encode(), digest_size=16)
+        for item in fingerprint:
+            digest.update(item.encode())
+            digest.update(b"\n")
+        return digest.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def get(self, key: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        if not os.path.exists(self.path(key)):
+            return None
+        cached = np.load(self.path(key))
+        return cached["X"], cached["y"]
+
+    def put(self, key: str, features: np.ndarray, labels: np.ndarray) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Write then rename so an interrupted run never leaves a truncated entry
+        tmp_path = self.path(key) + ".tmp.npz"
+        np.savez(tmp_path, X=features, y=labels)
+        os.replace(tmp_path, self.path(key))
+
+
+def embed_cached(
+    pipeline: PradaClassificationPipeline,
+    items: List[Tuple[str, str]],
+    load: Callable[[str], Image.Image],
+    cache: EmbeddingCache
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Embed (source, label) items with the pipeline, or return the cached matrix.
+
+    load turns a source (a file path or storage key) into an image.
+    """
+    key = cache.key(describe_pipeline(pipeline), (f"{source}\t{label}" for source, label in items))
+    cached = cache.get(key)
+    if cached is not None:
+        logger.info(f"Using cached embeddings {cache.path(key)}")
+        return cached
+
+    features, labels = [], []
+    start = time.perf_counter()
+    for offset in range(0, len(items), EMBED_CHUNK_SIZE):
+        chunk = items[offset:offset + EMBED_CHUNK_SIZE]
+        images, chunk_labels = [], []
+        for source, label in chunk:
+            try:
+                images.append(load(source))
+                chunk_labels.append(label)
+            except Exception as e:
+                logger.warning(f"Failed to load {source}: {str(e)}")
+        if images:
+            features.append(pipeline.embed_batch(images))
+            labels.extend(chunk_labels)
+        logger.info(f"Embedded {min(offset + EMBED_CHUNK_SIZE, len(items))}/{len(items)} images")
+
+    features, labels = np.vstack(features), np.array(labels)
+    logger.info(f"Embedding took {time.perf_counter() - start:.1f}s")
+    cache.put(key, features, labels)
+    return features, labels
+
+
+def sweep_configs(n_neighbors: List[int], metrics: List[str], pca_dims: List[int]) -> List[Dict[str, Any]]:
+    """Every combination of the given settings; a PCA dimension of 0 means no reduction."""
+    return [
+        {"n_neighbors": k, "metric": metric, "pca": pca}
+        for k, metric, pca in itertools.product(n_neighbors, metrics, pca_dims)
+    ]
+
+
+def _fit(features: np.ndarray, labels: np.ndarray, config: Dict[str, Any]) -> Tuple[Optional[PCA], NearestNeighborClassifier]:
+    pca = None
+    if config["pca"]:
+        pca = PCA(n_components=min(config["pca"], *features.shape)).fit(features)
+        features = pca.transform(features)
+    classifier = NearestNeighborClassifier(n_neighbors=config["n_neighbors"], metric=config["metric"])
+    classifier.fit(features, labels)
+    return pca, classifier
+
+
+def cross_validate(features: np.ndarray, labels: np.ndarray, config: Dict[str, Any], n_splits: int = 5, seed: int = 0) -> Dict[str, Any]:
+    """Mean and spread of accuracy over folds; PCA is fitted on each training fold only."""
+    _, counts = np.unique(labels, return_counts=True)
+    if counts.min() >= n_splits:
+        folds = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=seed).split(features, labels)
+    else:
+        folds = KFold(n_splits=n_splits, shuffle=True, random_state=seed).split(features)
+
+    accuracies = []
+    for train, test in folds:
+        pca, classifier = _fit(features[train], labels[train], config)
+        test_features = pca.transform(features[test]) if pca is not None else features[test]
+        predicted = classifier.classes[classifier.predict_proba(test_features).argmax(axis=1)]
+        accuracies.append(float(np.mean(predicted == labels[test])))
+
+    return {**config, "accuracy": float(np.mean(accuracies)), "accuracy_std": float(np.std(accuracies))}
+
+
+def measure_latency(features: np.ndarray, labels: np.ndarray, config: Dict[str, Any], n_queries: int = 50) -> float:
+    """Median milliseconds for reduction plus classification of one query against the full matrix."""
+    pca, classifier = _fit(features, labels, config)
+    durations = []
+    for query in features[:n_queries]:
+        start = time.perf_counter()
+        reduced = pca.transform(query.reshape(1, -1))[0] if pca is not None else query
+        classifier.predict(reduced)
+        durations.append(time.perf_counter() - start)
+    return float(np.median(durations) * 1000)
+
+
+def run_sweep(
+    features: np.ndarray,
+    labels: np.ndarray,
+    configs: List[Dict[str, Any]],
+    n_splits: int = 5,
+    n_jobs: int = -1
+) -> List[Dict[str, Any]]:
+    """Cross-validate all configs in parallel, then time each one serially so latencies are comparable."""
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(cross_validate)(features, labels, config, n_splits) for config in configs
+    )
+    for result, config in zip(results, configs):
+        result["latency_ms"] = measure_latency(features, labels, config)
+    return sorted(results, key=lambda result: (-result["accuracy"], result["latency_ms"]))
+
+
+def _load_file(path: str) -> Image.Image:
+    with Image.open(path) as image:
+        return image.convert("RGB")
+
+
+def _images_dir_items(path: str) -> List[Tuple[str, str]]:
+    items = []
+    for season in sorted(os.listdir(path)):
+        season_dir = os.path.join(path, season)
+        if os.path.isdir(season_dir):
+            items.extend((os.path.join(season_dir, name), season) for name in sorted(os.listdir(season_dir)))
+    return items
+
+
+def _database_items() -> List[Tuple[str, str]]:
+    from app.db.session import SessionLocal
+    from app.services.data_service import DataService
+
+    db = SessionLocal()
+    try:
+        return [(image_path, season) for _, image_path, season in DataService(db).iter_training_data()]
+    finally:
+        db.close()
+
+
+def _load_from_storage(key: str) -> Image.Image:
+    from app.core.storage import get_storage
+
+    return Image.open(io.BytesIO(get_storage().read_bytes(key))).convert("RGB")
+
+
+def main() -> None:
+    from app.ml.feature_extraction import ResNetFeatureExtractor
+    from app.ml.pipeline import create_default_preprocessors
+    from app.ml.preprocessing import BackgroundRemovalPreprocessor
+    from app.ml.segmentation import create_segmentation_backend
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--images-dir", help="Labelled <season>/<image> folders")
+    source.add_argument("--database", action="store_true", help="All non-duplicate images in the database")
+    source.add_argument("--checkpoint", help="A kNN checkpoint whose stored embeddings are used as-is")
+    parser.add_argument("--segmentation-backend", default=None, help="Preprocess with this backend instead of the configured one")
+    parser.add_argument("--model-name", default="resnet50", choices=["resnet50", "resnet101"])
+    parser.add_argument("--n-neighbors", nargs="+", type=int, default=[1, 3, 5, 9, 15])
+    parser.add_argument("--metrics", nargs="+", default=["euclidean", "cosine", "manhattan"])
+    parser.add_argument("--pca", nargs="+", type=int, default=[0, 64, 256], help="PCA dimensions; 0 for none")
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--jobs", type=int, default=-1, help="Parallel workers for the sweep (-1 for all cores)")
+    parser.add_argument("--out", default=None, help="Write the report to this JSON file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.checkpoint:
+        checkpoint = np.load(args.checkpoint)
+        features, labels = checkpoint["X"], checkpoint["y"]
+        description = {"checkpoint": args.checkpoint}
+    else:
+        if args.segmentation_backend:
+            preprocessors = [BackgroundRemovalPreprocessor(backend=create_segmentation_backend(args.segmentation_backend))]
+        else:
+            preprocessors = create_default_preprocessors()
+        pipeline = PradaClassificationPipeline(
+            preprocessors=preprocessors,
+            feature_extractors=[ResNetFeatureExtractor(model_name=args.model_name, pretrained=settings.RESNET_PRETRAINED)]
+        )
+        description = describe_pipeline(pipeline)
+        if args.images_dir:
+            items, load = _images_dir_items(args.images_dir), _load_file
+        else:
+            items, load = _database_items(), _load_from_storage
+        features, labels = embed_cached(pipeline, items, load, EmbeddingCache(settings.EMBEDDING_CACHE_DIR))
+
+    start = time.perf_counter()
+    results = run_sweep(features, labels, sweep_configs(args.n_neighbors, args.metrics, args.pca), args.folds, args.jobs)
+    logger.info(f"Swept {len(results)} configurations in {time.perf_counter() - start:.1f}s")
+
+    print(f"{'n_neighbors':>11} {'metric':>10} {'pca':>5} {'accuracy':>9} {'std':>6} {'latency_ms':>10}")
+    for result in results:
+        print(
+            f"{result['n_neighbors']:>11} {result['metric']:>10} {result['pca'] or '-':>5} "
+            f"{result['accuracy']:>9.3f} {result['accuracy_std']:>6.3f} {result['latency_ms']:>10.2f}"
+        )
+    if args.out:
+        os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump({"embeddings": description, "n_samples": len(labels), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
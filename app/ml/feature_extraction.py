@@ -9,6 +9,26 @@ import torchvision.transforms as transforms
 from PIL import Image
 from sklearn.decomposition import PCA
 
+
+# Side of the square crop the CNN extractors see
+CROP_SIZE = 224
+
+
+def center_crop(image: Union[Image.Image, np.ndarray], size: int = CROP_SIZE) -> np.ndarray:
+    """Return the size x size RGB uint8 centre crop that ResNetFeatureExtractor feeds its model."""
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    return np.asarray(transforms.CenterCrop(size)(image.convert('RGB')))
+
+
+def fit_crop(image: Union[Image.Image, np.ndarray], size: int = CROP_SIZE) -> np.ndarray:
+    """Scale an image so its longer side is size and pad it to a size x size crop, keeping all of it."""
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    scale = size / max(image.width, image.height)
+    image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.BILINEAR)
+    return center_crop(image, size)
+
 # TODO: Use any of these?
 class FeatureExtractor(ABC):
     """Base class for feature extraction methods."""
@@ -17,6 +37,10 @@ class FeatureExtractor(ABC):
     def extract(self, image: Union[Image.Image, np.ndarray]) -> np.ndarray:
         """Extract features from the input image."""
         pass
+    
+    def extract_batch(self, images: List[Union[Image.Image, np.ndarray]]) -> np.ndarray:
+        """Extract features from a list of images into an (n_images, n_features) array."""
+        return np.array([self.extract(image) for image in images])
 
 
 class ColorHistogramExtractor(FeatureExtractor):
@@ -45,13 +69,16 @@ class ColorHistogramExtractor(FeatureExtractor):
 class ResNetFeatureExtractor(FeatureExtractor):
     """Extract features using a pre-trained ResNet model."""
     
-    def __init__(self, model_name: str = "resnet50", layer: str = "avgpool"):
+    def __init__(self, model_name: str = "resnet50", layer: str = "avgpool", pretrained: bool = True, batch_size: int = 32):
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.model_name = model_name
+        self.pretrained = pretrained
+        self.batch_size = batch_size
         self.model = self._load_model(model_name)
         self.layer = layer
         self.transform = transforms.Compose([
             # transforms.Resize(256),
-            transforms.CenterCrop(224),
+            transforms.CenterCrop(CROP_SIZE),
             transforms.ToTensor(),
             transforms.Normalize(
                 mean=[0.485, 0.456, 0.406],
@@ -60,10 +87,12 @@ class ResNetFeatureExtractor(FeatureExtractor):
         ])
     
     def _load_model(self, model_name: str) -> nn.Module:
+        # IMAGENET1K_V1 is what pretrained=True loaded; the stored checkpoint embeddings were made with it.
+        # Random weights are only useful offline, e.g. for benchmarks
         if model_name == "resnet50":
-            model = models.resnet50(pretrained=True)
+            model = models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V1 if self.pretrained else None)
         elif model_name == "resnet101":
-            model = models.resnet101(pretrained=True)
+            model = models.resnet101(weights=models.ResNet101_Weights.IMAGENET1K_V1 if self.pretrained else None)
         else:
             raise ValueError(f"Unsupported model: {model_name}")
         
@@ -89,6 +118,24 @@ class ResNetFeatureExtractor(FeatureExtractor):
         # Flatten features
         features = features.squeeze().cpu().numpy()
         return features
+    
+    def extract_batch(self, images: List[Union[Image.Image, np.ndarray]]) -> np.ndarray:
+        """Extract features with one forward pass per batch_size images."""
+        features = []
+        for start in range(0, len(images), self.batch_size):
+            batch = []
+            for image in images[start:start + self.batch_size]:
+                if isinstance(image, np.ndarray):
+                    image = Image.fromarray(image)
+                batch.append(self.transform(image.convert('RGB')))
+            
+            with torch.no_grad():
+                output = self.model(torch.stack(batch).to(self.device))
+            features.append(output.flatten(1).cpu().numpy())
+        
+        if not features:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.concatenate(features)
 
 
 class PCAFeatureExtractor(FeatureExtractor):
@@ -102,8 +149,7 @@ class PCAFeatureExtractor(FeatureExtractor):
     
     def fit(self, images: List[Union[Image.Image, np.ndarray]]) -> None:
         """Fit PCA on a list of images."""
-        features = [self.base_extractor.extract(img) for img in images]
-        features = np.array(features)
+        features = self.base_extractor.extract_batch(images)
         self.pca.fit(features)
         self.is_fitted = True
     
@@ -113,6 +159,12 @@ class PCAFeatureExtractor(FeatureExtractor):
         
         features = self.base_extractor.extract(image)
         return self.pca.transform(features.reshape(1, -1)).flatten()
+    
+    def extract_batch(self, images: List[Union[Image.Image, np.ndarray]]) -> np.ndarray:
+        if not self.is_fitted:
+            raise ValueError("PCA extractor must be fitted before use")
+        
+        return self.pca.transform(self.base_extractor.extract_batch(images))
 
 
 class FeatureExtractionPipeline:
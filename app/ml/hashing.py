@@ -0,0 +1,105 @@
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+def _to_gray(image: Union[Image.Image, np.ndarray]) -> np.ndarray:
+    if isinstance(image, Image.Image):
+        return np.asarray(image.convert("L"))
+    if image.ndim == 3:
+        return cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    return image
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), "big")
+
+
+def phash(image: Union[Image.Image, np.ndarray], hash_size: int = 8, highfreq_factor: int = 4) -> int:
+    """Perceptual hash: sign of the low-frequency DCT coefficients against their median."""
+    size = hash_size * highfreq_factor
+    gray = cv2.resize(_to_gray(image), (size, size), interpolation=cv2.INTER_AREA)
+    dct = cv2.dct(gray.astype(np.float32))[:hash_size, :hash_size]
+    return _bits_to_int(dct > np.median(dct))
+
+
+def hamming(a: int, b: int) -> int:
+    """Number of differing bits between two hashes."""
+    return (a ^ b).bit_count()
+
+
+def hash_to_hex(value: int, hash_size: int = 8) -> str:
+    return f"{value:0{hash_size * hash_size // 4}x}"
+
+
+def hex_to_hash(value: str) -> int:
+    return int(value, 16)
+
+
+class MultiIndexHashTable:
+    """Multi-index hashing over integer hashes with the Hamming metric.
+
+    Each hash is split into max_distance + 1 disjoint substrings, each indexed in
+    its own table. By the pigeonhole principle any hash within max_distance of a
+    query matches it exactly on at least one substring, so a lookup only checks
+    the few candidates sharing a substring instead of the whole collection.
+    """
+
+    def __init__(self, max_distance: int = 4, bits: int = 64):
+        self.max_distance = max_distance
+        self.size = 0
+
+        n_chunks = max_distance + 1
+        self.chunks = []
+        shift = 0
+        for i in range(n_chunks):
+            width = bits // n_chunks + (1 if i < bits % n_chunks else 0)
+            self.chunks.append((shift, (1 << width) - 1))
+            shift += width
+        self.tables: List[Dict[int, List[Tuple[int, int]]]] = [{} for _ in self.chunks]
+
+    def add(self, value: int, item_id: int) -> None:
+        self.size += 1
+        for table, (shift, mask) in zip(self.tables, self.chunks):
+            table.setdefault((value >> shift) & mask, []).append((value, item_id))
+
+    def search(self, value: int, max_distance: int) -> List[Tuple[int, int]]:
+        """Return (distance, item_id) pairs within max_distance, closest first."""
+        if max_distance > self.max_distance:
+            raise ValueError(f"Table was built for distances up to {self.max_distance}")
+
+        matches = set()
+        for table, (shift, mask) in zip(self.tables, self.chunks):
+            for candidate, item_id in table.get((value >> shift) & mask, ()):
+                distance = hamming(value, candidate)
+                if distance <= max_distance:
+                    matches.add((distance, item_id))
+        return sorted(matches)
+
+    def __len__(self) -> int:
+        return self.size
+
+
+class PerceptualHashIndex:
+    """Thread-safe index of image hashes for duplicate lookups."""
+
+    def __init__(self, items: Optional[Iterable[Tuple[int, int]]] = None, max_distance: int = 4):
+        self.table = MultiIndexHashTable(max_distance=max_distance)
+        self._lock = threading.Lock()
+        for item_id, value in items or []:
+            self.add(item_id, value)
+
+    def add(self, item_id: int, value: int) -> None:
+        with self._lock:
+            self.table.add(value, item_id)
+
+    def find(self, value: int, max_distance: int = 0) -> List[Tuple[int, int]]:
+        """Return (distance, item_id) pairs of indexed images within max_distance."""
+        with self._lock:
+            return self.table.search(value, max_distance)
+
+    def __len__(self) -> int:
+        return len(self.table)
@@ -1,11 +1,18 @@
+import os
+import time
 from typing import Any, Dict, List, Optional, Union
 
 import numpy as np
 from PIL import Image
 
+from app.ml.augmentation import TestTimeAugmentation
+from app.ml.calibration import KNNCalibrator, default_calibration_path
 from app.ml.classifiers import Classifier, NearestNeighborClassifier, EnsembleClassifier
-from app.ml.feature_extraction import FeatureExtractor, ResNetFeatureExtractor, PCAFeatureExtractor
+from app.ml.feature_extraction import FeatureExtractor, ResNetFeatureExtractor, PCAFeatureExtractor, center_crop, fit_crop
 from app.ml.preprocessing import ImagePreprocessor, ResizePreprocessor, BackgroundRemovalPreprocessor, NormalizePreprocessor, PreprocessingPipeline
+from app.ml.segmentation import MaskCache, create_segmentation_backend, propose_regions, to_rgb_array
+from app.core.config import settings
+from app.core.metrics import BATCH_SIZE, stage_timer
 
 
 class PradaClassificationPipeline:
@@ -16,6 +23,8 @@ class PradaClassificationPipeline:
         preprocessors: Optional[List[ImagePreprocessor]] = None,
         feature_extractors: Optional[List[FeatureExtractor]] = None,
         classifier: Optional[Classifier] = None,
+        version: str = "untrained",
+        tta: Optional[TestTimeAugmentation] = None,
         # pretrained: Optional[bool] = False
     ):
         # Default preprocessors
@@ -39,12 +48,17 @@ class PradaClassificationPipeline:
         self.preprocessing_pipeline = PreprocessingPipeline(preprocessors)
         self.feature_extractors = feature_extractors
         self.classifier = classifier
+        self.version = version  # reported as the model_version label on metrics
+        self.tta = tta  # used by predict unless a call opts out
+        self.revision = 0  # bumped whenever the classifier changes, so cached results go stale
         self.is_fitted = False
     
     def fit(self, images: List[Union[Image.Image, np.ndarray]], labels: List[str]) -> None:
         """Fit the pipeline on training data."""
+        BATCH_SIZE.observe(len(images), stage="fit")
+        
         # Preprocess images
-        processed_images = [self.preprocessing_pipeline.process(img) for img in images]
+        processed_images = self.preprocessing_pipeline.process_batch(images)
         
         # Extract features
         features_list = []
@@ -53,8 +67,7 @@ class PradaClassificationPipeline:
                 # PCA extractor needs to be fitted first
                 extractor.fit(processed_images)
             
-            extractor_features = [extractor.extract(img) for img in processed_images]
-            features_list.append(np.array(extractor_features))
+            features_list.append(extractor.extract_batch(processed_images))
         
         # Combine features
         features = np.hstack(features_list)
@@ -62,30 +75,190 @@ class PradaClassificationPipeline:
         # Fit classifier
         self.classifier.fit(features, labels)
         self.is_fitted = True
+        self.revision += 1
     
-    def predict(self, image: Union[Image.Image, np.ndarray]) -> Dict[str, Any]:
-        """Make a prediction on a single image."""
-        # if not self.is_fitted:
-        #     raise ValueError("Pipeline must be fitted before use")
+    def embed_batch(self, images: List[Union[Image.Image, np.ndarray]], timings: Optional[Dict[str, float]] = None) -> np.ndarray:
+        """Preprocess a list of images and return an (n_images, n_features) array."""
+        BATCH_SIZE.observe(len(images), stage="embed")
+        
+        with stage_timer("preprocess", self.version, timings):
+            processed_images = self.preprocessing_pipeline.process_batch(images)
+        
+        with stage_timer("extract", self.version, timings):
+            features_list = [extractor.extract_batch(processed_images) for extractor in self.feature_extractors]
+        
+        return np.hstack(features_list)
+    
+    def embed_crops(self, crops: np.ndarray, timings: Optional[Dict[str, float]] = None) -> np.ndarray:
+        """Embed already preprocessed CROP_SIZE crops (see center_crop), skipping the preprocessing stage."""
+        BATCH_SIZE.observe(len(crops), stage="embed")
+        
+        with stage_timer("extract", self.version, timings):
+            features_list = [extractor.extract_batch(list(crops)) for extractor in self.feature_extractors]
+        
+        return np.hstack(features_list)
+    
+    def fit_features(self, features: np.ndarray, labels: List[str], ids: Optional[List[int]] = None) -> None:
+        """Fit the classifier on precomputed features, e.g. embedded chunk by chunk."""
+        if isinstance(self.classifier, NearestNeighborClassifier):
+            self.classifier.fit(features, labels, ids=ids)
+        else:
+            self.classifier.fit(features, labels)
+        self.is_fitted = True
+        self.revision += 1
+    
+    def swap_classifier(self, classifier: Classifier, version: str) -> None:
+        """Replace the fitted classifier, e.g. with another checkpoint, while requests are being served."""
+        self.classifier = classifier
+        self.version = version
+        self.is_fitted = True
+        self.revision += 1
+    
+    def embed(self, image: Union[Image.Image, np.ndarray], timings: Optional[Dict[str, float]] = None) -> np.ndarray:
+        """Preprocess a single image and return its combined feature vector."""
+        BATCH_SIZE.observe(1, stage="predict")
         
         # Preprocess image
-        processed_image = self.preprocessing_pipeline.process(image)
+        with stage_timer("preprocess", self.version, timings):
+            processed_image = self.preprocessing_pipeline.process(image)
         
         # Extract features
-        features_list = []
-        for extractor in self.feature_extractors:
-            features = extractor.extract(processed_image)
-            features_list.append(features)
+        with stage_timer("extract", self.version, timings):
+            features_list = []
+            for extractor in self.feature_extractors:
+                features = extractor.extract(processed_image)
+                features_list.append(features)
         
         # Combine features
-        features = np.hstack(features_list)
+        return np.hstack(features_list)
+    
+    def predict(
+        self,
+        image: Union[Image.Image, np.ndarray],
+        timings: Optional[Dict[str, float]] = None,
+        tta: Optional[bool] = None
+    ) -> Dict[str, Any]:
+        """Make a prediction on a single image.
         
-        # Make prediction
-        result = self.classifier.predict(features)
+        If a timings dict is passed, the seconds spent in each stage are added to it.
+        tta=None uses the pipeline's test-time augmentation if it has one, False turns
+        it off and True turns it on (with default settings if the pipeline has none).
+        """
+        # if not self.is_fitted:
+        #     raise ValueError("Pipeline must be fitted before use")
+        
+        if tta is False or (tta is None and self.tta is None):
+            features = self.embed(image, timings)
+            
+            # Make prediction
+            with stage_timer("classify", self.version, timings):
+                result = self.classifier.predict(features)
+            
+            return result
         
+        return self._predict_tta(image, self.tta or TestTimeAugmentation(), timings)
+    
+    def predict_batch(self, images: List[Union[Image.Image, np.ndarray]], timings: Optional[Dict[str, float]] = None) -> List[Dict[str, Any]]:
+        """Make predictions for a list of images with one batched embedding pass.
+        
+        Test-time augmentation is not applied to batches.
+        """
+        features = self.embed_batch(images, timings)
+        with stage_timer("classify", self.version, timings):
+            return self.classifier.predict_batch(features)
+    
+    def predict_regions(
+        self,
+        image: Union[Image.Image, np.ndarray],
+        max_regions: int = 4,
+        min_area: float = 0.02,
+        timings: Optional[Dict[str, float]] = None
+    ) -> Dict[str, Any]:
+        """Predict the whole image and each garment region separately, e.g. for full-outfit photos.
+        
+        Regions are the largest connected components of the foreground left by background
+        removal. Each region is scaled to fit a CROP_SIZE crop, and the usual centre crop
+        plus at most max_regions region crops are embedded in one batch. The top-level
+        result is the whole-image prediction, with per-region predictions under "regions".
+        """
+        with stage_timer("preprocess", self.version, timings):
+            processed_image = to_rgb_array(self.preprocessing_pipeline.process(image))
+            # Background removal zeroes everything outside the mask
+            boxes = propose_regions(processed_image.any(axis=2), max_regions, min_area)
+            crops = [center_crop(processed_image)]
+            crops.extend(fit_crop(processed_image[y:y + h, x:x + w]) for x, y, w, h in boxes)
+        
+        features = self.embed_crops(np.stack(crops), timings)
+        
+        with stage_timer("classify", self.version, timings):
+            predictions = self.classifier.predict_batch(features)
+        
+        result = predictions[0]
+        result["regions"] = [
+            {"box": {"x": x, "y": y, "width": w, "height": h}, **prediction}
+            for (x, y, w, h), prediction in zip(boxes, predictions[1:])
+        ]
         return result
     
-    def update(self, new_images: List[Union[Image.Image, np.ndarray]], new_labels: List[str]) -> None:
+    def _predict_tta(
+        self,
+        image: Union[Image.Image, np.ndarray],
+        augmentation: TestTimeAugmentation,
+        timings: Optional[Dict[str, float]] = None
+    ) -> Dict[str, Any]:
+        """Embed all augmented views in one batch and aggregate embeddings or votes."""
+        with stage_timer("preprocess", self.version, timings):
+            processed_image = self.preprocessing_pipeline.process(image)
+            views = augmentation.views(processed_image)
+        
+        start = time.perf_counter()
+        features = self.embed_crops(views, timings)
+        augmentation.record(len(views), time.perf_counter() - start)
+        
+        with stage_timer("classify", self.version, timings):
+            if augmentation.aggregation == "mean":
+                result = self.classifier.predict(augmentation.aggregate_features(features))
+            else:
+                result = augmentation.aggregate_predictions([self.classifier.predict(view) for view in features])
+        
+        result["tta_views"] = len(views)
+        return result
+    
+    def similar(
+        self,
+        features: np.ndarray,
+        k: int = 10,
+        offset: int = 0,
+        exclude_row: Optional[int] = None,
+        classifier: Optional[NearestNeighborClassifier] = None
+    ) -> List[Dict[str, Any]]:
+        """Return the top-k stored items closest to a feature vector, skipping the first offset.
+
+        Searches classifier if given (pass the one exclude_row refers to), otherwise the current one.
+        """
+        # One reference throughout, so a concurrent swap_classifier cannot mix two models
+        classifier = classifier if classifier is not None else self.classifier
+        if not isinstance(classifier, NearestNeighborClassifier):
+            raise ValueError("Similar item lookup requires a nearest neighbor classifier")
+        
+        # Ask for one extra neighbour so the query item itself can be dropped
+        extra = 1 if exclude_row is not None else 0
+        distances, indices = classifier.kneighbors(features, offset + k + extra)
+        keep = indices[0] != exclude_row
+        distances, indices = distances[0][keep][offset:offset + k], indices[0][keep][offset:offset + k]
+        
+        labels = classifier.label_encoder.inverse_transform(classifier.labels[indices])
+        items = []
+        for distance, row, label in zip(distances, indices, labels):
+            items.append({
+                "row": int(row),
+                "image_id": int(classifier.ids[row]) if classifier.ids[row] >= 0 else None,
+                "season": label,
+                "distance": float(distance)
+            })
+        return items
+    
+    def update(self, new_images: List[Union[Image.Image, np.ndarray]], new_labels: List[str], new_ids: Optional[List[int]] = None) -> None:
         """Update the model with new data."""
         if not self.is_fitted:
             self.fit(new_images, new_labels)
@@ -93,23 +266,21 @@ class PradaClassificationPipeline:
         
         # For nearest neighbor classifier, we can simply add new data
         if isinstance(self.classifier, NearestNeighborClassifier):
-            # Preprocess new images
-            processed_images = [self.preprocessing_pipeline.process(img) for img in new_images]
-            
-            # Extract features
-            features_list = []
-            for extractor in self.feature_extractors:
-                extractor_features = [extractor.extract(img) for img in processed_images]
-                features_list.append(np.array(extractor_features))
-            
-            # Combine features
-            new_features = np.hstack(features_list)
+            new_features = self.embed_batch(new_images)
             
             # Update classifier
+            if new_ids is None:
+                new_ids = [-1] * len(new_labels)
+            weights = None
+            if self.classifier.weights is not None:
+                weights = np.concatenate([self.classifier.weights, np.ones(len(new_labels))])
             self.classifier.fit(
                 np.vstack([self.classifier.features, new_features]),
-                list(self.classifier.label_encoder.inverse_transform(self.classifier.labels)) + new_labels
+                list(self.classifier.label_encoder.inverse_transform(self.classifier.labels)) + new_labels,
+                ids=list(self.classifier.ids) + list(new_ids),
+                weights=weights
             )
+            self.revision += 1
         else:
             # For other classifiers, we need to retrain
             # This is a simplified approach - in practice, you might want to implement
@@ -117,17 +288,84 @@ class PradaClassificationPipeline:
             self.fit(new_images, new_labels)
 
 
-def create_default_pipeline() -> PradaClassificationPipeline:
-    """Create a default pipeline with recommended components."""
-    # Preprocessors
-    preprocessors = [
+def create_default_preprocessors() -> List[ImagePreprocessor]:
+    """Create the preprocessors used by the default pipeline."""
+    return [
         # ResizePreprocessor(target_size=(224, 224)),
-        BackgroundRemovalPreprocessor(),
+        BackgroundRemovalPreprocessor(
+            backend=create_segmentation_backend(settings.SEGMENTATION_BACKEND, settings.SEGMENTATION_MODEL_PATH),
+            cache=MaskCache(max_bytes=settings.MASK_CACHE_BYTES, cache_dir=settings.MASK_CACHE_DIR)
+        ),
         # NormalizePreprocessor()
     ]
+
+
+def create_default_tta() -> TestTimeAugmentation:
+    """Create test-time augmentation from the TTA_* settings."""
+    return TestTimeAugmentation(
+        flips=settings.TTA_FLIPS,
+        crops=settings.TTA_CROPS,
+        scales=settings.TTA_SCALES,
+        aggregation=settings.TTA_AGGREGATION,
+        max_views=settings.TTA_MAX_VIEWS or None,
+        latency_budget_ms=settings.TTA_LATENCY_BUDGET_MS
+    )
+
+
+def checkpoint_version(checkpoint_path: str) -> str:
+    return os.path.splitext(os.path.basename(checkpoint_path))[0]
+
+
+def active_model_path() -> str:
+    """File naming the checkpoint (next to KNN_CHECKPOINT_PATH) that every worker should serve."""
+    return os.path.join(os.path.dirname(settings.KNN_CHECKPOINT_PATH), "active_model.txt")
+
+
+def read_active_model() -> Optional[str]:
+    try:
+        with open(active_model_path()) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def write_active_model(model_name: str) -> None:
+    """Point every worker at another checkpoint; written then renamed so readers never see a partial name."""
+    tmp_path = active_model_path() + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(model_name + "\n")
+    os.replace(tmp_path, active_model_path())
+
+
+def load_knn_classifier(checkpoint_path: str, n_neighbors: int = 5) -> NearestNeighborClassifier:
+    """Fit a kNN classifier on a stored embedding checkpoint, with its calibration if one exists."""
+    knn_classifier = NearestNeighborClassifier(n_neighbors=n_neighbors)
+    knn_ckpt = np.load(checkpoint_path)
+    knn_classifier.fit(
+        knn_ckpt['X'],
+        knn_ckpt['y'],
+        ids=knn_ckpt['ids'] if 'ids' in knn_ckpt else None,
+        weights=knn_ckpt['weights'] if 'weights' in knn_ckpt else None
+    )
+    if 'alias_ids' in knn_ckpt:
+        knn_classifier.aliases = dict(zip(knn_ckpt['alias_ids'].tolist(), knn_ckpt['alias_rows'].tolist()))
+    
+    calibration_path = settings.CALIBRATION_PATH or default_calibration_path(checkpoint_path)
+    if os.path.exists(calibration_path):
+        knn_classifier.calibrator = KNNCalibrator.load(calibration_path)
+        knn_classifier.abstain_threshold = knn_classifier.calibrator.abstain_threshold
+    if settings.ABSTAIN_THRESHOLD is not None:
+        knn_classifier.abstain_threshold = settings.ABSTAIN_THRESHOLD
+    return knn_classifier
+
+
+def create_default_pipeline() -> PradaClassificationPipeline:
+    """Create a default pipeline with recommended components."""
+    # Preprocessors
+    preprocessors = create_default_preprocessors()
     
     # Feature extractors
-    resnet_extractor = ResNetFeatureExtractor(model_name="resnet50")
+    resnet_extractor = ResNetFeatureExtractor(model_name="resnet50", pretrained=settings.RESNET_PRETRAINED)
     # pca_extractor = PCAFeatureExtractor(resnet_extractor, n_components=100)
     
     feature_extractors = [
@@ -135,9 +373,7 @@ def create_default_pipeline() -> PradaClassificationPipeline:
     ]
     
     # Classifiers
-    knn_classifier = NearestNeighborClassifier(n_neighbors=5)
-    knn_ckpt = np.load('C:/Users/jexia/projects/prada-id/app/ml/ckpts/features_labels.npz')
-    knn_classifier.fit(knn_ckpt['X'], knn_ckpt['y'])
+    knn_classifier = load_knn_classifier(settings.KNN_CHECKPOINT_PATH)
 
     # # Ensemble classifier
     # ensemble = EnsembleClassifier(
@@ -149,7 +385,9 @@ def create_default_pipeline() -> PradaClassificationPipeline:
     pipeline = PradaClassificationPipeline(
         preprocessors=preprocessors,
         feature_extractors=feature_extractors,
-        classifier=knn_classifier
+        classifier=knn_classifier,
+        version=checkpoint_version(settings.KNN_CHECKPOINT_PATH),
+        tta=create_default_tta() if settings.TTA_ENABLED else None
     )
     
     return pipeline 
\ No newline at end of file
@@ -5,6 +5,8 @@ import cv2
 import numpy as np
 from PIL import Image
 
+from app.ml.segmentation import MaskCache, SegmentationBackend, ThresholdSegmentationBackend, to_rgb_array
+
 
 class ImagePreprocessor(ABC):
     """Base class for image preprocessing steps."""
@@ -13,6 +15,10 @@ class ImagePreprocessor(ABC):
     def process(self, image: Union[Image.Image, np.ndarray]) -> Union[Image.Image, np.ndarray]:
         """Process the input image and return the processed image."""
         pass
+    
+    def process_batch(self, images: List[Union[Image.Image, np.ndarray]]) -> List[Union[Image.Image, np.ndarray]]:
+        """Process a list of images. Override when a step can batch its work."""
+        return [self.process(image) for image in images]
 
 
 class ResizePreprocessor(ImagePreprocessor):
@@ -29,32 +35,56 @@ class ResizePreprocessor(ImagePreprocessor):
 
 
 class BackgroundRemovalPreprocessor(ImagePreprocessor):
-    """Remove background from clothing images using the autodistilled yolov8-seg model."""
+    """Remove background from clothing images using a pluggable segmentation backend.
+
+    Masks are cached by image content hash when a MaskCache is given, so the same
+    photo is only segmented once across training runs and classifications.
+    """
     
-    def __init__(self, threshold: int = 127):
+    def __init__(
+        self,
+        threshold: int = 127,
+        backend: Optional[SegmentationBackend] = None,
+        cache: Optional[MaskCache] = None
+    ):
         self.threshold = threshold
+        self.backend = backend if backend else ThresholdSegmentationBackend(threshold)
+        self.cache = cache
     
     # TODO: add imput for clothing type?
     def process(self, image: Union[Image.Image, np.ndarray]) -> Union[Image.Image, np.ndarray]:
-        # Convert PIL Image to numpy array if needed
-        if isinstance(image, Image.Image):
-            img_array = np.array(image)
-        else:
-            img_array = image.copy()
-        
-        # Convert to grayscale
-        gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
+        return self.process_batch([image])[0]
+    
+    def process_batch(self, images: List[Union[Image.Image, np.ndarray]]) -> List[Union[Image.Image, np.ndarray]]:
+        arrays = [to_rgb_array(image) for image in images]
+        masks = self.get_masks(arrays)
         
-        # TODO: Apply model to create mask
-        _, mask = cv2.threshold(gray, self.threshold, 255, cv2.THRESH_BINARY_INV)
+        results = []
+        for image, img_array, mask in zip(images, arrays, masks):
+            # Apply mask to original image
+            result = cv2.bitwise_and(img_array, img_array, mask=mask)
+            
+            # Convert back to PIL Image if input was PIL Image
+            if isinstance(image, Image.Image):
+                result = Image.fromarray(result)
+            results.append(result)
+        return results
+    
+    def get_masks(self, arrays: List[np.ndarray]) -> List[np.ndarray]:
+        """Return foreground masks for RGB arrays, segmenting only cache misses."""
+        if self.cache is None:
+            return self.backend.segment_batch(arrays)
         
-        # Apply mask to original image
-        result = cv2.bitwise_and(img_array, img_array, mask=mask)
+        keys = [MaskCache.key(img_array, self.backend.cache_key) for img_array in arrays]
+        masks = [self.cache.get(key) for key in keys]
         
-        # Convert back to PIL Image if input was PIL Image
-        if isinstance(image, Image.Image):
-            return Image.fromarray(result)
-        return result
+        missing = [i for i, mask in enumerate(masks) if mask is None]
+        if missing:
+            computed = self.backend.segment_batch([arrays[i] for i in missing])
+            for i, mask in zip(missing, computed):
+                self.cache.put(keys[i], mask)
+                masks[i] = mask
+        return masks
 
 
 class NormalizePreprocessor(ImagePreprocessor):
@@ -91,4 +121,10 @@ class PreprocessingPipeline:
         result = image
         for preprocessor in self.preprocessors:
             result = preprocessor.process(result)
-        return result 
\ No newline at end of file
+        return result
+    
+    def process_batch(self, images: List[Union[Image.Image, np.ndarray]]) -> List[Union[Image.Image, np.ndarray]]:
+        results = images
+        for preprocessor in self.preprocessors:
+            results = preprocessor.process_batch(results)
+        return results 
\ No newline at end of file
@@ -0,0 +1,397 @@
+import hashlib
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import List, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from app.core.metrics import CACHE_REQUESTS
+
+
+def to_rgb_array(image: Union[Image.Image, np.ndarray]) -> np.ndarray:
+    """Convert a PIL image or array to a contiguous uint8 RGB array."""
+    if isinstance(image, Image.Image):
+        return np.asarray(image.convert("RGB"))
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+    if image.shape[2] == 4:
+        return cv2.cvtColor(image, cv2.COLOR_RGBA2RGB)
+    return np.ascontiguousarray(image)
+
+
+def keep_largest_component(mask: np.ndarray) -> np.ndarray:
+    """Keep only the largest external contour of a binary mask, filled."""
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return mask
+    largest = max(contours, key=cv2.contourArea)
+    result = np.zeros_like(mask)
+    cv2.drawContours(result, [largest], -1, 255, thickness=cv2.FILLED)
+    return result
+
+
+def propose_regions(
+    mask: np.ndarray,
+    max_regions: int,
+    min_area: float = 0.02,
+    margin: float = 0.05
+) -> List[Tuple[int, int, int, int]]:
+    """Bounding boxes (x, y, width, height) of the largest connected foreground components.
+
+    Components covering less than min_area of the image are dropped as noise, at most
+    max_regions boxes are returned (largest first), and each box is padded by margin
+    of its longer side.
+    """
+    height, width = mask.shape[:2]
+    _, _, stats, _ = cv2.connectedComponentsWithStats((mask > 0).astype(np.uint8), connectivity=8)
+    # Row 0 is the background
+    stats = stats[1:]
+    stats = stats[stats[:, cv2.CC_STAT_AREA] >= min_area * height * width]
+    stats = stats[np.argsort(-stats[:, cv2.CC_STAT_AREA])[:max_regions]]
+
+    boxes = []
+    for x, y, w, h, _ in stats:
+        pad = int(margin * max(w, h))
+        left, top = max(0, x - pad), max(0, y - pad)
+        right, bottom = min(width, x + w + pad), min(height, y + h + pad)
+        boxes.append((int(left), int(top), int(right - left), int(bottom - top)))
+    return boxes
+
+
+class SegmentationBackend(ABC):
+    """Base class for foreground (garment) segmentation backends."""
+
+    name: str = "base"
+
+    @abstractmethod
+    def segment(self, image: np.ndarray) -> np.ndarray:
+        """Return a uint8 mask (255 = garment) with the same height/width as image."""
+        pass
+
+    def segment_batch(self, images: List[np.ndarray]) -> List[np.ndarray]:
+        """Segment a list of RGB images."""
+        return [self.segment(image) for image in images]
+
+    @property
+    def cache_key(self) -> str:
+        """Identify the backend and its settings so cached masks are not shared."""
+        return self.name
+
+
+class ThresholdSegmentationBackend(SegmentationBackend):
+    """Treat every pixel darker than a grayscale threshold as foreground."""
+
+    name = "threshold"
+
+    def __init__(self, threshold: int = 127):
+        self.threshold = threshold
+
+    def segment(self, image: np.ndarray) -> np.ndarray:
+        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        _, mask = cv2.threshold(gray, self.threshold, 255, cv2.THRESH_BINARY_INV)
+        return mask
+
+    @property
+    def cache_key(self) -> str:
+        return f"{self.name}-{self.threshold}"
+
+
+class ContourSegmentationBackend(SegmentationBackend):
+    """Fill the largest closed edge contour; cheap and works on plain backdrops."""
+
+    name = "contour"
+
+    def __init__(self, max_side: int = 512, canny_low: int = 30, canny_high: int = 100):
+        self.max_side = max_side
+        self.canny_low = canny_low
+        self.canny_high = canny_high
+
+    def segment(self, image: np.ndarray) -> np.ndarray:
+        height, width = image.shape[:2]
+        small = _downscale(image, self.max_side)
+
+        gray = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY)
+        gray = cv2.GaussianBlur(gray, (5, 5), 0)
+        edges = cv2.Canny(gray, self.canny_low, self.canny_high)
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7, 7))
+        edges = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, kernel, iterations=2)
+
+        mask = keep_largest_component(edges)
+        return cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+
+    @property
+    def cache_key(self) -> str:
+        return f"{self.name}-{self.max_side}-{self.canny_low}-{self.canny_high}"
+
+
+class GrabCutSegmentationBackend(SegmentationBackend):
+    """Run GrabCut initialised from a centred rectangle on a downscaled copy."""
+
+    name = "grabcut"
+
+    def __init__(self, max_side: int = 256, iterations: int = 3, margin: float = 0.05):
+        self.max_side = max_side
+        self.iterations = iterations
+        self.margin = margin
+
+    def segment(self, image: np.ndarray) -> np.ndarray:
+        height, width = image.shape[:2]
+        small = _downscale(image, self.max_side)
+        small_h, small_w = small.shape[:2]
+
+        # Assume the garment sits inside the frame, away from the borders
+        dx = max(1, int(small_w * self.margin))
+        dy = max(1, int(small_h * self.margin))
+        rect = (dx, dy, small_w - 2 * dx, small_h - 2 * dy)
+
+        gc_mask = np.zeros((small_h, small_w), np.uint8)
+        bgd_model = np.zeros((1, 65), np.float64)
+        fgd_model = np.zeros((1, 65), np.float64)
+        cv2.grabCut(
+            cv2.cvtColor(small, cv2.COLOR_RGB2BGR), gc_mask, rect,
+            bgd_model, fgd_model, self.iterations, cv2.GC_INIT_WITH_RECT
+        )
+
+        mask = np.where((gc_mask == cv2.GC_FGD) | (gc_mask == cv2.GC_PR_FGD), 255, 0)
+        mask = keep_largest_component(mask.astype(np.uint8))
+        return cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+
+    @property
+    def cache_key(self) -> str:
+        return f"{self.name}-{self.max_side}-{self.iterations}-{self.margin}"
+
+
+class ModelSegmentationBackend(SegmentationBackend):
+    """Shared batching logic for network-based backends.
+
+    Images are resized to a square input, normalised with ImageNet statistics and
+    run through the network in batches. The network output is either a single
+    foreground logit map (N, 1, H, W) or per-class logits (N, C, H, W) where
+    class 0 is background.
+    """
+
+    def __init__(self, input_size: int = 320, batch_size: int = 8, threshold: float = 0.5):
+        self.input_size = input_size
+        self.batch_size = batch_size
+        self.threshold = threshold
+        self.mean = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+        self.std = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+    @abstractmethod
+    def _forward(self, batch: np.ndarray) -> np.ndarray:
+        """Run the network on a float32 (N, 3, S, S) batch and return logits."""
+        pass
+
+    def segment(self, image: np.ndarray) -> np.ndarray:
+        return self.segment_batch([image])[0]
+
+    def segment_batch(self, images: List[np.ndarray]) -> List[np.ndarray]:
+        masks = []
+        for start in range(0, len(images), self.batch_size):
+            chunk = images[start:start + self.batch_size]
+            batch = np.stack([self._prepare(image) for image in chunk])
+            logits = self._forward(batch)
+            for image, logit in zip(chunk, logits):
+                masks.append(self._postprocess(logit, image.shape[:2]))
+        return masks
+
+    def _prepare(self, image: np.ndarray) -> np.ndarray:
+        resized = cv2.resize(image, (self.input_size, self.input_size), interpolation=cv2.INTER_AREA)
+        normalized = (resized.astype(np.float32) / 255.0 - self.mean) / self.std
+        return normalized.transpose(2, 0, 1)
+
+    def _postprocess(self, logits: np.ndarray, shape: tuple) -> np.ndarray:
+        if logits.shape[0] == 1:
+            foreground = 1.0 / (1.0 + np.exp(-logits[0])) > self.threshold
+        else:
+            foreground = logits.argmax(axis=0) != 0
+        mask = foreground.astype(np.uint8) * 255
+        return cv2.resize(mask, (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+
+    @property
+    def cache_key(self) -> str:
+        return f"{self.name}-{self.input_size}-{self.threshold}"
+
+
+class TorchSegmentationBackend(ModelSegmentationBackend):
+    """Segment with a TorchScript model, or torchvision's DeepLabV3-MobileNet."""
+
+    name = "torch"
+
+    def __init__(self, model_path: Optional[str] = None, num_threads: Optional[int] = None, **kwargs):
+        super().__init__(**kwargs)
+        import torch
+
+        self.torch = torch
+        self.model_path = model_path
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.model = self._load_model(model_path)
+
+    def _load_model(self, model_path: Optional[str]):
+        if model_path:
+            model = self.torch.jit.load(model_path, map_location=self.device)
+        else:
+            from torchvision.models.segmentation import deeplabv3_mobilenet_v3_large
+
+            model = deeplabv3_mobilenet_v3_large(weights="DEFAULT")
+        model = model.to(self.device)
+        model.eval()
+        return model
+
+    def _forward(self, batch: np.ndarray) -> np.ndarray:
+        with self.torch.inference_mode():
+            output = self.model(self.torch.from_numpy(batch).to(self.device))
+        # torchvision segmentation models return {"out": logits}
+        if isinstance(output, dict):
+            output = output["out"]
+        return output.cpu().numpy()
+
+    @property
+    def cache_key(self) -> str:
+        return f"{super().cache_key}-{self.model_path or 'deeplabv3_mobilenet_v3_large'}"
+
+
+class ONNXSegmentationBackend(ModelSegmentationBackend):
+    """Segment with an ONNX model (e.g. an exported yolov8-seg mask head) on CPU."""
+
+    name = "onnx"
+
+    def __init__(self, model_path: str, num_threads: Optional[int] = None, **kwargs):
+        super().__init__(**kwargs)
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError("onnxruntime is required for the onnx segmentation backend") from e
+
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.model_path = model_path
+        self.session = ort.InferenceSession(
+            model_path, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def _forward(self, batch: np.ndarray) -> np.ndarray:
+        return self.session.run(None, {self.input_name: batch})[0]
+
+    @property
+    def cache_key(self) -> str:
+        return f"{super().cache_key}-{self.model_path}"
+
+
+class MaskCache:
+    """LRU cache of segmentation masks keyed by image content hash.
+
+    Masks are kept in memory bit-packed (one bit per pixel), up to max_bytes of
+    packed masks, and, if cache_dir is given, also written to disk as PNG files so
+    that reruns of training and repeat classifications skip segmentation across processes.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, cache_dir: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._masks: "OrderedDict[str, Tuple[np.ndarray, Tuple[int, int]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(image: np.ndarray, backend_key: str) -> str:
+        """Hash the pixels, shape and backend settings of an image."""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(backend_key.encode())
+        digest.update(str(image.shape).encode())
+        digest.update(np.ascontiguousarray(image).data)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            entry = self._masks.get(key)
+            if entry is not None:
+                self._masks.move_to_end(key)
+                self.hits += 1
+        if entry is not None:
+            CACHE_REQUESTS.inc(cache="mask", result="hit")
+            packed, shape = entry
+            return np.unpackbits(packed, count=shape[0] * shape[1]).reshape(shape) * np.uint8(255)
+
+        # cv2.imread logs a warning for missing files, so only read masks that exist
+        if self.cache_dir and os.path.exists(self._path(key)):
+            mask = cv2.imread(self._path(key), cv2.IMREAD_GRAYSCALE)
+            if mask is not None:
+                self._remember(key, mask)
+                with self._lock:
+                    self.hits += 1
+                CACHE_REQUESTS.inc(cache="mask", result="hit")
+                return mask
+
+        with self._lock:
+            self.misses += 1
+        CACHE_REQUESTS.inc(cache="mask", result="miss")
+        return None
+
+    def put(self, key: str, mask: np.ndarray) -> None:
+        self._remember(key, mask)
+        if self.cache_dir:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            cv2.imwrite(path, mask)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._masks.clear()
+            self.nbytes = 0
+
+    def _remember(self, key: str, mask: np.ndarray) -> None:
+        # Masks are binary, so packing keeps a 12 MP mask in 1.5 MB instead of 12 MB
+        packed = np.packbits(mask > 0)
+        if packed.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._masks.pop(key, None)
+            if previous is not None:
+                self.nbytes -= previous[0].nbytes
+            self._masks[key] = (packed, mask.shape[:2])
+            self.nbytes += packed.nbytes
+            while self.nbytes > self.max_bytes:
+                _, (evicted, _) = self._masks.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.png")
+
+
+def create_segmentation_backend(name: str, model_path: Optional[str] = None, **kwargs) -> SegmentationBackend:
+    """Build a segmentation backend by name."""
+    if name == "threshold":
+        return ThresholdSegmentationBackend(**kwargs)
+    elif name == "contour":
+        return ContourSegmentationBackend(**kwargs)
+    elif name == "grabcut":
+        return GrabCutSegmentationBackend(**kwargs)
+    elif name == "torch":
+        return TorchSegmentationBackend(model_path=model_path, **kwargs)
+    elif name == "onnx":
+        if not model_path:
+            raise ValueError("The onnx segmentation backend requires a model path")
+        return ONNXSegmentationBackend(model_path=model_path, **kwargs)
+    else:
+        raise ValueError(f"Unsupported segmentation backend: {name}")
+
+
+def _downscale(image: np.ndarray, max_side: int) -> np.ndarray:
+    height, width = image.shape[:2]
+    scale = max_side / max(height, width)
+    if scale >= 1:
+        return image
+    return cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
@@ -0,0 +1,182 @@
+"""
+Serve the API from several worker processes that share one copy of the model.
+
+The parent imports the app, which loads the classification pipeline, then forks
+the workers onto one listening socket. The ResNet weights and the kNN feature
+matrix are never written after loading, so their pages stay shared copy-on-write
+between all workers instead of being loaded once per worker like `uvicorn --workers`.
+
+    python -m app.serve --workers 4 --threads 2
+
+POSIX only, since it relies on os.fork.
+"""
+import argparse
+import gc
+import glob
+import logging
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+from typing import Dict
+
+from app.core.config import settings
+
+
+logger = logging.getLogger(__name__)
+
+# A worker that dies sooner than this after starting is treated as a startup failure, not restarted
+MIN_WORKER_LIFETIME = 5.0
+
+
+def threads_per_worker(workers: int, threads: int = 0) -> int:
+    """Intra-op threads for each worker; 0 splits the CPU cores evenly between workers."""
+    if threads > 0:
+        return threads
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def _bind(host: str, port: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def preload_app() -> None:
+    """Load the app and its pipeline in the parent so forked workers share them."""
+    import torch
+
+    # With a single intra-op thread the parent never starts an OpenMP thread pool,
+    # which would not survive the fork
+    torch.set_num_threads(1)
+
+    import app.main  # noqa: F401  (creates the pipeline in app.api.endpoints.model)
+    from app.db.session import engine
+
+    # Connections opened while importing must not be shared between processes
+    engine.dispose()
+
+    # Move everything loaded so far out of the collector's reach, so collections
+    # in the workers don't write to (and un-share) the parent's pages
+    gc.collect()
+    gc.freeze()
+
+
+def _run_worker(sock: socket.socket, threads: int, log_level: str, metrics_dir: str) -> None:
+    import torch
+    import uvicorn
+
+    from app.core.metrics import REGISTRY
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    torch.set_num_threads(threads)
+    # /metrics on any worker reports the totals of all of them
+    REGISTRY.share(metrics_dir)
+
+    # Already imported when preloaded; otherwise each worker loads its own pipeline here
+    from app.main import app
+
+    config = uvicorn.Config(app, log_level=log_level, timeout_keep_alive=5)
+    uvicorn.Server(config).run(sockets=[sock])
+    REGISTRY.write_snapshot()
+
+
+def serve(
+    host: str = "0.0.0.0",
+    port: int = 8000,
+    workers: int = 2,
+    threads: int = 0,
+    preload: bool = True,
+    log_level: str = "info"
+) -> None:
+    """Fork workers and restart any that exit until SIGINT or SIGTERM."""
+    if not hasattr(os, "fork"):
+        raise RuntimeError("app.serve needs os.fork; use `uvicorn app.main:app --workers N` on this platform")
+
+    threads = threads_per_worker(workers, threads)
+    sock = _bind(host, port)
+    metrics_dir = settings.METRICS_DIR or tempfile.mkdtemp(prefix="prada-metrics-")
+    os.makedirs(metrics_dir, exist_ok=True)
+    # Metrics start from zero with the server, so drop the snapshots of a previous run
+    for path in glob.glob(os.path.join(metrics_dir, "*.json")):
+        os.remove(path)
+    if preload:
+        preload_app()
+
+    children: Dict[int, float] = {}
+    stopping = False
+
+    def spawn() -> None:
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _run_worker(sock, threads, log_level, metrics_dir)
+            except BaseException:
+                logger.exception("Worker failed")
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = time.monotonic()
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    logger.info(f"Starting {workers} workers with {threads} threads each on {host}:{port} (preload={preload})")
+    for _ in range(workers):
+        spawn()
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if stopping or started is None:
+            continue
+        if time.monotonic() - started < MIN_WORKER_LIFETIME:
+            logger.error(f"Worker {pid} exited during startup (status {status}); shutting down")
+            stop(signal.SIGTERM, None)
+            continue
+        logger.warning(f"Worker {pid} exited (status {status}); starting a replacement")
+        spawn()
+
+    sock.close()
+    if not settings.METRICS_DIR:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve the API from forked workers sharing one pipeline")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=settings.SERVE_WORKERS)
+    parser.add_argument("--threads", type=int, default=settings.SERVE_THREADS_PER_WORKER,
+                        help="Intra-op threads per worker (0 = cores / workers)")
+    parser.add_argument("--no-preload", dest="preload", action="store_false",
+                        help="Load the pipeline in every worker instead of sharing it")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    serve(args.host, args.port, args.workers, args.threads, args.preload, args.log_level)
+
+
+if __name__ == "__main__":
+    main()
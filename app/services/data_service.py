@@ -1,109 +1,92 @@
 import os
 import json
-from typing import List, Dict, Any, Optional, Tuple
-from datetime import datetime
+from typing import Iterator, List, Dict, Any, Optional, Tuple
 
-import boto3
-from botocore.exceptions import ClientError
 from sqlalchemy.orm import Session
 from fastapi import UploadFile
 
-from app.core.config import settings
-from app.db.models import ImageContribution, User
+from app.core.storage import StorageBackend, get_storage, image_key
+from app.db.models import Images, SeasonCount
 from app.ml.pipeline import PradaClassificationPipeline
+from app.services.export_service import training_data_query
+from app.services.stats_service import StatsService, season_count_upsert
 
 
 class DataService:
     """Service for managing image data and model training data."""
     
-    def __init__(self, db: Session, s3_client=None):
+    def __init__(self, db: Session, storage: Optional[StorageBackend] = None):
         self.db = db
-        self.s3_client = s3_client or boto3.client(
-            's3',
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_REGION
-        )
-        self.bucket_name = settings.S3_BUCKET
+        self.storage = storage or get_storage()
     
-    async def upload_image(self, file: UploadFile, user_id: int) -> str:
-        """Upload an image to S3 and return the URL."""
-        try:
-            # Generate a unique filename
-            timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-            filename = f"images/{user_id}/{timestamp}_{file.filename}"
-            
-            # Upload to S3
-            self.s3_client.upload_fileobj(
-                file.file,
-                self.bucket_name,
-                filename,
-                ExtraArgs={'ContentType': file.content_type}
-            )
-            
-            # Generate URL
-            url = f"https://{self.bucket_name}.s3.{settings.AWS_REGION}.amazonaws.com/{filename}"
-            return url
-        except ClientError as e:
-            raise Exception(f"Failed to upload image: {str(e)}")
+    def upload_image(self, file: UploadFile) -> str:
+        """Store an uploaded image and return its storage key."""
+        data = file.file.read()
+        key = image_key(data)
+        if not self.storage.exists(key):
+            self.storage.write_bytes(key, data)
+        return key
     
-    def save_contribution(self, user_id: int, image_url: str, season: str, confidence: Optional[float] = None) -> ImageContribution:
+    def save_contribution(self, image_path: str, season: str) -> Images:
         """Save an image contribution to the database."""
-        contribution = ImageContribution(
-            user_id=user_id,
-            image_url=image_url,
-            season=season,
-            confidence=confidence
-        )
+        contribution = Images(image_path=image_path, season=season)
         self.db.add(contribution)
+        self.db.execute(season_count_upsert(self.db.bind.dialect.name, season))
         self.db.commit()
+        StatsService.invalidate()
         self.db.refresh(contribution)
         return contribution
     
+    def iter_training_data(
+        self,
+        batch_size: int = 1000,
+        season: Optional[str] = None,
+        include_duplicates: bool = False,
+        after_id: int = 0
+    ) -> Iterator[Tuple[int, str, str]]:
+        """Yield (image id, path, season) in id order, loading one keyset page at a time."""
+        while True:
+            rows = self.db.execute(training_data_query(after_id, batch_size, season, include_duplicates)).all()
+            if not rows:
+                return
+            for row in rows:
+                yield tuple(row)
+            after_id = rows[-1][0]
+    
     def get_training_data(self, verified_only: bool = True) -> Tuple[List[str], List[str]]:
-        """Get training data for model training."""
-        query = self.db.query(ImageContribution)
-        if verified_only:
-            query = query.filter(ImageContribution.is_verified == 1)
+        """Get training data for model training.
         
-        contributions = query.all()
+        Images have no verification flag; verified_only leaves out flagged duplicates.
+        Prefer iter_training_data for large datasets.
+        """
+        image_paths, labels = [], []
+        for _, image_path, season in self.iter_training_data(include_duplicates=not verified_only):
+            image_paths.append(image_path)
+            labels.append(season)
         
-        # Extract image URLs and labels
-        image_urls = [c.image_url for c in contributions]
-        labels = [c.season for c in contributions]
-        
-        return image_urls, labels
+        return image_paths, labels
     
-    def download_image(self, image_url: str) -> bytes:
-        """Download an image from S3."""
-        try:
-            # Extract key from URL
-            key = image_url.split(f"{self.bucket_name}.s3.{settings.AWS_REGION}.amazonaws.com/")[1]
-            
-            # Download from S3
-            response = self.s3_client.get_object(
-                Bucket=self.bucket_name,
-                Key=key
-            )
-            
-            return response['Body'].read()
-        except ClientError as e:
-            raise Exception(f"Failed to download image: {str(e)}")
+    def download_image(self, image_path: str) -> bytes:
+        """Read an image from storage."""
+        return self.storage.read_bytes(image_path)
     
     def get_all_seasons(self) -> List[str]:
-        """Get all unique seasons from the database."""
-        seasons = self.db.query(ImageContribution.season).distinct().all()
+        """Get all unique seasons from the season_counts summary table."""
+        seasons = self.db.query(SeasonCount.season).filter(SeasonCount.count > 0).order_by(SeasonCount.season).all()
         return [season[0] for season in seasons]
     
     def get_contribution_stats(self) -> Dict[str, Any]:
-        """Get statistics about contributions."""
-        total = self.db.query(ImageContribution).count()
-        verified = self.db.query(ImageContribution).filter(ImageContribution.is_verified == 1).count()
-        seasons = self.get_all_seasons()
+        """Get statistics about contributions from the season_counts summary table."""
+        counts = dict(
+            self.db.query(SeasonCount.season, SeasonCount.count)
+            .filter(SeasonCount.count > 0)
+            .order_by(SeasonCount.season)
+            .all()
+        )
         
         return {
-            "total_contributions": total,
-            "verified_contributions": verified,
-            "unique_seasons": len(seasons),
-            "seasons": seasons
+            "total_contributions": sum(counts.values()),
+            "unique_seasons": len(counts),
+            "seasons": list(counts),
+            "season_counts": counts
         } 
\ No newline at end of file
@@ -0,0 +1,185 @@
+import argparse
+import asyncio
+import io
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+from sqlalchemy import delete, select, text, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.core.storage import get_storage
+from app.db.models import Images
+from app.services.stats_service import StatsService
+from app.ml.hashing import PerceptualHashIndex, hash_to_hex, hex_to_hash, phash
+
+
+logger = logging.getLogger(__name__)
+
+# Key of the Postgres advisory lock that serializes uploads across workers; any constant shared by them works
+UPLOAD_ADVISORY_LOCK = 0x70726164
+
+
+class DedupService:
+    """Service for detecting duplicate and near-duplicate images by perceptual hash."""
+
+    # One index per process, built from the images table on first use
+    _index: Optional[PerceptualHashIndex] = None
+    _index_max_id = 0  # highest image id in the index; newer rows come from other workers
+    _index_lock = asyncio.Lock()
+    # Queues this worker's uploads for the database lock taken by lock_uploads() instead of
+    # having them wait on each other inside the database
+    upload_lock = asyncio.Lock()
+
+    def __init__(self, db: AsyncSession, max_distance: Optional[int] = None):
+        self.db = db
+        self.max_distance = settings.DUPLICATE_HASH_DISTANCE if max_distance is None else max_distance
+
+    async def get_index(self) -> PerceptualHashIndex:
+        """Get the process-wide hash index, loading it from the database if needed."""
+        async with DedupService._index_lock:
+            if DedupService._index is None:
+                DedupService._index = PerceptualHashIndex(max_distance=self.max_distance)
+                DedupService._index_max_id = 0
+            # Pick up images stored since the last call, including uploads to other workers
+            rows = await self.db.execute(
+                select(Images.id, Images.phash)
+                .where(Images.id > DedupService._index_max_id, Images.phash.isnot(None), Images.phash != "")
+                .order_by(Images.id)
+            )
+            for image_id, value in rows:
+                DedupService._index.add(image_id, hex_to_hash(value))
+                DedupService._index_max_id = image_id
+        return DedupService._index
+
+    @staticmethod
+    def hash_image(data: bytes) -> str:
+        """Compute the perceptual hash of encoded image bytes."""
+        image = Image.open(io.BytesIO(data))
+        # Let the JPEG decoder downscale while decoding; the hash only needs 32x32 pixels
+        image.draft("L", (128, 128))
+        return hash_to_hex(phash(image))
+
+    async def lock_uploads(self) -> None:
+        """Serialize uploads across workers from here until the caller's transaction ends.
+
+        Postgres takes a transaction-level advisory lock. SQLite has one writer at a time, so
+        the caller only has to insert its row (without the hash) before calling find().
+        """
+        if self.db.bind.dialect.name == "postgresql":
+            await self.db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": UPLOAD_ADVISORY_LOCK})
+
+    async def find(self, value: str) -> List[Tuple[int, int]]:
+        """Return (distance, image_id) pairs of stored near-duplicates of a hash.
+
+        For a new upload, call lock_uploads() and insert the row first, then set its hash
+        and commit, or a concurrent upload of the same image can pass the check unseen.
+        """
+        index = await self.get_index()
+        return index.find(hex_to_hash(value), self.max_distance)
+
+    async def refresh(self) -> None:
+        """Index the images committed since the last lookup, such as an upload just stored."""
+        await self.get_index()
+
+    async def original_id(self, image_id: int) -> int:
+        """Follow duplicate_of to the image a duplicate was first uploaded as."""
+        duplicate_of = await self.db.scalar(select(Images.duplicate_of).where(Images.id == image_id))
+        return duplicate_of if duplicate_of is not None else image_id
+
+    async def backfill_hashes(self, batch_size: int = 500) -> int:
+        """Compute hashes for stored images that do not have one yet."""
+        storage = get_storage()
+        updated = 0
+        while True:
+            rows = (await self.db.scalars(
+                select(Images).where(Images.phash.is_(None)).order_by(Images.id).limit(batch_size)
+            )).all()
+            if not rows:
+                return updated
+
+            for row in rows:
+                try:
+                    data = await asyncio.to_thread(storage.read_bytes, row.image_path)
+                    row.phash = self.hash_image(data)
+                    updated += 1
+                except Exception as e:
+                    logger.warning(f"Failed to hash image {row.id} at {row.image_path}: {str(e)}")
+                    # Mark as unhashable so the loop makes progress
+                    row.phash = ""
+            await self.db.commit()
+
+    async def find_duplicates(self) -> Dict[int, List[int]]:
+        """Scan all hashed images in upload order and map each original to its duplicates."""
+        index = PerceptualHashIndex(max_distance=self.max_distance)
+        originals: Dict[int, int] = {}
+        groups: Dict[int, List[int]] = {}
+
+        rows = await self.db.stream(
+            select(Images.id, Images.phash)
+            .where(Images.phash.isnot(None), Images.phash != "")
+            .order_by(Images.id)
+            .execution_options(yield_per=1000)
+        )
+        async for image_id, value in rows:
+            value = hex_to_hash(value)
+            matches = index.find(value, self.max_distance)
+            if matches:
+                original = originals[matches[0][1]]
+                originals[image_id] = original
+                groups.setdefault(original, []).append(image_id)
+            else:
+                originals[image_id] = image_id
+            index.add(image_id, value)
+        return groups
+
+    async def mark_duplicates(self, groups: Dict[int, List[int]], remove: bool = False) -> int:
+        """Flag (or delete) the duplicates found by find_duplicates."""
+        count = 0
+        for original, duplicates in groups.items():
+            if remove:
+                statement = delete(Images).where(Images.id.in_(duplicates))
+            else:
+                statement = update(Images).where(Images.id.in_(duplicates)).values(duplicate_of=original)
+            result = await self.db.execute(statement.execution_options(synchronize_session=False))
+            count += result.rowcount
+        await self.db.commit()
+
+        # The in-process index no longer matches the table
+        DedupService._index = None
+        return count
+
+
+async def run(args: argparse.Namespace) -> None:
+    from app.db.session import AsyncSessionLocal
+
+    async with AsyncSessionLocal() as db:
+        service = DedupService(db, max_distance=args.max_distance)
+        logger.info(f"Hashed {await service.backfill_hashes()} images")
+
+        groups = await service.find_duplicates()
+        for original, duplicates in groups.items():
+            logger.info(f"Image {original}: duplicates {duplicates}")
+        logger.info(f"Found {sum(len(d) for d in groups.values())} duplicates of {len(groups)} images")
+
+        if args.apply or args.delete:
+            count = await service.mark_duplicates(groups, remove=args.delete)
+            logger.info(f"{'Deleted' if args.delete else 'Flagged'} {count} images")
+            if args.delete:
+                await StatsService(db).rebuild()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Find duplicate and near-duplicate images in the images table.")
+    parser.add_argument("--max-distance", type=int, default=None, help="Max Hamming distance for near-duplicates")
+    parser.add_argument("--apply", action="store_true", help="Set duplicate_of on the duplicates found")
+    parser.add_argument("--delete", action="store_true", help="Delete duplicate rows instead of flagging them")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
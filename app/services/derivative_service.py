@@ -0,0 +1,145 @@
+import argparse
+import hashlib
+import io
+import logging
+import os
+import threading
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from app.core.config import settings
+from app.core.packed_store import PackedArrayStore
+from app.ml.feature_extraction import CROP_SIZE, center_crop
+from app.ml.pipeline import create_default_preprocessors
+from app.ml.preprocessing import BackgroundRemovalPreprocessor, PreprocessingPipeline
+
+
+logger = logging.getLogger(__name__)
+
+
+class DerivativeService:
+    """Service for the thumbnails and preprocessed crops generated when an image is ingested.
+
+    Crops depend on the segmentation backend and its settings, so each combination
+    gets its own crop store (see crop_store_name).
+    """
+
+    def __init__(self, root: Optional[str] = None, preprocessing: Optional[PreprocessingPipeline] = None):
+        self.root = root or settings.DERIVATIVES_DIR
+        size = settings.THUMBNAIL_SIZE
+        self.thumbnails = PackedArrayStore(
+            os.path.join(self.root, f"thumb{size}"), (size, size, 3), settings.DERIVATIVE_CHUNK_ITEMS
+        )
+        self._crops: Optional[PackedArrayStore] = None
+        self._crops_lock = threading.Lock()
+        self._preprocessing = preprocessing
+
+    @property
+    def crops(self) -> Optional[PackedArrayStore]:
+        # Opened on first use, since naming it needs the segmentation backend
+        if self._crops is None and settings.DERIVATIVE_CROPS:
+            with self._crops_lock:
+                if self._crops is None:
+                    self._crops = PackedArrayStore(
+                        os.path.join(self.root, crop_store_name(self.preprocessing)),
+                        (CROP_SIZE, CROP_SIZE, 3),
+                        settings.DERIVATIVE_CHUNK_ITEMS
+                    )
+        return self._crops
+
+    @property
+    def preprocessing(self) -> PreprocessingPipeline:
+        # Built on first use so read-only callers never load a segmentation model
+        if self._preprocessing is None:
+            self._preprocessing = PreprocessingPipeline(create_default_preprocessors())
+        return self._preprocessing
+
+    def add(self, image_id: int, data: bytes) -> None:
+        """Decode an uploaded image once and store its thumbnail and crop."""
+        image = Image.open(io.BytesIO(data)).convert("RGB")
+
+        # Pad the thumbnail into a square slot and remember the real size
+        thumbnail = image.copy()
+        thumbnail.thumbnail((settings.THUMBNAIL_SIZE, settings.THUMBNAIL_SIZE))
+        slot = np.zeros(self.thumbnails.item_shape, dtype=np.uint8)
+        slot[:thumbnail.height, :thumbnail.width] = np.asarray(thumbnail)
+        self.thumbnails.put(image_id, slot, thumbnail.height, thumbnail.width)
+
+        if self.crops is not None:
+            self.crops.put(image_id, center_crop(self.preprocessing.process(image)))
+
+    def get_thumbnail(self, image_id: int) -> Optional[Image.Image]:
+        """Return the stored thumbnail for an image, or None."""
+        slot = self.thumbnails.get(image_id)
+        if slot is None:
+            return None
+        height, width = self.thumbnails.content_size(image_id)
+        return Image.fromarray(slot[:height, :width])
+
+    def get_crops(self, image_ids: List[int]) -> Tuple[List[int], np.ndarray]:
+        """Return the ids that have a stored crop and an (n, CROP_SIZE, CROP_SIZE, 3) array of their crops."""
+        if self.crops is None:
+            return [], np.empty((0, CROP_SIZE, CROP_SIZE, 3), dtype=np.uint8)
+        return self.crops.get_many(image_ids)
+
+    def refresh(self) -> None:
+        """Pick up derivatives written by other processes."""
+        self.thumbnails.refresh()
+        if self.crops is not None:
+            self.crops.refresh()
+
+
+def crop_store_name(preprocessing: PreprocessingPipeline) -> str:
+    """Directory of the crops made by a preprocessing pipeline, e.g. crop224_threshold_3f9a1c0b2d4e.
+
+    The suffix hashes each segmentation backend's cache_key (the key masks are cached
+    under), so changing a threshold or model path never serves crops made the old way.
+    """
+    keys = [
+        preprocessor.backend.cache_key if isinstance(preprocessor, BackgroundRemovalPreprocessor) else type(preprocessor).__name__
+        for preprocessor in preprocessing.preprocessors
+    ]
+    digest = hashlib.blake2b("|".join(keys).encode(), digest_size=6).hexdigest()
+    return f"crop{CROP_SIZE}_{settings.SEGMENTATION_BACKEND}_{digest}"
+
+
+@lru_cache
+def get_derivative_service() -> DerivativeService:
+    return DerivativeService()
+
+
+def main() -> None:
+    from app.core.storage import get_storage
+    from app.db.session import SessionLocal
+    from app.services.data_service import DataService
+
+    parser = argparse.ArgumentParser(description="Generate derivatives for images ingested before they existed")
+    parser.add_argument("--season", default=None, help="Only backfill this season")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    derivative_service = get_derivative_service()
+    storage = get_storage()
+    db = SessionLocal()
+    try:
+        created = 0
+        rows = DataService(db, storage).iter_training_data(season=args.season, include_duplicates=True)
+        for image_id, image_path, _ in rows:
+            has_crop = derivative_service.crops is None or image_id in derivative_service.crops
+            if image_id in derivative_service.thumbnails and has_crop:
+                continue
+            try:
+                derivative_service.add(image_id, storage.read_bytes(image_path))
+                created += 1
+            except Exception as e:
+                logger.warning(f"Failed to generate derivatives for image {image_id}: {str(e)}")
+        logger.info(f"Generated derivatives for {created} images")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import csv
+import io
+import json
+from typing import AsyncIterator, Optional
+
+from sqlalchemy import Select, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import Images
+
+
+def training_data_query(after_id: int = 0, limit: int = 1000, season: Optional[str] = None, include_duplicates: bool = False) -> Select:
+    """Select one keyset page of (id, image_path, season) rows with id > after_id.
+
+    Each page is an index range scan that starts where the last one ended, so
+    paging cost does not grow with depth and no transaction stays open between pages.
+    """
+    query = select(Images.id, Images.image_path, Images.season).where(Images.id > after_id)
+    if season is not None:
+        query = query.where(Images.season == season)
+    if not include_duplicates:
+        query = query.where(Images.duplicate_of.is_(None))
+    return query.order_by(Images.id).limit(limit)
+
+
+class ExportService:
+    """Service for streaming the training dataset out of the database."""
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    async def iter_rows(
+        self,
+        batch_size: int = 1000,
+        season: Optional[str] = None,
+        include_duplicates: bool = False,
+        after_id: int = 0
+    ) -> AsyncIterator[tuple]:
+        """Yield (image id, path, season) rows in id order, one page in memory at a time."""
+        while True:
+            result = await self.db.execute(training_data_query(after_id, batch_size, season, include_duplicates))
+            rows = result.all()
+            if not rows:
+                return
+            for row in rows:
+                yield tuple(row)
+            after_id = rows[-1][0]
+
+    async def iter_ndjson(self, **kwargs) -> AsyncIterator[str]:
+        async for image_id, image_path, season in self.iter_rows(**kwargs):
+            yield json.dumps({"id": image_id, "image_path": image_path, "season": season}) + "\n"
+
+    async def iter_csv(self, **kwargs) -> AsyncIterator[str]:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["id", "image_path", "season"])
+        async for row in self.iter_rows(**kwargs):
+            writer.writerow(row)
+            # Flush in chunks rather than one write per row
+            if buffer.tell() > 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
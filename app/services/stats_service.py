@@ -0,0 +1,80 @@
+from typing import Any, Dict, List
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.db.models import Images, SeasonCount
+
+
+# Shared by all requests in the process; cleared whenever this process stores an upload
+stats_cache = TTLCache("stats", ttl=settings.STATS_CACHE_TTL, max_items=8)
+
+
+def season_count_upsert(dialect_name: str, season: str):
+    """Build an INSERT ... ON CONFLICT statement that adds one to a season's count."""
+    insert = postgresql_insert if dialect_name == "postgresql" else sqlite_insert
+    statement = insert(SeasonCount).values(season=season, count=1)
+    return statement.on_conflict_do_update(
+        index_elements=[SeasonCount.season],
+        set_={"count": SeasonCount.count + 1}
+    )
+
+
+class StatsService:
+    """Service for dataset statistics backed by the season_counts summary table."""
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    async def record_upload(self, season: str) -> None:
+        """Increment the count for a season in the caller's transaction.
+
+        Call invalidate() once the transaction is committed.
+        """
+        await self.db.execute(season_count_upsert(self.db.bind.dialect.name, season))
+
+    @staticmethod
+    def invalidate() -> None:
+        stats_cache.invalidate()
+
+    async def get_season_counts(self) -> Dict[str, int]:
+        """Get the number of images per season."""
+        counts = stats_cache.get("season_counts")
+        if counts is None:
+            rows = await self.db.execute(select(SeasonCount.season, SeasonCount.count).order_by(SeasonCount.season))
+            counts = {season: count for season, count in rows if count > 0}
+            stats_cache.set("season_counts", counts)
+        return counts
+
+    async def get_all_seasons(self) -> List[str]:
+        """Get all unique seasons."""
+        return list(await self.get_season_counts())
+
+    async def get_contribution_stats(self) -> Dict[str, Any]:
+        """Get statistics about contributions without scanning the images table."""
+        counts = await self.get_season_counts()
+        return {
+            "total_contributions": sum(counts.values()),
+            "unique_seasons": len(counts),
+            "seasons": list(counts),
+            "season_counts": counts
+        }
+
+    async def rebuild(self) -> None:
+        """Recompute the summary table from the images table."""
+        await self.db.execute(delete(SeasonCount))
+        rows = await self.db.execute(select(Images.season, func.count(Images.id)).group_by(Images.season))
+        self.db.add_all(SeasonCount(season=season, count=count) for season, count in rows)
+        await self.db.commit()
+        stats_cache.invalidate()
+
+    async def rebuild_if_empty(self) -> None:
+        """Fill the summary table the first time it is deployed next to existing images."""
+        has_counts = await self.db.scalar(select(SeasonCount.season).limit(1))
+        has_images = await self.db.scalar(select(Images.id).limit(1))
+        if has_counts is None and has_images is not None:
+            await self.rebuild()
@@ -1,7 +1,8 @@
 import os
 import json
 import logging
-from typing import List, Dict, Any, Optional, Tuple
+from itertools import islice
+from typing import Iterable, Iterator, List, Dict, Any, Optional, Tuple
 from datetime import datetime
 
 import numpy as np
@@ -10,52 +11,63 @@ import io
 from sqlalchemy.orm import Session
 
 from app.core.config import settings
-from app.db.models import ModelVersion
 from app.ml.pipeline import PradaClassificationPipeline, create_default_pipeline
 from app.services.data_service import DataService
+from app.services.derivative_service import DerivativeService, get_derivative_service
 
 
 logger = logging.getLogger(__name__)
 
+# Images decoded and embedded at a time; bounds peak memory regardless of dataset size
+EMBED_CHUNK_SIZE = 256
+
 
 class TrainingService:
     """Service for managing model training."""
     
-    def __init__(self, db: Session, data_service: DataService):
+    def __init__(self, db: Session, data_service: DataService, derivative_service: Optional[DerivativeService] = None):
         self.db = db
         self.data_service = data_service
+        self.derivative_service = derivative_service or get_derivative_service()
         self.pipeline = None
         self.models_dir = "models"
         
         # Create models directory if it doesn't exist
         os.makedirs(self.models_dir, exist_ok=True)
     
+    def save_checkpoint(self, path: str, verified_only: bool = True) -> Dict[str, Any]:
+        """Embed the catalogue and save it as a kNN checkpoint that keeps each row's image id.
+        
+        Without the ids, GET /models/similar/{image_id} cannot find catalogue items in the index.
+        """
+        self.pipeline = create_default_pipeline()
+        rows = self.data_service.iter_training_data(include_duplicates=not verified_only)
+        num_samples = self._fit_streaming(self.pipeline, rows)
+        
+        if num_samples is None:
+            return {"status": "error", "message": "No training data available"}
+        if num_samples == 0:
+            return {"status": "error", "message": "Failed to process any images"}
+        
+        self.pipeline.classifier.save(path)
+        return {"status": "success", "path": path, "num_samples": num_samples}
+    
     def train_model(self, verified_only: bool = True) -> Dict[str, Any]:
         """Train the model on the available data."""
+        # The model_versions table is still commented out of app.db.models
+        from app.db.models import ModelVersion
+        
         try:
-            # Get training data
-            image_urls, labels = self.data_service.get_training_data(verified_only=verified_only)
+            # Create pipeline and embed the dataset as it streams out of the database
+            self.pipeline = create_default_pipeline()
+            rows = self.data_service.iter_training_data(include_duplicates=not verified_only)
+            num_samples = self._fit_streaming(self.pipeline, rows)
             
-            if not image_urls:
+            if num_samples is None:
                 return {"status": "error", "message": "No training data available"}
-            
-            # Download and process images
-            images = []
-            for url in image_urls:
-                try:
-                    image_data = self.data_service.download_image(url)
-                    image = Image.open(io.BytesIO(image_data))
-                    images.append(image)
-                except Exception as e:
-                    logger.warning(f"Failed to process image {url}: {str(e)}")
-            
-            if not images:
+            if num_samples == 0:
                 return {"status": "error", "message": "Failed to process any images"}
             
-            # Create and train pipeline
-            self.pipeline = create_default_pipeline()
-            self.pipeline.fit(images, labels)
-            
             # Save model
             version = datetime.now().strftime("%Y%m%d%H%M%S")
             model_path = os.path.join(self.models_dir, f"prada_classifier_{version}.pt")
@@ -69,7 +81,7 @@ class TrainingService:
             model_version = ModelVersion(
                 version=version,
                 path=model_path,
-                metrics=json.dumps({"num_samples": len(images)}),
+                metrics=json.dumps({"num_samples": num_samples}),
                 is_active=1
             )
             
@@ -84,7 +96,7 @@ class TrainingService:
                 "status": "success",
                 "message": "Model trained successfully",
                 "version": version,
-                "num_samples": len(images)
+                "num_samples": num_samples
             }
         except Exception as e:
             logger.error(f"Error training model: {str(e)}")
@@ -92,6 +104,8 @@ class TrainingService:
     
     def get_model(self, version: Optional[str] = None) -> PradaClassificationPipeline:
         """Get a trained model, either the latest or a specific version."""
+        from app.db.models import ModelVersion
+        
         if self.pipeline is not None and self.pipeline.is_fitted:
             return self.pipeline
         
@@ -112,25 +126,57 @@ class TrainingService:
         self.pipeline = create_default_pipeline()
         
         # Train the model on the available data
-        image_urls, labels = self.data_service.get_training_data(verified_only=True)
+        self._fit_streaming(self.pipeline, self.data_service.iter_training_data())
         
-        if image_urls:
-            images = []
-            for url in image_urls:
+        return self.pipeline
+    
+    def _fit_streaming(self, pipeline: PradaClassificationPipeline, rows: Iterable[Tuple[int, str, str]]) -> Optional[int]:
+        """Embed (id, path, season) rows chunk by chunk and fit the pipeline's classifier.
+        
+        Images with a crop stored at ingest time are read from the packed crop store;
+        only the rest are downloaded, decoded and preprocessed.
+        Returns the number of images used, or None if there were no rows at all.
+        """
+        self.derivative_service.refresh()
+        features, labels, ids = [], [], []
+        seen_rows = False
+        for chunk in _chunks(rows, EMBED_CHUNK_SIZE):
+            seen_rows = True
+            seasons = {image_id: season for image_id, _, season in chunk}
+            crop_ids, crops = self.derivative_service.get_crops(list(seasons))
+            if crop_ids:
+                features.append(pipeline.embed_crops(crops))
+                labels.extend(seasons[image_id] for image_id in crop_ids)
+                ids.extend(crop_ids)
+            
+            has_crop = set(crop_ids)
+            images, chunk_labels, chunk_ids = [], [], []
+            for image_id, image_path, season in chunk:
+                if image_id in has_crop:
+                    continue
                 try:
-                    image_data = self.data_service.download_image(url)
-                    image = Image.open(io.BytesIO(image_data))
-                    images.append(image)
+                    image_data = self.data_service.download_image(image_path)
+                    images.append(Image.open(io.BytesIO(image_data)))
+                    chunk_labels.append(season)
+                    chunk_ids.append(image_id)
                 except Exception as e:
-                    logger.warning(f"Failed to process image {url}: {str(e)}")
+                    logger.warning(f"Failed to process image {image_path}: {str(e)}")
             
             if images:
-                self.pipeline.fit(images, labels)
+                features.append(pipeline.embed_batch(images))
+                labels.extend(chunk_labels)
+                ids.extend(chunk_ids)
         
-        return self.pipeline
+        if not seen_rows:
+            return None
+        if features:
+            pipeline.fit_features(np.vstack(features), labels, ids)
+        return len(labels)
     
     def get_model_versions(self) -> List[Dict[str, Any]]:
         """Get all model versions."""
+        from app.db.models import ModelVersion
+        
         versions = self.db.query(ModelVersion).all()
         return [
             {
@@ -141,4 +187,37 @@ class TrainingService:
                 "created_at": v.created_at.isoformat()
             }
             for v in versions
-        ] 
\ No newline at end of file
+        ]
+
+
+def _chunks(rows: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(rows)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def main() -> None:
+    import argparse
+    
+    from app.db.session import SessionLocal
+    
+    parser = argparse.ArgumentParser(description="Embed the catalogue and save a kNN checkpoint with its image ids")
+    parser.add_argument("--out", default=None, help="Defaults to prada_classifier_<timestamp>.npz next to KNN_CHECKPOINT_PATH")
+    parser.add_argument("--include-duplicates", action="store_true", help="Also embed images flagged as duplicates")
+    args = parser.parse_args()
+    
+    # Next to the served checkpoint, POST /models/switch_models/ can load it by name
+    version = f"prada_classifier_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    out = args.out or os.path.join(os.path.dirname(settings.KNN_CHECKPOINT_PATH), f"{version}.npz")
+    
+    logging.basicConfig(level=logging.INFO)
+    db = SessionLocal()
+    try:
+        result = TrainingService(db, DataService(db)).save_checkpoint(out, verified_only=not args.include_duplicates)
+    finally:
+        db.close()
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Benchmark the /classify endpoint under concurrent load through an in-process ASGI client.
+
+    python -m benchmarks.api --concurrency 1 4 16 --requests 64
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+from benchmarks.common import configure_offline_environment, make_synthetic_jpeg, summarize, write_results
+
+
+CLASSIFY_URL = "/api/v1/models/classify/"
+CLASSIFY_BATCH_URL = "/api/v1/models/classify_batch/"
+
+
+async def _load(client, payload: bytes, concurrency: int, total: int) -> Tuple[List[float], float]:
+    durations = []
+    remaining = [total]
+
+    async def worker() -> None:
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = time.perf_counter()
+            response = await client.post(CLASSIFY_URL, files={"image": ("bench.jpg", payload, "image/jpeg")})
+            durations.append(time.perf_counter() - start)
+            response.raise_for_status()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return durations, time.perf_counter() - start
+
+
+async def _batch(client, payloads: List[bytes], repeat: int) -> List[float]:
+    files = [("images", (f"{i}.jpg", payload, "image/jpeg")) for i, payload in enumerate(payloads)]
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = await client.post(CLASSIFY_BATCH_URL, files=files)
+        response.raise_for_status()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+async def _run(concurrency_levels: List[int], total: int) -> List[Dict]:
+    import httpx
+
+    from app.main import app
+
+    payload = make_synthetic_jpeg()
+    results = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        await _load(client, payload, 1, 2)  # warm up
+        for concurrency in concurrency_levels:
+            durations, wall = await _load(client, payload, concurrency, total)
+            result = summarize("api.classify", durations, params={"concurrency": concurrency})
+            # Throughput under load is requests over wall time, not over summed latency
+            result["items_per_sec"] = len(durations) / wall
+            results.append(result)
+
+        # The same number of images as one /classify_batch request
+        payloads = [make_synthetic_jpeg(seed=seed) for seed in range(total)]
+        durations = await _batch(client, payloads, repeat=2)
+        results.append(summarize("api.classify_batch", durations, items_per_call=total, params={"images": total}))
+    return results
+
+
+def run(quick: bool = False, concurrency_levels: Optional[List[int]] = None, total: Optional[int] = None) -> List[Dict]:
+    """Run the load test. The offline environment must be configured before app is imported."""
+    concurrency_levels = concurrency_levels or ([1, 4] if quick else [1, 4, 16])
+    total = total or (8 if quick else 64)
+    return asyncio.run(_run(concurrency_levels, total))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--quick", action="store_true")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=None)
+    parser.add_argument("--requests", type=int, default=None, help="Requests per concurrency level")
+    parser.add_argument("--catalogue-size", type=int, default=5000)
+    parser.add_argument("--out", default=None, help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    configure_offline_environment(tempfile.mkdtemp(prefix="prada-bench-"), args.catalogue_size)
+    write_results(run(args.quick, args.concurrency, args.requests), args.out)
+
+
+if __name__ == "__main__":
+    main()
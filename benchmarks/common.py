@@ -0,0 +1,144 @@
+"""
+Shared helpers for the offline benchmark suite: synthetic data, timing and result files.
+"""
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+def make_synthetic_images(count: int, size: int, seed: int = 0) -> List[np.ndarray]:
+    """Dark garment-like blobs on a light, slightly noisy studio backdrop."""
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        image = np.full((size, size, 3), 235, dtype=np.uint8)
+        center = tuple(int(c) for c in rng.integers(size // 3, 2 * size // 3, size=2))
+        axes = tuple(int(a) for a in rng.integers(size // 6, size // 3, size=2))
+        color = tuple(int(c) for c in rng.integers(0, 120, size=3))
+        cv2.ellipse(image, center, axes, float(rng.integers(0, 180)), 0, 360, color, -1)
+        noise = rng.integers(-10, 10, size=image.shape, dtype=np.int16)
+        images.append(np.clip(image.astype(np.int16) + noise, 0, 255).astype(np.uint8))
+    return images
+
+
+def make_synthetic_jpeg(size: int = 800, seed: int = 0) -> bytes:
+    """Encode one synthetic image as JPEG bytes, as a client would upload it."""
+    image = make_synthetic_images(1, size, seed)[0]
+    _, encoded = cv2.imencode(".jpg", cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+    return encoded.tobytes()
+
+
+def make_feature_store(n_items: int, n_features: int = 2048, n_seasons: int = 10, seed: int = 0):
+    """Random non-negative embeddings (like ResNet avgpool outputs) with season labels."""
+    rng = np.random.default_rng(seed)
+    features = rng.random((n_items, n_features), dtype=np.float32)
+    labels = [f"{1995 + i // 2}_{'SS' if i % 2 else 'FW'}" for i in rng.integers(0, n_seasons, size=n_items)]
+    return features, labels
+
+
+def write_feature_store(path: str, n_items: int, n_features: int = 2048) -> str:
+    """Write a synthetic kNN checkpoint in the same format as app/ml/ckpts."""
+    features, labels = make_feature_store(n_items, n_features)
+    np.savez(path, X=features, y=np.array(labels), ids=np.arange(1, n_items + 1))
+    return path
+
+
+def configure_offline_environment(workdir: str, catalogue_size: int = 5000) -> None:
+    """Point the app at a throwaway SQLite database, a synthetic kNN checkpoint and
+    untrained ResNet weights. Must run before anything imports app.core.config."""
+    os.makedirs(workdir, exist_ok=True)
+    os.environ["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["KNN_CHECKPOINT_PATH"] = write_feature_store(os.path.join(workdir, "features.npz"), catalogue_size)
+    os.environ["RESNET_PRETRAINED"] = "false"
+    os.environ["IMAGES_DIR"] = os.path.join(workdir, "images")
+    # Benchmarks post the same image repeatedly, which the result cache would answer without running the model
+    os.environ["CLASSIFY_CACHE_TTL"] = "0"
+
+
+def measure(
+    name: str,
+    fn: Callable[[], Any],
+    items_per_call: int = 1,
+    repeat: int = 20,
+    warmup: int = 2,
+    params: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """Time repeated calls of fn and summarise latency and throughput."""
+    for _ in range(warmup):
+        fn()
+
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+
+    return summarize(name, durations, items_per_call, params)
+
+
+def summarize(name: str, durations: List[float], items_per_call: int = 1, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    durations = sorted(durations)
+    return {
+        "name": name,
+        "params": params or {},
+        "n": len(durations),
+        "mean_ms": statistics.mean(durations) * 1000,
+        "p50_ms": durations[len(durations) // 2] * 1000,
+        "p95_ms": durations[min(len(durations) - 1, int(len(durations) * 0.95))] * 1000,
+        "items_per_sec": items_per_call * len(durations) / sum(durations),
+    }
+
+
+def result_key(result: Dict[str, Any]) -> str:
+    """Identify a benchmark case across runs, e.g. 'knn.predict[catalogue_size=1000]'."""
+    params = ",".join(f"{k}={v}" for k, v in sorted(result["params"].items()))
+    return f"{result['name']}[{params}]"
+
+
+def environment() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        commit = None
+
+    info = {
+        "commit": commit,
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+    }
+    try:
+        import torch
+
+        info["torch"] = torch.__version__
+        info["torch_threads"] = torch.get_num_threads()
+    except ImportError:
+        pass
+    return info
+
+
+def write_results(results: List[Dict[str, Any]], path: Optional[str]) -> None:
+    """Print results as JSON lines and, if path is given, save them with the environment."""
+    for result in results:
+        print(json.dumps(result))
+    if path:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"environment": environment(), "results": results}, f, indent=2)
+
+
+def to_pil(images: List[np.ndarray]) -> List[Image.Image]:
+    return [Image.fromarray(image) for image in images]
@@ -0,0 +1,45 @@
+"""
+Compare two benchmark result files and flag regressions in mean latency.
+
+    python -m benchmarks.compare base.json head.json --threshold 0.1
+"""
+import argparse
+import json
+import sys
+from typing import Dict
+
+from benchmarks.common import result_key
+
+
+def load(path: str) -> Dict[str, Dict]:
+    with open(path) as f:
+        return {result_key(result): result for result in json.load(f)["results"]}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("base")
+    parser.add_argument("head")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown counted as a regression")
+    args = parser.parse_args()
+
+    base, head = load(args.base), load(args.head)
+    regressions = 0
+    print(f"{'case':60} {'base ms':>10} {'head ms':>10} {'change':>8}")
+    for key in sorted(set(base) & set(head)):
+        before, after = base[key]["mean_ms"], head[key]["mean_ms"]
+        change = (after - before) / before if before else 0.0
+        flag = ""
+        if change > args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{key:60} {before:10.2f} {after:10.2f} {change:+8.1%}{flag}")
+
+    for key in sorted(set(base) ^ set(head)):
+        print(f"{key:60} only in {'base' if key in base else 'head'}")
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
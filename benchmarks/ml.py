@@ -0,0 +1,194 @@
+"""
+Benchmark the ml pipeline stages on synthetic images and a synthetic feature store.
+
+    python -m benchmarks.ml --out bench_results/ml.json
+"""
+import argparse
+import io
+import tempfile
+from typing import Dict, List
+
+import numpy as np
+from PIL import Image
+
+from app.core.packed_store import PackedArrayStore
+from app.ml.classifiers import EnsembleClassifier, NearestNeighborClassifier
+from app.ml.compaction import compact_classifier
+from app.ml.feature_extraction import CROP_SIZE, ResNetFeatureExtractor, center_crop
+from app.ml.pipeline import PradaClassificationPipeline
+from app.ml.preprocessing import BackgroundRemovalPreprocessor, PreprocessingPipeline
+from benchmarks.common import make_feature_store, make_synthetic_images, make_synthetic_jpeg, measure, to_pil, write_results
+
+
+def bench_preprocessing(images: List[np.ndarray], repeat: int) -> List[Dict]:
+    preprocessing = PreprocessingPipeline([BackgroundRemovalPreprocessor()])
+    pil_images = to_pil(images)
+    return [
+        measure("preprocess.process", lambda: preprocessing.process(pil_images[0]), repeat=repeat),
+        measure(
+            "preprocess.process_batch",
+            lambda: preprocessing.process_batch(pil_images),
+            items_per_call=len(pil_images),
+            repeat=max(1, repeat // 4),
+            params={"batch_size": len(pil_images)}
+        ),
+    ]
+
+
+def bench_extraction(extractor: ResNetFeatureExtractor, images: List[np.ndarray], batch_sizes: List[int], repeat: int) -> List[Dict]:
+    pil_images = to_pil(images)
+    results = []
+    for batch_size in batch_sizes:
+        batch = pil_images[:batch_size]
+        extractor.batch_size = batch_size
+        results.append(measure(
+            "extract.batch",
+            lambda: extractor.extract_batch(batch),
+            items_per_call=batch_size,
+            repeat=max(1, repeat // batch_size),
+            params={"batch_size": batch_size}
+        ))
+    return results
+
+
+def bench_reembed_inputs(n_images: int, repeat: int) -> List[Dict]:
+    """Compare getting extractor inputs by decoding and preprocessing JPEGs against reading packed crops."""
+    preprocessing = PreprocessingPipeline([BackgroundRemovalPreprocessor()])
+    jpegs = [make_synthetic_jpeg(seed=seed) for seed in range(n_images)]
+    store = PackedArrayStore(tempfile.mkdtemp(prefix="prada-bench-crops-"), (CROP_SIZE, CROP_SIZE, 3))
+    for image_id, data in enumerate(jpegs):
+        store.put(image_id, center_crop(preprocessing.process(Image.open(io.BytesIO(data)))))
+    
+    def decode():
+        images = [Image.open(io.BytesIO(data)) for data in jpegs]
+        return [center_crop(image) for image in preprocessing.process_batch(images)]
+    
+    params = {"n_images": n_images}
+    return [
+        measure("reembed.decode", decode, items_per_call=n_images, repeat=repeat, params=params),
+        measure("reembed.packed", lambda: store.get_many(list(range(n_images))), items_per_call=n_images, repeat=repeat, params=params),
+    ]
+
+
+def bench_knn(catalogue_sizes: List[int], repeat: int) -> List[Dict]:
+    results = []
+    for size in catalogue_sizes:
+        features, labels = make_feature_store(size)
+        classifier = NearestNeighborClassifier(n_neighbors=5)
+        classifier.fit(features, labels)
+        query = np.random.default_rng(1).random(features.shape[1], dtype=np.float32)
+        results.append(measure(
+            "knn.predict", lambda: classifier.predict(query), repeat=repeat, params={"catalogue_size": size}
+        ))
+    return results
+
+
+def bench_ensemble(catalogue_size: int, batch_size: int, repeat: int) -> List[Dict]:
+    """Sequential (n_jobs=1) against concurrent member prediction for a three-member kNN ensemble."""
+    features, labels = make_feature_store(catalogue_size)
+    queries = np.random.default_rng(1).random((batch_size, features.shape[1]), dtype=np.float32)
+    results = []
+    for n_jobs in (1, 3):
+        ensemble = EnsembleClassifier(
+            [
+                NearestNeighborClassifier(n_neighbors=5),
+                NearestNeighborClassifier(n_neighbors=9, metric="cosine"),
+                NearestNeighborClassifier(n_neighbors=15, metric="manhattan"),
+            ],
+            weights=[0.5, 0.3, 0.2],
+            n_jobs=n_jobs
+        )
+        ensemble.fit(features, labels)
+        results.append(measure(
+            "ensemble.predict_proba",
+            lambda: ensemble.predict_proba(queries),
+            items_per_call=batch_size,
+            repeat=repeat,
+            params={"catalogue_size": catalogue_size, "batch_size": batch_size, "n_jobs": n_jobs}
+        ))
+        ensemble.close()
+    return results
+
+
+def bench_compaction(catalogue_size: int, repeat: int) -> List[Dict]:
+    """kNN latency and held-out accuracy before and after compacting a catalogue where items appear 1-5 times."""
+    rng = np.random.default_rng(2)
+    features, labels = make_feature_store(catalogue_size // 3)
+    copies = rng.integers(1, 6, size=len(features))
+    features = np.repeat(features, copies, axis=0)
+    features += rng.normal(0, 0.01, size=features.shape).astype(np.float32)
+    labels = np.repeat(labels, copies)
+
+    held_out = rng.random(len(features)) < 0.1
+    before = NearestNeighborClassifier(n_neighbors=5)
+    before.fit(features[~held_out], labels[~held_out])
+    after = compact_classifier(before)
+    queries, query_labels = features[held_out][:200], labels[held_out][:200]
+
+    results = []
+    for index, classifier in (("before", before), ("after", after)):
+        result = measure(
+            "compaction.predict_proba",
+            lambda: classifier.predict_proba(queries),
+            items_per_call=len(queries),
+            repeat=repeat,
+            params={"catalogue_size": len(features), "index": index}
+        )
+        result["rows"] = len(classifier.features)
+        result["accuracy"] = float(np.mean(classifier.classes[classifier.predict_proba(queries).argmax(axis=1)] == query_labels))
+        results.append(result)
+    return results
+
+
+def bench_end_to_end(extractor: ResNetFeatureExtractor, images: List[np.ndarray], catalogue_size: int, repeat: int) -> List[Dict]:
+    features, labels = make_feature_store(catalogue_size)
+    classifier = NearestNeighborClassifier(n_neighbors=5)
+    classifier.fit(features, labels)
+    pipeline = PradaClassificationPipeline(
+        preprocessors=[BackgroundRemovalPreprocessor()],
+        feature_extractors=[extractor],
+        classifier=classifier,
+        version="benchmark"
+    )
+    image = to_pil(images[:1])[0]
+    # A full-outfit photo: three garments side by side
+    outfit = to_pil([np.hstack(images[:3])])[0]
+    return [
+        measure("pipeline.predict", lambda: pipeline.predict(image), repeat=repeat, params={"catalogue_size": catalogue_size}),
+        measure(
+            "pipeline.predict_regions", lambda: pipeline.predict_regions(outfit, max_regions=3),
+            repeat=repeat, params={"catalogue_size": catalogue_size, "max_regions": 3}
+        )
+    ]
+
+
+def run(quick: bool = False) -> List[Dict]:
+    repeat = 5 if quick else 20
+    batch_sizes = [1, 8] if quick else [1, 8, 32]
+    catalogue_sizes = [500, 5000] if quick else [500, 5000, 50000]
+
+    images = make_synthetic_images(max(batch_sizes), 800)
+    extractor = ResNetFeatureExtractor(model_name="resnet50", pretrained=False)
+
+    results = []
+    results.extend(bench_preprocessing(images, repeat))
+    results.extend(bench_extraction(extractor, images, batch_sizes, repeat * 2))
+    results.extend(bench_reembed_inputs(max(batch_sizes), repeat))
+    results.extend(bench_knn(catalogue_sizes, repeat * 5))
+    results.extend(bench_ensemble(catalogue_sizes[1], 32, repeat))
+    results.extend(bench_compaction(catalogue_sizes[1], repeat))
+    results.extend(bench_end_to_end(extractor, images, catalogue_sizes[-1], repeat))
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--quick", action="store_true", help="Fewer repeats and smaller sizes")
+    parser.add_argument("--out", default=None, help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    write_results(run(args.quick), args.out)
+
+
+if __name__ == "__main__":
+    main()
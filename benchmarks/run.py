@@ -0,0 +1,47 @@
+"""
+Run the offline benchmark suite and write machine-readable results.
+
+    python -m benchmarks.run --out bench_results/$(git rev-parse --short HEAD).json
+    python -m benchmarks.compare bench_results/<base>.json bench_results/<head>.json
+"""
+import argparse
+import tempfile
+
+from benchmarks.common import configure_offline_environment, write_results
+
+
+SUITES = ["segmentation", "ml", "api"]
+# Slow (real server processes, many forward passes per query), so only run when asked for
+OPTIONAL_SUITES = ["serving", "tta"]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--suites", nargs="+", choices=SUITES + OPTIONAL_SUITES, default=SUITES)
+    parser.add_argument("--quick", action="store_true", help="Fewer repeats and smaller sizes")
+    parser.add_argument("--catalogue-size", type=int, default=5000, help="Size of the synthetic kNN index used by the API")
+    parser.add_argument("--out", default=None, help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    # Settings are read on first import of the app, so configure before importing suites
+    configure_offline_environment(tempfile.mkdtemp(prefix="prada-bench-"), args.catalogue_size)
+
+    from benchmarks import api, ml, segmentation, serving, tta
+
+    results = []
+    if "segmentation" in args.suites:
+        results.extend(segmentation.run(args.quick, backends=["threshold", "contour", "grabcut"]))
+    if "ml" in args.suites:
+        results.extend(ml.run(args.quick))
+    if "api" in args.suites:
+        results.extend(api.run(args.quick))
+    if "serving" in args.suites:
+        results.extend(serving.run(args.quick))
+    if "tta" in args.suites:
+        results.extend(tta.run(args.quick))
+
+    write_results(results, args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark masks/sec for each segmentation backend on 32 synthetic 800px garment photos (8 with --quick).
+
+    python -m benchmarks.segmentation --backends threshold contour grabcut --out bench_results/segmentation.json
+    python -m benchmarks.segmentation --quick --backends onnx --model-path path/to/model.onnx
+"""
+import argparse
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from app.ml.preprocessing import BackgroundRemovalPreprocessor
+from app.ml.segmentation import MaskCache, create_segmentation_backend
+from benchmarks.common import make_synthetic_images, summarize, write_results
+
+
+DEFAULT_BACKENDS = ["threshold", "contour", "grabcut", "torch"]
+
+
+def bench_backend(name: str, images: List[np.ndarray], model_path: Optional[str] = None) -> List[Dict]:
+    backend = create_segmentation_backend(name, model_path)
+    preprocessor = BackgroundRemovalPreprocessor(backend=backend, cache=MaskCache(max_bytes=sum(image.shape[0] * image.shape[1] for image in images)))
+    params = {"backend": name, "size": images[0].shape[0]}
+
+    # Warm up (model load, allocator, lazy init)
+    backend.segment_batch(images[:2])
+
+    start = time.perf_counter()
+    preprocessor.get_masks(images)
+    cold = time.perf_counter() - start
+
+    start = time.perf_counter()
+    preprocessor.get_masks(images)
+    cached = time.perf_counter() - start
+
+    return [
+        summarize("segmentation.masks", [cold], len(images), params),
+        summarize("segmentation.cached_masks", [cached], len(images), params),
+    ]
+
+
+def run(quick: bool = False, backends: Optional[List[str]] = None, model_path: Optional[str] = None) -> List[Dict]:
+    images = make_synthetic_images(8 if quick else 32, 800)
+    results = []
+    for name in backends or DEFAULT_BACKENDS:
+        try:
+            results.extend(bench_backend(name, images, model_path))
+        except Exception as e:
+            print(f"Skipping segmentation backend {name}: {str(e)}")
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--quick", action="store_true")
+    parser.add_argument("--backends", nargs="+", default=DEFAULT_BACKENDS)
+    parser.add_argument("--model-path", default=None, help="Model file for the torch/onnx backends")
+    parser.add_argument("--out", default=None, help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    write_results(run(args.quick, args.backends, args.model_path), args.out)
+
+
+if __name__ == "__main__":
+    main()
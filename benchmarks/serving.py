@@ -0,0 +1,162 @@
+"""
+Measure memory per worker and /classify throughput for `python -m app.serve`,
+with the pipeline shared by forking (preload) and loaded in every worker (no preload).
+
+    python -m benchmarks.serving --workers 1 2 4 --out bench_results/serving.json
+
+Linux only: memory is read from /proc/<pid>/smaps_rollup. PSS (proportional set size)
+splits shared pages between the processes sharing them, so summed PSS is the real
+footprint, while RSS counts shared weights once per worker.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from benchmarks.common import configure_offline_environment, make_synthetic_jpeg, summarize, write_results
+
+
+CLASSIFY_URL = "/api/v1/models/classify/"
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _children(pid: int) -> List[int]:
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The ppid is the 2nd field after the parenthesised command name
+                if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                    children.append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+    return children
+
+
+def _memory_mb(pid: int) -> Dict[str, float]:
+    memory = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            field, _, value = line.partition(":")
+            if field in ("Rss", "Pss"):
+                memory[field.lower()] = int(value.split()[0]) / 1024
+    return memory
+
+
+def _wait_ready(server: subprocess.Popen, port: int, timeout: float) -> None:
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with code {server.returncode} before becoming ready")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/health", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"Server on port {port} did not become ready")
+
+
+async def _load(port: int, payload: bytes, concurrency: int, total: int):
+    import httpx
+
+    durations = []
+    remaining = [total]
+
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=None) as client:
+        async def worker() -> None:
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                start = time.perf_counter()
+                response = await client.post(CLASSIFY_URL, files={"image": ("bench.jpg", payload, "image/jpeg")})
+                durations.append(time.perf_counter() - start)
+                response.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return durations, time.perf_counter() - start
+
+
+def bench_server(workers: int, preload: bool, threads: int, total: int, payload: bytes) -> Dict:
+    port = _free_port()
+    command = [
+        sys.executable, "-m", "app.serve", "--host", "127.0.0.1", "--port", str(port),
+        "--workers", str(workers), "--threads", str(threads), "--log-level", "warning"
+    ]
+    if not preload:
+        command.append("--no-preload")
+
+    server = subprocess.Popen(command)
+    try:
+        _wait_ready(server, port, timeout=300)
+        # Every worker must be up before memory is read and load is applied
+        while len(_children(server.pid)) < workers:
+            time.sleep(0.5)
+        asyncio.run(_load(port, payload, workers * 2, workers * 4))  # warm up
+
+        durations, wall = asyncio.run(_load(port, payload, workers * 2, total))
+        memory = [_memory_mb(pid) for pid in _children(server.pid)]
+        parent = _memory_mb(server.pid)
+    finally:
+        server.terminate()
+        server.wait(timeout=60)
+
+    result = summarize(
+        "serving.classify", durations, params={"workers": workers, "preload": preload, "threads": threads}
+    )
+    result["items_per_sec"] = len(durations) / wall
+    result["rss_mb_per_worker"] = sum(m["rss"] for m in memory) / len(memory)
+    result["pss_mb_per_worker"] = sum(m["pss"] for m in memory) / len(memory)
+    # The parent's pages are shared with the workers, so it counts toward the real footprint
+    result["total_pss_mb"] = sum(m["pss"] for m in memory) + parent["pss"]
+    return result
+
+
+def run(
+    quick: bool = False,
+    worker_counts: Optional[List[int]] = None,
+    threads: int = 1,
+    total: Optional[int] = None
+) -> List[Dict]:
+    """Run each worker count with and without preload. The offline environment must be configured first."""
+    worker_counts = worker_counts or ([1, 2] if quick else [1, 2, 4])
+    total = total or (16 if quick else 64)
+    payload = make_synthetic_jpeg()
+
+    results = []
+    for workers in worker_counts:
+        for preload in (True, False):
+            results.append(bench_server(workers, preload, threads, total, payload))
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true")
+    parser.add_argument("--workers", nargs="+", type=int, default=None)
+    parser.add_argument("--threads", type=int, default=1, help="Intra-op threads per worker")
+    parser.add_argument("--requests", type=int, default=None, help="Requests per configuration")
+    parser.add_argument("--catalogue-size", type=int, default=5000)
+    parser.add_argument("--out", default=None, help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    configure_offline_environment(tempfile.mkdtemp(prefix="prada-bench-"), args.catalogue_size)
+    write_results(run(args.quick, args.workers, args.threads, args.requests), args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Benchmark the accuracy gain and added latency of test-time augmentation configurations.
+
+    python -m benchmarks.tta --out bench_results/tta.json
+    python -m benchmarks.tta --images-dir data/labelled --pretrained
+
+Without --images-dir, a synthetic catalogue of centred garments is queried with
+off-centre, mirrored photos of the same garments, and ResNet has random weights,
+so only the relative accuracy of configurations is meaningful. --images-dir takes
+a folder of <season>/<image>.jpg and holds out every fifth image per season as a query.
+"""
+import argparse
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from app.ml.augmentation import TestTimeAugmentation
+from app.ml.classifiers import NearestNeighborClassifier
+from app.ml.feature_extraction import ResNetFeatureExtractor
+from app.ml.pipeline import PradaClassificationPipeline
+from app.ml.preprocessing import BackgroundRemovalPreprocessor
+from benchmarks.common import summarize, write_results
+
+
+# name -> TestTimeAugmentation kwargs; None is the plain single centre crop
+CONFIGS = {
+    "none": None,
+    "flip": {"flips": True},
+    "five_crop": {"flips": False, "crops": 5},
+    "five_crop_flip": {"flips": True, "crops": 5},
+    "five_crop_flip_scales": {"flips": True, "crops": 5, "scales": (1.0, 0.8)},
+    "five_crop_flip_vote": {"flips": True, "crops": 5, "aggregation": "vote"},
+}
+
+
+def make_labelled_synthetic(n_per_class: int, n_classes: int, size: int, off_centre: bool, seed: int) -> Tuple[List[Image.Image], List[str]]:
+    """Each class is a garment colour and silhouette; queries are shifted off-centre and mirrored."""
+    rng = np.random.default_rng(seed)
+    class_colors = np.random.default_rng(1234).integers(0, 160, size=(n_classes, 3))
+    images, labels = [], []
+    for label in range(n_classes):
+        for _ in range(n_per_class):
+            image = np.full((size, size, 3), 235, dtype=np.uint8)
+            axes = (size // 8 + 6 * label, size // 4 - 4 * label)
+            shift = rng.integers(-size // 4, size // 4, size=2) if off_centre else rng.integers(-8, 8, size=2)
+            center = (int(size // 2 + shift[0]), int(size // 2 + shift[1]))
+            color = tuple(int(c) for c in np.clip(class_colors[label] + rng.integers(-15, 15, size=3), 0, 255))
+            cv2.ellipse(image, center, axes, float(rng.integers(-15, 15)), 0, 360, color, -1)
+            if off_centre and rng.random() < 0.5:
+                image = image[:, ::-1]
+            noise = rng.integers(-10, 10, size=image.shape, dtype=np.int16)
+            images.append(Image.fromarray(np.clip(image.astype(np.int16) + noise, 0, 255).astype(np.uint8)))
+            labels.append(f"class_{label}")
+    return images, labels
+
+
+def load_labelled_dir(path: str) -> Tuple[List[Image.Image], List[str], List[Image.Image], List[str]]:
+    """Split <season>/<image> folders into catalogue and query sets."""
+    catalogue, catalogue_labels, queries, query_labels = [], [], [], []
+    for season in sorted(os.listdir(path)):
+        season_dir = os.path.join(path, season)
+        if not os.path.isdir(season_dir):
+            continue
+        for i, filename in enumerate(sorted(os.listdir(season_dir))):
+            image = Image.open(os.path.join(season_dir, filename)).convert("RGB")
+            if i % 5 == 4:
+                queries.append(image)
+                query_labels.append(season)
+            else:
+                catalogue.append(image)
+                catalogue_labels.append(season)
+    return catalogue, catalogue_labels, queries, query_labels
+
+
+def bench_config(
+    pipeline: PradaClassificationPipeline,
+    name: str,
+    kwargs: Optional[Dict],
+    queries: List[Image.Image],
+    labels: List[str]
+) -> Dict:
+    pipeline.tta = TestTimeAugmentation(**kwargs) if kwargs is not None else None
+    pipeline.predict(queries[0])  # warm up
+
+    durations, correct, views = [], 0, 0
+    for image, label in zip(queries, labels):
+        start = time.perf_counter()
+        result = pipeline.predict(image)
+        durations.append(time.perf_counter() - start)
+        correct += result["season"] == label
+        views += result.get("tta_views", 1)
+
+    result = summarize("tta.predict", durations, params={"config": name})
+    result["accuracy"] = correct / len(queries)
+    result["views"] = views / len(queries)
+    return result
+
+
+def run(
+    quick: bool = False,
+    images_dir: Optional[str] = None,
+    pretrained: bool = False,
+    configs: Optional[List[str]] = None
+) -> List[Dict]:
+    if images_dir:
+        catalogue, catalogue_labels, queries, query_labels = load_labelled_dir(images_dir)
+    else:
+        n_per_class = 10 if quick else 40
+        catalogue, catalogue_labels = make_labelled_synthetic(n_per_class, 6, 320, off_centre=False, seed=0)
+        queries, query_labels = make_labelled_synthetic(max(2, n_per_class // 4), 6, 320, off_centre=True, seed=1)
+
+    pipeline = PradaClassificationPipeline(
+        preprocessors=[BackgroundRemovalPreprocessor()],
+        feature_extractors=[ResNetFeatureExtractor(model_name="resnet50", pretrained=pretrained)],
+        classifier=NearestNeighborClassifier(n_neighbors=5),
+        version="benchmark"
+    )
+    pipeline.fit_features(pipeline.embed_batch(catalogue), catalogue_labels)
+
+    results = []
+    for name in configs or list(CONFIGS):
+        results.append(bench_config(pipeline, name, CONFIGS[name], queries, query_labels))
+
+    baseline = results[0]
+    for result in results:
+        result["accuracy_gain"] = result["accuracy"] - baseline["accuracy"]
+        result["added_ms"] = result["mean_ms"] - baseline["mean_ms"]
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true")
+    parser.add_argument("--images-dir", default=None, help="Labelled <season>/<image> folders to evaluate on")
+    parser.add_argument("--pretrained", action="store_true", help="Use ImageNet weights (downloads them)")
+    parser.add_argument("--configs", nargs="+", choices=list(CONFIGS), default=None,
+                        help="Configurations to compare; the first one is the baseline")
+    parser.add_argument("--out", default=None, help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    write_results(run(args.quick, args.images_dir, args.pretrained, args.configs), args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+import os
+
+# Tests never connect to a database; SQLite lets API modules be imported without a Postgres driver
+os.environ.setdefault("SQLALCHEMY_DATABASE_URI", "sqlite://")
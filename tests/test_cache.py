@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+from app.core import cache
+from app.core.cache import SingleFlight, TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(cache.time, "monotonic", fake)
+    return fake
+
+
+def test_entries_expire_after_ttl(clock):
+    ttl_cache = TTLCache("test", ttl=10)
+    ttl_cache.set("a", 1)
+
+    clock.now += 9.9
+    assert ttl_cache.get("a") == 1
+    clock.now += 0.1
+    assert ttl_cache.get("a") is None
+    assert len(ttl_cache) == 0
+
+
+def test_setting_again_restarts_the_ttl(clock):
+    ttl_cache = TTLCache("test", ttl=10)
+    ttl_cache.set("a", 1)
+    clock.now += 8
+    ttl_cache.set("a", 2)
+    clock.now += 8
+    assert ttl_cache.get("a") == 2
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    ttl_cache = TTLCache("test", ttl=10, max_items=2)
+    ttl_cache.set("a", 1)
+    ttl_cache.set("b", 2)
+    ttl_cache.get("a")
+    ttl_cache.set("c", 3)
+    assert ttl_cache.get("b") is None
+    assert ttl_cache.get("a") == 1 and ttl_cache.get("c") == 3
+
+
+def test_singleflight_shares_overlapping_calls_only():
+    flight = SingleFlight("test")
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    async def run():
+        overlapping = await asyncio.gather(*(flight.do("key", compute) for _ in range(5)))
+        later = await flight.do("key", compute)
+        return overlapping, later
+
+    overlapping, later = asyncio.run(run())
+    assert [result for result, _ in overlapping] == [1] * 5
+    assert [shared for _, shared in overlapping] == [False] + [True] * 4
+    # The finished call is forgotten, so the next one runs again
+    assert later == (2, False)
+    assert len(flight) == 0
+
+
+def test_singleflight_forgets_failed_calls():
+    flight = SingleFlight("test")
+
+    async def fail():
+        raise RuntimeError("boom")
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            await flight.do("key", fail)
+        return len(flight)
+
+    assert asyncio.run(run()) == 0
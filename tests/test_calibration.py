@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from app.ml.calibration import KNNCalibrator, vote_probabilities
+
+
+def random_neighbors(n: int = 2000, k: int = 7, n_classes: int = 3, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    distances = np.sort(rng.uniform(0.5, 2.0, size=(n, k)), axis=1)
+    neighbor_labels = rng.integers(0, n_classes, size=(n, k))
+    return distances, neighbor_labels
+
+
+def isotonic_calibrator(x, y) -> KNNCalibrator:
+    calibrator = KNNCalibrator("isotonic")
+    calibrator.isotonic_x = np.array(x, dtype=float)
+    calibrator.isotonic_y = np.array(y, dtype=float)
+    return calibrator
+
+
+@pytest.mark.parametrize("y", [
+    [0.1, 0.2, 0.3],   # confidence lowered everywhere, even below uniform
+    [0.5, 0.9, 1.0],   # confidence raised everywhere
+    [0.2, 0.6, 0.95],  # lowered for weak votes, raised for strong ones
+])
+def test_isotonic_calibration_keeps_the_vote_winner(y):
+    distances, neighbor_labels = random_neighbors()
+    raw = vote_probabilities(distances, neighbor_labels, 3)
+    calibrated = isotonic_calibrator([0.34, 0.6, 1.0], y).predict_proba(distances, neighbor_labels, 3)
+
+    assert np.array_equal(calibrated.argmax(axis=1), raw.argmax(axis=1))
+    np.testing.assert_allclose(calibrated.sum(axis=1), 1.0)
+    assert (calibrated > 0).all()
+
+
+def test_isotonic_calibration_sets_the_top_share_to_the_fitted_confidence():
+    distances = np.ones((1, 3))
+    neighbor_labels = np.array([[0, 2, 2]])
+    # A fitted confidence below uniform is floored there, with the winner still just ahead
+    calibrated = isotonic_calibrator([0.0, 1.0], [0.25, 0.25]).predict_proba(distances, neighbor_labels, 3)[0]
+    assert calibrated.argmax() == 2
+    assert calibrated[2] == pytest.approx(max(0.25, 1 / 3), abs=1e-3)
+
+
+def test_fitted_isotonic_calibration_keeps_the_vote_winner():
+    distances, neighbor_labels = random_neighbors(seed=1)
+    rng = np.random.default_rng(2)
+    raw = vote_probabilities(distances / np.median(distances[:, 0]), neighbor_labels, 3)
+    # Labels that agree with the vote only part of the time, so the fitted map lowers confidence
+    labels = np.where(rng.random(len(raw)) < 0.4, raw.argmax(axis=1), rng.integers(0, 3, len(raw)))
+
+    calibrator = KNNCalibrator("isotonic").fit(distances, neighbor_labels, labels, 3)
+    calibrated = calibrator.predict_proba(distances, neighbor_labels, 3)
+
+    assert np.array_equal(calibrated.argmax(axis=1), raw.argmax(axis=1))
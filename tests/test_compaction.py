@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from app.ml.calibration import KNNCalibrator, calibrate_classifier, default_calibration_path
+from app.ml.classifiers import NearestNeighborClassifier
+from app.ml.compaction import compact_classifier, condense, publish_checkpoint
+
+
+def two_seasons(n_per_season: int = 500, dims: int = 16, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    features = np.vstack([
+        rng.normal(0.0, 1.0, size=(n_per_season, dims)),
+        rng.normal(20.0, 1.0, size=(n_per_season, dims)),
+    ])
+    labels = np.repeat([0, 1], n_per_season)
+    return features, labels
+
+
+@pytest.mark.parametrize("n_neighbors", [3, 5, 6, 7, 8, 10])
+def test_condense_drops_interior_of_separated_seasons(n_neighbors):
+    features, labels = two_seasons()
+    keep = condense(features, labels, np.arange(len(features)), n_neighbors)
+    # Only the seed rows of each season are needed when every vote is unanimous
+    assert keep.sum() == 2 * n_neighbors
+
+
+@pytest.mark.parametrize("min_agreement", [0.6, 0.8, 1.0])
+def test_condense_min_agreement_is_exact_for_fractional_shares(min_agreement):
+    features, labels = two_seasons()
+    keep = condense(features, labels, np.arange(len(features)), 5, min_agreement=min_agreement)
+    assert keep.sum() == 10
+
+
+@pytest.mark.parametrize("n_neighbors", [5, 6, 7])
+def test_compacted_classifier_keeps_accuracy_and_ids(n_neighbors):
+    features, labels = two_seasons()
+    seasons = np.array(["SS99", "FW99"])[labels]
+    classifier = NearestNeighborClassifier(n_neighbors=n_neighbors)
+    classifier.fit(features, seasons, ids=np.arange(len(features)))
+
+    compacted = compact_classifier(classifier)
+
+    assert len(compacted.features) < len(features) // 10
+    predicted = compacted.classes[compacted.predict_proba(features).argmax(axis=1)]
+    assert np.mean(predicted == seasons) == 1.0
+    # Every catalogue item can still be looked up, through an alias if its row was dropped
+    assert all(compacted.row_for_id(image_id) is not None for image_id in range(len(features)))
+
+
+def test_compaction_refits_calibration_and_publishes_it_with_the_checkpoint(tmp_path):
+    features, labels = two_seasons()
+    classifier = NearestNeighborClassifier(n_neighbors=5)
+    classifier.fit(features, np.array(["SS99", "FW99"])[labels])
+    classifier.calibrator, _ = calibrate_classifier(classifier, target_accuracy=0.9)
+    classifier.abstain_threshold = classifier.calibrator.abstain_threshold
+
+    compacted = compact_classifier(classifier)
+    assert compacted.calibrator is not classifier.calibrator
+    assert compacted.abstain_threshold == classifier.abstain_threshold
+
+    path = str(tmp_path / "features_labels_compacted.npz")
+    publish_checkpoint(compacted, path)
+    assert np.load(path)["X"].shape == compacted.features.shape
+    assert KNNCalibrator.load(default_calibration_path(path)).temperature == compacted.calibrator.temperature
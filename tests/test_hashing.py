@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from app.ml.hashing import PerceptualHashIndex, hamming
+
+
+def hashes_with_near_duplicates(n: int = 2000, seed: int = 0):
+    """Random 64-bit hashes, half of them copies of earlier ones with a few bits flipped."""
+    rng = np.random.default_rng(seed)
+    values = [int(v) for v in rng.integers(0, 2**63, size=n // 2, dtype=np.int64)]
+    for _ in range(n - len(values)):
+        value = values[rng.integers(len(values))]
+        for bit in rng.choice(64, size=rng.integers(0, 7), replace=False):
+            value ^= 1 << int(bit)
+        values.append(value)
+    return values
+
+
+@pytest.mark.parametrize("max_distance", [0, 1, 2, 4])
+def test_find_matches_brute_force(max_distance):
+    values = hashes_with_near_duplicates()
+    index = PerceptualHashIndex(enumerate(values), max_distance=4)
+
+    for query in values[::7]:
+        expected = sorted(
+            (hamming(query, value), item_id) for item_id, value in enumerate(values)
+            if hamming(query, value) <= max_distance
+        )
+        assert index.find(query, max_distance) == expected
+
+
+def test_find_beyond_the_indexed_distance_is_refused():
+    index = PerceptualHashIndex([(1, 0)], max_distance=2)
+    with pytest.raises(ValueError):
+        index.find(0, 3)
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from app.core.packed_store import PackedArrayStore
+
+
+def item(value: int, shape=(4, 4, 3)) -> np.ndarray:
+    return np.full(shape, value, dtype=np.uint8)
+
+
+def test_items_round_trip_across_chunks(tmp_path):
+    store = PackedArrayStore(str(tmp_path), (4, 4, 3), chunk_items=3)
+    for key in range(10):
+        store.put(key, item(key), height=key % 4 + 1, width=2)
+
+    assert len(store) == 10 and 9 in store and 10 not in store
+    assert all(np.array_equal(store.get(key), item(key)) for key in range(10))
+    assert store.content_size(5) == (2, 2)
+    assert store.get(10) is None and store.content_size(10) is None
+    assert sorted(p.name for p in tmp_path.glob("chunk_*")) == [f"chunk_{i:05d}.u8" for i in range(4)]
+
+
+def test_get_many_keeps_key_order_and_skips_missing(tmp_path):
+    store = PackedArrayStore(str(tmp_path), (4, 4, 3), chunk_items=3)
+    for key in range(10):
+        store.put(key, item(key))
+
+    found, items = store.get_many([7, 42, 1, 8, 0, 4])
+    assert found == [7, 1, 8, 0, 4]
+    assert items.shape == (5, 4, 4, 3)
+    assert [int(i[0, 0, 0]) for i in items] == found
+
+    found, items = store.get_many([42])
+    assert found == [] and items.shape == (0, 4, 4, 3)
+
+
+def test_last_write_wins(tmp_path):
+    store = PackedArrayStore(str(tmp_path), (4, 4, 3))
+    store.put(1, item(10))
+    store.put(1, item(20))
+    assert len(store) == 1
+    assert np.array_equal(store.get(1), item(20))
+
+
+def test_refresh_sees_writes_from_another_store(tmp_path):
+    reader = PackedArrayStore(str(tmp_path), (4, 4, 3), chunk_items=2)
+    writer = PackedArrayStore(str(tmp_path), (4, 4, 3), chunk_items=2)
+    reader.put(0, item(0))
+    for key in range(1, 5):
+        writer.put(key, item(key))
+
+    assert 4 not in reader
+    reader.refresh()
+    found, items = reader.get_many([4, 0, 3])
+    assert found == [4, 0, 3]
+    assert [int(i[0, 0, 0]) for i in items] == [4, 0, 3]
+
+
+def test_torn_index_record_is_ignored(tmp_path):
+    store = PackedArrayStore(str(tmp_path), (4, 4, 3))
+    store.put(1, item(1))
+    with open(store.index_path, "ab") as f:
+        f.write(b"\x00" * 5)  # a crash mid-write
+
+    reopened = PackedArrayStore(str(tmp_path), (4, 4, 3))
+    assert len(reopened) == 1
+    reopened.put(2, item(2))
+    assert np.array_equal(PackedArrayStore(str(tmp_path), (4, 4, 3)).get(2), item(2))
+
+
+def test_wrong_shape_or_dtype_is_refused(tmp_path):
+    store = PackedArrayStore(str(tmp_path), (4, 4, 3))
+    with pytest.raises(ValueError):
+        store.put(1, item(1, shape=(4, 4)))
+    with pytest.raises(ValueError):
+        store.put(1, item(1).astype(np.float32))
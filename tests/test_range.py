@@ -0,0 +1,30 @@
+import pytest
+
+from app.api.endpoints.data_operations import _parse_range
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 100)),
+    ("bytes=10-19", (10, 20)),
+    ("bytes=990-", (990, 1000)),       # open-ended
+    ("bytes=990-5000", (990, 1000)),   # end clamped to the size
+    ("bytes=-100", (900, 1000)),       # suffix: the last 100 bytes
+    ("bytes=-5000", (0, 1000)),        # suffix longer than the file
+    (" bytes=0-0 ", (0, 1)),
+])
+def test_satisfiable_ranges(header, expected):
+    assert _parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", [
+    "bytes=1000-",      # starts at the end
+    "bytes=2000-3000",  # starts past the end
+    "bytes=-0",         # empty suffix
+    "bytes=20-10",      # ends before it starts
+    "bytes=-",
+    "bytes=0-9,20-29",  # multiple ranges are not supported
+    "items=0-9",
+    "bytes=a-b",
+])
+def test_unsatisfiable_ranges_answer_416(header):
+    assert _parse_range(header, 1000) is None